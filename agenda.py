@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+"""agenda.py
+
+Udacity conference server-side Python App Engine personal agenda
+
+Interval helpers for a user's agenda, the sessions on the user's wishlist.
+An agenda is a list of items [start, end, websafeSessionKey, name], sorted by
+start and end. Start and end are ISO 8601 datetime strings, so they sort
+chronologically; sessions without date or start time have empty strings and
+come first, they are ignored for conflicts and free slots.
+
+The conferences the user is registered for are conference-level items of
+the same form, [start, end, websafeConferenceKey, name], spanning their days
+from 00:00 to 24:00. Their conflicts are found with the same sweep; they
+aren't part of the free slots, which are the gaps between the picked
+sessions.
+
+Keeping the list sorted makes adding a session a binary search plus insert,
+and conflicts and free slots a single sweep over the list.
+
+$Id$
+"""
+
+# built-in modules
+import bisect
+from datetime import datetime
+from datetime import timedelta
+
+# free slots are searched between these times of the days with sessions
+DAY_START = "08:00"
+DAY_END = "20:00"
+# free slots shorter than this are not reported
+MIN_FREE_SLOT = timedelta(minutes=15)
+
+
+def sessionItem(sess):
+    """Return the agenda item of a Session entity."""
+    start = end = ""
+    if sess.date and sess.startTime:
+        startDateTime = datetime.combine(sess.date, sess.startTime)
+        duration = sess.duration
+        endDateTime = startDateTime + timedelta(
+            hours=duration.hour, minutes=duration.minute) if duration \
+            else startDateTime
+        start, end = startDateTime.isoformat(), endDateTime.isoformat()
+    return [start, end, sess.key.urlsafe(), sess.name]
+
+
+def conferenceItem(conf):
+    """Return the agenda item of a Conference entity."""
+    start = end = ""
+    if conf.startDate:
+        start = "%sT00:00" % conf.startDate.isoformat()
+        end = "%sT24:00" % (conf.endDate or conf.startDate).isoformat()
+    return [start, end, conf.key.urlsafe(), conf.name]
+
+
+def buildAgenda(sessions):
+    """Return the sorted agenda of the given Session entities; O(n log n)."""
+    return sorted(sessionItem(sess) for sess in sessions if sess)
+
+
+def addItem(items, item):
+    """Insert an item into a sorted agenda, keeping it sorted."""
+    bisect.insort(items, item)
+    return items
+
+
+def _scheduled(items):
+    """Return the items with a start time, still sorted."""
+    return [item for item in items if item[0]]
+
+
+def findConflicts(items):
+    """Return the groups of overlapping sessions of a sorted agenda.
+
+    A single sweep keeps the latest end of the current group; an item
+    starting before that end overlaps the group.
+
+    returns:
+        conflicts: list of lists of at least two items each.
+    """
+    conflicts = []
+    group = []
+    groupEnd = None
+    for item in _scheduled(items):
+        if group and item[0] < groupEnd:
+            group.append(item)
+            groupEnd = max(groupEnd, item[1])
+        else:
+            if len(group) > 1:
+                conflicts.append(group)
+            group = [item]
+            groupEnd = item[1]
+    if len(group) > 1:
+        conflicts.append(group)
+    return conflicts
+
+
+def findFreeSlots(items):
+    """Return the free slots between DAY_START and DAY_END of every day of
+    a sorted agenda which has sessions.
+
+    returns:
+        freeSlots: list of [start, end] pairs of ISO 8601 strings.
+    """
+    freeSlots = []
+    day = None
+    free = None
+    dayEnd = None
+
+    def addSlot(start, end):
+        if end - start >= MIN_FREE_SLOT:
+            freeSlots.append([start.isoformat(), end.isoformat()])
+
+    for item in _scheduled(items):
+        start = datetime.strptime(item[0][:16], "%Y-%m-%dT%H:%M")
+        end = datetime.strptime(item[1][:16], "%Y-%m-%dT%H:%M")
+        if start.date() != day:
+            # close the previous day and open the next one
+            if day is not None and free < dayEnd:
+                addSlot(free, dayEnd)
+            day = start.date()
+            free = datetime.combine(day, datetime.strptime(
+                DAY_START, "%H:%M").time())
+            dayEnd = datetime.combine(day, datetime.strptime(
+                DAY_END, "%H:%M").time())
+        if start > free:
+            addSlot(free, min(start, dayEnd))
+        free = max(free, end)
+    if day is not None and free < dayEnd:
+        addSlot(free, dayEnd)
+    return freeSlots
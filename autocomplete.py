@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+"""autocomplete.py
+
+Udacity conference server-side Python App Engine autocomplete
+
+Prefix index for the typeahead of city, topic and speaker names. Every prefix
+of a name, and of each of its words, up to MAX_PREFIX_LENGTH characters is a
+PrefixIndex entity holding the first MAX_SUGGESTIONS names starting with it,
+in alphabetical order. So a lookup is a single get, served from the memory of
+the instance or memcache in front of the datastore.
+
+The index is maintained by the /tasks/index_names task on the autocomplete
+queue, which runs one task at a time, so entries are updated without
+transactions. Names are only ever added; a suggestion of a renamed speaker
+simply finds nothing.
+
+$Id$
+"""
+
+# built-in modules
+import time
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+# own modules
+from models import PrefixIndex
+from settings import AUTOCOMPLETE_QUEUE
+
+# longer prefixes are looked up by their first MAX_PREFIX_LENGTH characters
+MAX_PREFIX_LENGTH = 20
+MAX_SUGGESTIONS = 10
+
+MEMCACHE_AUTOCOMPLETE_KEY = "AUTOCOMPLETE:%s:%s"
+# suggestions are kept in the memory of the instance for MEMORY_TTL seconds
+MEMORY_TTL = 60
+MEMORY_MAX_ENTRIES = 10000
+_memory = {}
+
+
+def normalize(name):
+    """Return a name in lower case with single spaces."""
+    return u" ".join(name.lower().split())
+
+
+def _prefixes(name):
+    """Return the prefixes of a name and of each of its words."""
+    norm = normalize(name)
+    starts = [0] + [i + 1 for i, char in enumerate(norm) if char == " "]
+    return set(norm[start:end] for start in starts
+               for end in range(start + 1,
+                                min(len(norm), start + MAX_PREFIX_LENGTH) + 1))
+
+
+def _key(field, prefix):
+    return ndb.Key(PrefixIndex, u"%s:%s" % (field, prefix))
+
+
+def _cacheKey(field, prefix):
+    return (MEMCACHE_AUTOCOMPLETE_KEY % (field, prefix)).encode('utf-8')
+
+
+def queueNames(names, transactional=False):
+    """Queue names to be added to the index.
+
+    args:
+        names: dict of lists of names by AutocompleteField name.
+        transactional: only add the task if the current transaction commits.
+    """
+    params = dict((field, [name for name in values if name])
+                  for field, values in names.items())
+    if any(params.values()):
+        taskqueue.add(params=params, url='/tasks/index_names',
+                      queue_name=AUTOCOMPLETE_QUEUE,
+                      transactional=transactional)
+
+
+def _merge(suggestions, names):
+    """Return the first MAX_SUGGESTIONS of both lists, without duplicates."""
+    merged = {}
+    for name in suggestions + names:
+        merged.setdefault(normalize(name), name)
+    return [merged[norm] for norm in sorted(merged)][:MAX_SUGGESTIONS]
+
+
+def addNames(field, names):
+    """Add names to the index of a field; only changed entries are written
+    and their cached suggestions replaced."""
+    byPrefix = {}
+    for name in set(name.strip() for name in names if name.strip()):
+        for prefix in _prefixes(name):
+            byPrefix.setdefault(prefix, []).append(name)
+    prefixes = list(byPrefix)
+    keys = [_key(field, prefix) for prefix in prefixes]
+    changed = {}
+    for prefix, key, entry in zip(prefixes, keys, ndb.get_multi(keys)):
+        current = entry.suggestions if entry else []
+        suggestions = _merge(current, byPrefix[prefix])
+        if suggestions != current:
+            changed[prefix] = PrefixIndex(key=key, suggestions=suggestions)
+    ndb.put_multi(changed.values())
+    memcache.set_multi(dict((_cacheKey(field, prefix), entry.suggestions)
+                            for prefix, entry in changed.items()))
+
+
+def getSuggestions(field, prefix):
+    """Return the names of a field starting with a prefix, from the memory
+    of the instance, memcache or the datastore."""
+    norm = normalize(prefix)
+    if not norm:
+        return []
+    lookup = norm[:MAX_PREFIX_LENGTH]
+    cacheKey = _cacheKey(field, lookup)
+    now = time.time()
+    cached = _memory.get(cacheKey)
+    if cached and cached[0] > now:
+        suggestions = cached[1]
+    else:
+        suggestions = memcache.get(cacheKey)
+        if suggestions is None:
+            entry = _key(field, lookup).get()
+            suggestions = entry.suggestions if entry else []
+            memcache.set(cacheKey, suggestions)
+        if len(_memory) >= MEMORY_MAX_ENTRIES:
+            _memory.clear()
+        _memory[cacheKey] = (now + MEMORY_TTL, suggestions)
+    if len(norm) > MAX_PREFIX_LENGTH:
+        # only the first characters are indexed; check the rest here
+        suggestions = [name for name in suggestions
+                       if normalize(name).startswith(norm) or
+                       (u" " + norm) in normalize(name)]
+    return suggestions
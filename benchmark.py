@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+"""benchmark.py -- Udacity conference repository benchmark
+
+Loads generated conferences, sessions, speakers, profiles and registrations
+into a SQLite database and times the reads of the API on it through the
+SqliteRepository, i.e. the conference filters, the sessions by type and
+speaker, the featured speaker aggregation and the pagination of attendees.
+
+    $ python benchmark.py --conferences 100000 --sessions 10
+
+loads 100000 conferences with 10 sessions each into
+/tmp/conference-benchmark.sqlite, together with 50000 speakers, 100000
+profiles and a million registrations, about 4 million rows in all. It then
+prints the average time and number of rows of each read, so the query shapes
+can be compared with each other and across changes at a realistic scale. An
+existing database is reused, unless --reload is given. No App Engine SDK is
+needed.
+
+$Id$
+"""
+
+# built-in modules
+import argparse
+import os
+import random
+import time
+# own modules
+from sqliterepository import SqliteRepository
+
+CITIES = ['London', 'Chicago', 'Tokyo', 'Paris', 'San Francisco', 'Berlin',
+          'Sydney', 'Toronto', 'Madrid', 'Singapore']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition', 'Machine Learning',
+          'Cloud Computing', 'Security']
+TYPES = ['NOT_SPECIFIED', 'Workshop', 'Lecture', 'Keynote', 'Information',
+         'Networking']
+
+
+def load(repo, conferences, sessions, speakers, profiles, registrations,
+         seed):
+    """Fill the database with generated rows."""
+    rnd = random.Random(seed)
+    repo.createSchema()
+    repo.insert('profile', (
+        ('user%d' % i, 'User %d' % i, 'user%d@example.com' % i)
+        for i in range(profiles)))
+    repo.insert('speaker', ((i, 'Speaker %d' % i) for i in range(speakers)))
+
+    def conferenceRows():
+        for i in range(conferences):
+            month = rnd.randint(1, 12)
+            maxAttendees = rnd.choice([50, 100, 200, 500, 1000])
+            yield (i, 'Conference %d' % i, 'user%d' % rnd.randrange(profiles),
+                   rnd.choice(CITIES), '2016-%02d-01' % month, month,
+                   '2016-%02d-03' % month, maxAttendees,
+                   rnd.randint(0, maxAttendees))
+    repo.insert('conference', conferenceRows())
+    repo.insert('conference_topic', (
+        (i, topic) for i in range(conferences)
+        for topic in rnd.sample(TOPICS, rnd.randint(1, 3))))
+
+    def sessionRows():
+        for i in range(conferences * sessions):
+            yield (i, i // sessions, 'Session %d' % i, rnd.choice(TYPES),
+                   '2016-01-01', '%02d:00' % rnd.randint(8, 19))
+    repo.insert('session', sessionRows())
+    # speakers mostly speak at a handful of conferences, so some speak
+    # more than once at the same one and get featured
+    repo.insert('session_speaker', (
+        (i, ((i // sessions) * 7 + rnd.randrange(sessions)) % speakers,
+         position)
+        for i in range(conferences * sessions)
+        for position in range(rnd.randint(1, 2))))
+
+    def registrationRows():
+        seen = set()
+        for i in range(registrations):
+            pair = ('user%d' % rnd.randrange(profiles),
+                    rnd.randrange(conferences))
+            if pair not in seen:
+                seen.add(pair)
+                yield pair + (float(i),)
+    repo.insert('registration', registrationRows())
+
+
+def timeit(name, func, runs):
+    """Run func runs times & print the average time and result size."""
+    started = time.time()
+    size = 0
+    for run in range(runs):
+        size += func(run)
+    elapsed = (time.time() - started) / runs
+    print('%-40s %10.2f ms %12.1f rows' % (name, elapsed * 1000,
+                                            float(size) / runs))
+
+
+def run(repo, conferences, speakers, runs, seed):
+    """Time the reads of the API."""
+    rnd = random.Random(seed)
+
+    def conf():
+        return rnd.randrange(conferences)
+
+    timeit('queryConferences city', lambda run: len(repo.queryConferences(
+        [{'field': 'city', 'operator': '=', 'value': rnd.choice(CITIES)}],
+        pageSize=100)[0]), runs)
+    timeit('queryConferences 3 cities', lambda run: len(repo.queryConferences(
+        [{'field': 'city', 'operator': 'IN', 'value': rnd.sample(CITIES, 3)}],
+        pageSize=100)[0]), runs)
+    timeit('queryConferences topic & month >', lambda run: len(
+        repo.queryConferences([
+            {'field': 'topics', 'operator': '=',
+             'value': rnd.choice(TOPICS)},
+            {'field': 'month', 'operator': '>', 'value': rnd.randint(1, 11)}],
+            pageSize=100)[0]), runs)
+    timeit('queryConferences maxAttendees range', lambda run: len(
+        repo.queryConferences([
+            {'field': 'maxAttendees', 'operator': '>=', 'value': 100},
+            {'field': 'maxAttendees', 'operator': '<', 'value': 500}],
+            pageSize=100)[0]), runs)
+    timeit('conferenceSessions', lambda run: len(
+        repo.conferenceSessions(conf())), runs)
+    timeit('conferenceSessions by type', lambda run: len(
+        repo.conferenceSessions(conf(), typesOfSession=[rnd.choice(TYPES)])),
+        runs)
+    timeit('conferenceSessions by 2 types', lambda run: len(
+        repo.conferenceSessions(conf(), typesOfSession=rnd.sample(TYPES, 2))),
+        runs)
+    timeit('speakerSessions', lambda run: len(
+        repo.speakerSessions(rnd.randrange(speakers))), runs)
+    timeit('featuredSpeakers', lambda run: len(
+        repo.featuredSpeakers(conf())), runs)
+
+    def attendees(run):
+        conferenceId, size, token = conf(), 0, None
+        while True:
+            profiles, token = repo.attendees(conferenceId, 20, token)
+            size += len(profiles)
+            if not token:
+                return size
+    timeit('attendees, all pages of 20', attendees, runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--db', default='/tmp/conference-benchmark.sqlite')
+    parser.add_argument('--conferences', type=int, default=100000)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=50000)
+    parser.add_argument('--profiles', type=int, default=100000)
+    parser.add_argument('--registrations', type=int, default=1000000)
+    parser.add_argument('--runs', type=int, default=100)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--reload', action='store_true',
+                        help='recreate the database')
+    args = parser.parse_args()
+
+    if args.reload and os.path.exists(args.db):
+        os.remove(args.db)
+    fresh = not os.path.exists(args.db)
+    repo = SqliteRepository(args.db)
+    if fresh:
+        started = time.time()
+        load(repo, args.conferences, args.sessions, args.speakers,
+             args.profiles, args.registrations, args.seed)
+        print('loaded in %.1f s' % (time.time() - started))
+    run(repo, args.conferences, args.speakers, args.runs, args.seed)
+
+
+if __name__ == '__main__':
+    main()
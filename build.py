@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+"""build.py -- Udacity conference web front-end build
+
+Bundles the stylesheets and scripts between the build markers of
+templates/index.html:
+
+    <!-- build:css /assets/app.css -->
+    <link rel="stylesheet" href="/css/main.css">
+    <!-- endbuild -->
+
+Every block is concatenated, minified and written to build/assets/ with the
+md5 of its content in the file name, e.g. /assets/app.3f2a9c0b1d.css, so
+app.yaml can serve the assets with a far-future expiration. The partials are
+put into the Angular $templateCache at the end of the script bundle, so
+route changes don't fetch them. build/index.html refers to the bundles.
+
+Run it before starting the devserver or deploying:
+
+    $ python build.py
+
+$Id$
+"""
+
+# built-in modules
+import glob
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+INDEX = os.path.join(ROOT, 'templates', 'index.html')
+PARTIALS = os.path.join(ROOT, 'static', 'partials')
+BUILD = os.path.join(ROOT, 'build')
+ASSETS = os.path.join(BUILD, 'assets')
+
+# url prefixes of the static handlers in app.yaml and their directories
+STATIC_DIRS = {
+    '/css/': os.path.join(ROOT, 'static', 'bootstrap', 'css'),
+    '/js/': os.path.join(ROOT, 'static', 'js'),
+}
+
+BLOCK = re.compile(r'([ \t]*)<!-- build:(css|js) (\S+) -->'
+                   r'(.*?)<!-- endbuild -->', re.S)
+REFERENCE = re.compile(r'(?:href|src)="(/[^/"][^"]*)"')
+
+
+def _read(path):
+    with io.open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _write(path, data):
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(data)
+
+
+def _localPath(url):
+    """Return the file served by app.yaml for a local url."""
+    for prefix, directory in STATIC_DIRS.items():
+        if url.startswith(prefix):
+            return os.path.join(directory, url[len(prefix):])
+    raise ValueError('No static handler for %s' % url)
+
+
+def minifyCss(css):
+    """Strip comments and insignificant whitespace from a stylesheet."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    css = re.sub(r'\s+', ' ', css)
+    css = re.sub(r'\s*([{};,>])\s*', r'\1', css)
+    css = re.sub(r':\s+', ':', css)
+    return css.replace(';}', '}').strip() + '\n'
+
+
+def minifyJs(js):
+    """Strip comments standing on their own lines, indentation and empty
+    lines from a script. Line breaks are kept, so statements relying on
+    automatic semicolon insertion still work, and nothing within a line is
+    touched, so strings and regular expressions stay intact."""
+    js = re.sub(r'^[ \t]*/\*(?:(?!\*/).)*\*/[ \t]*$', '', js,
+                flags=re.S | re.M)
+    lines = []
+    for line in js.splitlines():
+        line = line.strip()
+        if line and not line.startswith('//'):
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def templateCacheJs():
+    """Return a script putting all partials into the $templateCache."""
+    puts = ''.join(
+        '    $templateCache.put(%s, %s);\n' % (
+            json.dumps('/partials/' + os.path.basename(path)),
+            json.dumps(_read(path)))
+        for path in sorted(glob.glob(os.path.join(PARTIALS, '*.html'))))
+    return ("angular.module('conferenceApp').run(['$templateCache', "
+            "function ($templateCache) {\n%s}]);\n" % puts)
+
+
+def _fingerprint(url, data):
+    """Write a bundle named after its content; return its url."""
+    name, ext = os.path.splitext(os.path.basename(url))
+    digest = hashlib.md5(data.encode('utf-8')).hexdigest()[:10]
+    fileName = '%s.%s%s' % (name, digest, ext)
+    _write(os.path.join(ASSETS, fileName), data)
+    return '%s/%s' % (os.path.dirname(url), fileName)
+
+
+def _bundle(match):
+    """Build the bundle of a build block & return the tag replacing it."""
+    indent, kind, url, body = match.groups()
+    sources = [_read(_localPath(ref)) for ref in REFERENCE.findall(body)]
+    if kind == 'css':
+        url = _fingerprint(url, minifyCss('\n'.join(sources)))
+        return '%s<link rel="stylesheet" href="%s">' % (indent, url)
+    sources.append(templateCacheJs())
+    url = _fingerprint(url, minifyJs('\n;\n'.join(sources)))
+    return '%s<script src="%s"></script>' % (indent, url)
+
+
+def build():
+    """Build build/index.html and the bundles in build/assets/."""
+    if os.path.isdir(BUILD):
+        shutil.rmtree(BUILD)
+    os.makedirs(ASSETS)
+    _write(os.path.join(BUILD, 'index.html'), BLOCK.sub(_bundle, _read(INDEX)))
+    for name in sorted(os.listdir(ASSETS)):
+        print('build/assets/%s (%d bytes)' % (
+            name, os.path.getsize(os.path.join(ASSETS, name))))
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""caches.py
+
+Udacity conference server-side Python App Engine derived values in memcache
+
+The announcement of nearly sold out conferences, the featured speakers of a
+conference and the version stamp of its sessions are derived from the
+datastore and maintained by tasks and crons as well as the API. They live in
+this module rather than in conference.py, so task and cron instances don't
+have to import the Endpoints API.
+
+$Id$
+"""
+
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+# own modules
+from models import Conference
+from repository import getRepository
+import readthrough
+
+MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_PROFILE_KEY = "PROFILE:%s"
+MEMCACHE_FEATURED_KEY = "FEATURED:%s"
+# conferences with at most this many (but more than zero) seats left are
+# listed in the announcement
+NEARLY_SOLD_OUT_SEATS = 5
+# number of compare-and-set attempts before falling back to a full sweep
+MEMCACHE_CAS_RETRIES = 5
+
+
+# - - - Announcements - - - - - - - - - - - - - - - - - - - -
+
+def isNearlySoldOut(conf):
+    """Return True if only a few seats of the conference are left."""
+    return 0 < (conf.seatsAvailable or 0) <= NEARLY_SOLD_OUT_SEATS
+
+
+def formatAnnouncement(nearlySoldOut):
+    """Format the announcement from the nearly sold out set.
+
+    args:
+        nearlySoldOut: dict mapping websafe conference keys to the names
+            of the nearly sold out conferences.
+    returns:
+        announcement: announcement string, empty if the set is empty.
+    """
+    if not nearlySoldOut:
+        return ""
+    return '%s %s' % (
+        'Last chance to attend! The following conferences '
+        'are nearly sold out:',
+        ', '.join(sorted(nearlySoldOut.values())))
+
+
+def queryNearlySoldOut():
+    """Return the nearly sold out set & the announcement formatted from
+    it, queried from the datastore."""
+    confs = Conference.query(ndb.AND(
+        Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+        Conference.seatsAvailable > 0)
+    ).fetch(projection=[Conference.name])
+
+    # The nearly sold out set and the announcement formatted from it are
+    # stored together, so both are always updated at once.
+    nearlySoldOut = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+    return {'conferences': nearlySoldOut,
+            'announcement': formatAnnouncement(nearlySoldOut)}
+
+
+def cacheAnnouncement():
+    """Create Announcement & assign to memcache; used by the memcache
+    cron job as a consistency sweep and as fallback whenever the nearly
+    sold out set has been evicted from memcache.
+    """
+    cached = queryNearlySoldOut()
+    readthrough.setValue(MEMCACHE_ANNOUNCEMENTS_KEY, cached)
+    return cached['announcement']
+
+
+def updateNearlySoldOut(c_key):
+    """Add or remove a single conference to/from the nearly sold out set
+    and rebuild the announcement from it; used by the update_announcement
+    task whenever a conference crosses the nearly sold out threshold.
+
+    args:
+        c_key: key of the conference which changed.
+    returns:
+        announcement: the updated announcement string.
+    """
+    # get the committed state of the conference; it may have changed
+    # again since the task was enqueued, so don't trust the task params.
+    conf = c_key.get()
+    wsck = c_key.urlsafe()
+    client = memcache.Client()
+    for _ in range(MEMCACHE_CAS_RETRIES):
+        cached = client.gets(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if cached is None:
+            # The set got evicted, so it can't be updated incrementally.
+            break
+        nearlySoldOut = cached['conferences']
+        if conf and isNearlySoldOut(conf):
+            nearlySoldOut[wsck] = conf.name
+        else:
+            nearlySoldOut.pop(wsck, None)
+        announcement = formatAnnouncement(nearlySoldOut)
+        # compare-and-set prevents concurrent tasks from overwriting each
+        # others changes
+        cached = {'conferences': nearlySoldOut,
+                  'announcement': announcement}
+        if client.cas(MEMCACHE_ANNOUNCEMENTS_KEY, cached):
+            readthrough.setStale(MEMCACHE_ANNOUNCEMENTS_KEY, cached)
+            return announcement
+    # set evicted or too much contention; rebuild it from the datastore.
+    return cacheAnnouncement()
+
+
+def getAnnouncement():
+    """Return the announcement from memcache; recomputed by a single
+    request if it got evicted."""
+    cached = readthrough.getValue(MEMCACHE_ANNOUNCEMENTS_KEY,
+                                  queryNearlySoldOut)
+    return cached.get('announcement') or ""
+
+
+# - - - Featured speakers - - - - - - - - - - - - - - - - - -
+
+def formatFeaturedSpeakers(c_key):
+    """Format the featured speakers of a conference, i.e. the speakers
+    of more than one of its sessions, and their sessions.
+
+    returns:
+        featured: featured speakers string, empty if there are none.
+    """
+    speakers = getRepository().featuredSpeakers(c_key)
+    if not speakers:
+        return ""
+    featured = "FEATURED SPEAKERS & SESSIONS ON THIS CONFERENCE -- "
+    for count, (name, sessionNames) in enumerate(speakers, 1):
+        featured += " FEATURED %s: %s SESSIONS: " % (count, name)
+        featured += ", ".join(sessionNames)
+    return featured
+
+
+def cacheFeaturedSpeakers(c_key):
+    """Format the featured speakers of a conference & assign them to
+    memcache; used by the check_speakers task whenever sessions or
+    speakers of the conference change."""
+    featured = formatFeaturedSpeakers(c_key)
+    # an empty string is cached as well, so it isn't recomputed on reads
+    readthrough.setValue(MEMCACHE_FEATURED_KEY % c_key.urlsafe(), featured)
+    return featured
+
+
+def getFeaturedSpeakers(c_key, cached=None):
+    """Return the featured speakers of a conference from memcache;
+    recomputed by a single request if they got evicted."""
+    return readthrough.getValue(
+        MEMCACHE_FEATURED_KEY % c_key.urlsafe(),
+        lambda: formatFeaturedSpeakers(c_key), cached)
+
+
+# - - - Sessions version - - - - - - - - - - - - - - - - - - -
+
+@ndb.transactional
+def touchConferenceSessions(c_key):
+    """Bump the version stamp of the sessions of a conference."""
+    conf = c_key.get()
+    if not conf:
+        # deleted; its sessions are being deleted as well
+        return
+    conf.touchSessions()
+    conf.put()
@@ -13,15 +13,22 @@ may 26 (v1.2)
 """
 
 # built-in modules
+import hashlib
+import logging
+import time
+_importStarted = time.time()
 from datetime import datetime
+from datetime import timedelta
 # third-party modules
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 # own modules
 from models import Profile
 from models import ProfileMiniForm
@@ -30,6 +37,7 @@ from models import TeeShirtSize
 from models import Conference
 from models import ConferenceForm
 from models import ConferenceForms
+from models import ConferenceDetailForm
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
 from models import Session
@@ -37,15 +45,48 @@ from models import SessionForm
 from models import SessionForms
 from models import Speaker
 from models import SpeakerForm
+from models import SpeakerName
+from models import SpeakerConferenceForm
+from models import SpeakerProfileForm
 from models import TypeOfSession
 from models import BooleanMessage
 from models import ConflictException
+from models import Registration
+from models import AttendeeForm
+from models import AttendeeForms
+from models import ExportData
+from models import ExportFormat
+from models import ExportJobForm
 from models import StringMessage
+from models import AutocompleteField
+from models import SuggestionsForm
+from models import FacetForm
+from models import PopularSessionForm
+from models import PopularSessionForms
+from models import Agenda
+from models import AgendaForm
+from models import AgendaItemForm
+from models import AgendaConflictForm
+from models import AgendaSlotForm
+from models import DEFAULTS
+from models import DEFAULTS_SESSION
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
+from settings import CONFIRMATION_EMAIL_QUEUE
 from utils import getUserId
+from ratelimit import rateLimited
+from multiquery import mergeQueries
+from repository import INTEGER_FIELDS
+from repository import getRepository
+from caches import MEMCACHE_FEATURED_KEY
+from caches import MEMCACHE_PROFILE_KEY
+import agenda
+import autocomplete
+import facets
+import popularity
+import caches
 
 # authorship information
 __authors__ = "Wesley Chun, Norbert Stueken"
@@ -61,23 +102,6 @@ __status__ = "Development"
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
-
-DEFAULTS = {
-    "city": "Default City",
-    "maxAttendees": 0,
-    "seatsAvailable": 0,
-    "topics": ["Default", "Topic"],
-}
-
-DEFAULTS_SESSION = {
-    "highlights": ["Default", "Highlight"],
-    "location": "Default Location",
-    "typeOfSession": TypeOfSession("NOT_SPECIFIED"),
-    "date": "1900-01-01",
-    "startTime": "10:00",
-    "duration": "00:00"
-}
 
 OPERATORS = {
             'EQ':   '=',
@@ -85,9 +109,14 @@ OPERATORS = {
             'GTEQ': '>=',
             'LT':   '<',
             'LTEQ': '<=',
-            'NE':   '!='
+            'NE':   '!=',
+            'IN':   'IN'
             }
 
+# default and maximum number of items of paginated listings
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
 FIELDS = {
             'CITY': 'city',
             'TOPIC': 'topics',
@@ -100,27 +129,97 @@ CONF_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
 )
 
+# container for read endpoints supporting conditional requests. The entity
+# tag of the client's copy can be sent in the If-None-Match header or, as
+# the discovery based JavaScript client can't set headers, as ifNoneMatch
+# parameter.
+CONF_CONDITIONAL_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+ANNOUNCEMENT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONF_CREATED_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageToken=messages.StringField(2),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+)
+
+CONF_ATTENDING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageToken=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    ifNoneMatch=messages.StringField(3),
+)
+
+EXPORT_POST_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    data=messages.EnumField(ExportData, 2, required=True),
+    format=messages.EnumField(ExportFormat, 3, default='CSV'),
+)
+
+EXPORT_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeExportKey=messages.StringField(1),
+)
+
 # container only used to show city and not field for the request in
 # API Explorer
 CONF_IN_CITY_REQUEST = endpoints.ResourceContainer(
     city=messages.StringField(1)
 )
 
+AUTOCOMPLETE_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    field=messages.EnumField(AutocompleteField, 1),
+    prefix=messages.StringField(2),
+)
+
 SESSION_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
 )
 
 SESSION_BY_TYPE_GET_REQUEST = endpoints.ResourceContainer(
-    typeOfSession=messages.EnumField(TypeOfSession, 1),
+    typeOfSession=messages.EnumField(TypeOfSession, 1, repeated=True),
+    websafeConferenceKey=messages.StringField(2),
+)
+
+SESSION_UPCOMING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    hours=messages.IntegerField(1, default=2),
+    websafeConferenceKey=messages.StringField(2),
+)
+
+SESSION_RUNNING_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    time=messages.StringField(1),
     websafeConferenceKey=messages.StringField(2),
 )
 
+SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
+    SpeakerForm,
+    websafeSpeakerKey=messages.StringField(1),
+)
+
 SESSION_POST_REQUEST = endpoints.ResourceContainer(
     SessionForm,
     websafeConferenceKey=messages.StringField(1),
@@ -131,6 +230,12 @@ WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1)
 )
 
+POPULAR_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    limit=messages.IntegerField(2),
+)
+
 WISHLIST_POST_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeSessionKey=messages.StringField(1)
@@ -150,6 +255,58 @@ SESSION_BY_SPK_AND_CONF_GET_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v1.2"""
 
+    # A new service instance is created for every request, so these hold the
+    # request scoped user, user id and profile (see _getProfileFromUser).
+    _user = None
+    _userId = None
+    _profile = None
+
+# - - - Conditional requests - - - - - - - - - - - - - - - - -
+
+    def _getIfNoneMatch(self, request):
+        """Return the entity tags of the copies the client already holds.
+
+        args:
+            request: request object, possibly containing an ifNoneMatch
+                field.
+        returns:
+            etags: list of entity tags, taken from the ifNoneMatch field or
+                the If-None-Match header.
+        """
+        value = getattr(request, 'ifNoneMatch', None)
+        if not value:
+            value = self.request_state.headers.get('If-None-Match') or ''
+        # strip weak validator prefixes & quotes, e.g. W/"v12" -> v12
+        return [etag.strip().replace('W/', '', 1).strip('"')
+                for etag in value.split(',') if etag.strip()]
+
+    @staticmethod
+    def _stringEtag(data):
+        """Return the entity tag (a content hash) of a cached string."""
+        return hashlib.md5((data or "").encode('utf-8')).hexdigest()[:16]
+
+    def _conditionalString(self, request, data):
+        """Return data as StringMessage, leaving it out if the client already
+        holds the current version.
+        """
+        etag = self._stringEtag(data)
+        if etag in self._getIfNoneMatch(request):
+            return StringMessage(data="", etag=etag, notModified=True)
+        return StringMessage(data=data, etag=etag)
+
+    def _conditionalMessage(self, request, message):
+        """Return message with its entity tag (a content hash), or an empty
+        message of its type if the client already holds the current version.
+
+        Used for responses assembled from several entities, which have no
+        single version stamp; the response is still built, but not sent.
+        """
+        etag = hashlib.md5(protojson.encode_message(message)).hexdigest()[:16]
+        if etag in self._getIfNoneMatch(request):
+            return type(message)(etag=etag, notModified=True)
+        message.etag = etag
+        return message
+
 
 # - - - Session  objects - - - - - - - - - - - - - - - - - -
 
@@ -179,10 +336,14 @@ class ConferenceApi(remote.Service):
                 # convert startTime to time string;
                 elif field.name == 'duration':
                     setattr(sf, field.name, str(getattr(sess, field.name)))
-                # convert list of Speaker keys to list of strings:
+                # copy the denormalized speaker names; sessions written
+                # before they were stored read the speakers in one batch
                 elif field.name == 'speakers':
-                    setattr(sf, field.name,
-                            [str(s.get().name) for s in sess.speakers])
+                    names = sess.speakerNames
+                    if len(names) != len(sess.speakers):
+                        names = [spk.name for spk in
+                                 ndb.get_multi(sess.speakers) if spk]
+                    setattr(sf, field.name, [str(name) for name in names])
                 # just copy other fields
                 else:
                     setattr(sf, field.name, getattr(sess, field.name))
@@ -204,10 +365,7 @@ class ConferenceApi(remote.Service):
                 values and a websafeKey identifying the session.
         """
         # check if user is logged in
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         # convert websafeKey to conference key
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
@@ -258,29 +416,16 @@ class ConferenceApi(remote.Service):
         # convert speakers from a list of strings to a list of Speaker entity
         # keys
         if data['speakers']:
-            # check for each provided session speaker if he exists already in
-            # the database. If yes, get the key value, if not, create a new
-            # speaker with the provided name as key.
-            # NOTE: For simplification, it is assumed that a name uniquely
-            # identifies a speaker and therefore can be set as id as well.
-            sessionSpeakers = []
-            for speaker in data['speakers']:
-                # get_or_insert(key_name, args) transactionally retrieves an
-                # existing entity or creates a new one. This also prevents the
-                # risk of duplicate speaker records when multiple sessions with
-                # the same speaker are created at the same time.
-                # For the key name, the speaker string is formatted in lower
-                # case without whitespaces. To be safe, it should also be
-                # converted to an ascii string in case of special unicode
-                # characters. However, as this is more complicated, its not
-                # been done for this exercise.
-                session_speaker_key = Speaker.get_or_insert(
-                     speaker.lower().strip().replace(" ", "_"),
-                     name=speaker).key
-                # Add Speaker key to the list of sessionSpeakers.
-                sessionSpeakers.append(session_speaker_key)
-            # overwrite data['speakers'] with the new created key list.
-            data['speakers'] = sessionSpeakers
+            # A speaker is found by its name; speakers who don't exist yet
+            # are created with an allocated id. Their SpeakerName entities
+            # keep names unique, also when sessions with the same new speaker
+            # are created at the same time, and a renamed speaker isn't found
+            # by its former name any more.
+            names = data['speakers']
+            speakers = Speaker.getOrInsertMulti(names)
+            # Add Speaker keys and names to the lists of the session.
+            data['speakers'] = [speakers[name].key for name in names]
+            data['speakerNames'] = [speakers[name].name for name in names]
 
         # get Conference Key
         c_key = conf.key
@@ -292,11 +437,19 @@ class ConferenceApi(remote.Service):
         data['key'] = s_key
         # create Session
         Session(**data).put()
+        # invalidate the entity tag of the conference sessions
+        caches.touchConferenceSessions(c_key)
         # get session to copy it back to the form as return
         sess = s_key.get()
         # add task to queue to check the speakers of the conference
         taskqueue.add(params={'c_key_str': c_key.urlsafe()},
                       url='/tasks/check_speakers')
+        # offer the speakers to the autocomplete
+        autocomplete.queueNames({'SPEAKER': sess.speakerNames})
+        # recount the sessions of the speakers
+        for spk_key in sess.speakers:
+            taskqueue.add(params={'websafeSpeakerKey': spk_key.urlsafe()},
+                          url='/tasks/count_speaker_sessions')
         return self._copySessionToForm(sess)
 
     def _getConferenceSessions(self, request):
@@ -329,26 +482,95 @@ class ConferenceApi(remote.Service):
             raise endpoints.BadRequestException("Speaker 'name' field \
                 required")
 
-        # create a new Speaker.key
-        spk_key = Speaker().key
-        # query all existing/known speakers
-        qryKnownSpeakers = Speaker.query()
-        # write the names of the known speakers in a list
-        knownSpeakers = []
-        for ks in qryKnownSpeakers:
-            knownSpeakers.append(ks.name)
+        # look the speaker up by its SpeakerName instead of scanning all
+        # known speakers
+        spk_key = Speaker.findKey(request.name)
         # If speaker doesn't exist, raise an "Not Found"-exception.
-        if request.name not in knownSpeakers:
+        if not spk_key:
             raise endpoints.NotFoundException(
                 'No speaker found with name: %s'
                 % request.name)
-        # Else return its key.
-        # NOTE: For simplification, it is assumed that a name uniquely
-        # identifies a speaker.
-        else:
-            spk_key = Speaker.query(Speaker.name == request.name).get().key
         return spk_key
 
+    @endpoints.method(SpeakerForm, SpeakerProfileForm,
+                      path='speaker',
+                      http_method='GET', name='getSpeaker')
+    def getSpeaker(self, request):
+        """Return a speaker with the number of sessions per conference."""
+        return self._copySpeakerToForm(self._getSpeakerKey(request).get())
+
+    def _copySpeakerToForm(self, spk):
+        """Copy a Speaker and its session counts to a SpeakerProfileForm."""
+        # the counts are kept up to date by /tasks/count_speaker_sessions
+        counts = spk.sessionCounts or {}
+        c_keys = [ndb.Key(urlsafe=wsck) for wsck in sorted(counts)]
+        return SpeakerProfileForm(
+            name=spk.name,
+            websafeKey=spk.key.urlsafe(),
+            conferences=[SpeakerConferenceForm(
+                websafeConferenceKey=c_key.urlsafe(), name=conf.name,
+                sessions=counts[c_key.urlsafe()])
+                for c_key, conf in zip(c_keys, ndb.get_multi(c_keys))
+                if conf],
+            sessions=sum(counts.values())
+        )
+
+    @endpoints.method(SPEAKER_POST_REQUEST, SpeakerProfileForm,
+                      path='speaker/{websafeSpeakerKey}',
+                      http_method='PUT', name='updateSpeaker')
+    def updateSpeaker(self, request):
+        """Rename a speaker; only organizers of a conference the speaker
+        has sessions at may do so."""
+        user_id = self._getUserId()
+        if not request.name:
+            raise endpoints.BadRequestException("Speaker 'name' field \
+                required")
+        spk_key = ndb.Key(urlsafe=request.websafeSpeakerKey)
+        if not spk_key.get():
+            raise endpoints.NotFoundException(
+                'No speaker found with key: %s' % request.websafeSpeakerKey)
+
+        # check that user organizes a conference of the speaker
+        c_keys = set(s_key.parent() for s_key in Session.query(
+            Session.speakers == spk_key).fetch(keys_only=True))
+        if not any(conf and conf.organizerUserId == user_id
+                   for conf in ndb.get_multi(list(c_keys))):
+            raise endpoints.ForbiddenException(
+                'Only an organizer of a conference of the speaker can '
+                'rename the speaker.')
+
+        # the name must not belong to another speaker
+        other = Speaker.findKey(request.name)
+        if other and other != spk_key:
+            raise ConflictException(
+                'Another speaker is named: %s' % request.name)
+
+        return self._copySpeakerToForm(
+            self._renameSpeaker(spk_key, request.name))
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _renameSpeaker(spk_key, name):
+        """Rename a speaker and fan the new name out to its sessions."""
+        spk = spk_key.get()
+        # move the SpeakerName of the speaker to the new name
+        oldId, newId = Speaker.idFromName(spk.name), Speaker.idFromName(name)
+        if oldId != newId:
+            mappings = ndb.get_multi([ndb.Key(SpeakerName, oldId),
+                                      ndb.Key(SpeakerName, newId)])
+            if mappings[1] and mappings[1].speaker != spk_key:
+                raise ConflictException(
+                    'Another speaker is named: %s' % name)
+            if mappings[0] and mappings[0].speaker == spk_key:
+                mappings[0].key.delete()
+            SpeakerName(id=newId, speaker=spk_key).put()
+        spk.name = name
+        spk.put()
+        taskqueue.add(params={'websafeSpeakerKey': spk_key.urlsafe()},
+                      url='/tasks/rename_speaker', transactional=True)
+        autocomplete.queueNames({'SPEAKER': [name]}, transactional=True)
+        return spk
+
     @endpoints.method(SESSION_POST_REQUEST, SessionForm,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='POST', name='createSession')
@@ -359,13 +581,22 @@ class ConferenceApi(remote.Service):
     @endpoints.method(SESSION_GET_REQUEST, SessionForms,
                       path='conference/{websafeConferenceKey}/sessions',
                       http_method='GET', name='getConferenceSessions')
+    @rateLimited
     def getConferenceSessions(self, request):
         """Given a conference, return all sessions."""
+        # the query is lazy; sessions are only read if they changed
         sessions = self._getConferenceSessions(request)
+        # the conference has just been read by _getConferenceSessions, so it
+        # is served from the in-context cache
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        etag = 's%d' % (conf.sessionsVersion or 0)
+        if etag in self._getIfNoneMatch(request):
+            return SessionForms(etag=etag, notModified=True)
         # return set of SessionForm objects per Session
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in
-                   sessions]
+                   sessions],
+            etag=etag
         )
 
     @endpoints.method(
@@ -373,11 +604,15 @@ class ConferenceApi(remote.Service):
         path='conference/{websafeConferenceKey}/sessions/byType',
         http_method='GET', name='getConferenceSessionsByType')
     def getConferenceSessionsByType(self, request):
-        """ Given a conference, return all sessions of a specified type."""
-        sessions = self._getConferenceSessions(request)
-        # filter by requested typeOfSession
-        sessions = sessions.filter(
-            Session.typeOfSession == str(request.typeOfSession))
+        """ Given a conference, return all sessions of the specified types."""
+        if not request.typeOfSession:
+            raise endpoints.BadRequestException("'typeOfSession' required")
+        # check that the conference exists
+        self._getConferenceSessions(request)
+        # get the sessions of the requested types of session
+        sessions = getRepository().conferenceSessions(
+            ndb.Key(urlsafe=request.websafeConferenceKey),
+            typesOfSession=[str(t) for t in set(request.typeOfSession)])
         # return set of SessionForm objects per Session
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in
@@ -391,8 +626,8 @@ class ConferenceApi(remote.Service):
         """ Returns all sessions given by a particular speaker."""
         # get key of requested speaker
         spk_key = self._getSpeakerKey(request)
-        # create query for all session by provided speaker
-        sessions = Session.query(Session.speakers == spk_key)
+        # get all sessions by provided speaker
+        sessions = getRepository().speakerSessions(spk_key)
         # return set of SessionForm objects per Session
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in
@@ -405,26 +640,81 @@ class ConferenceApi(remote.Service):
         http_method='POST', name='getConferenceSessionsBySpeaker')
     def getConferenceSessionsBySpeaker(self, request):
         """ Returns all conference sessions of a given speaker."""
-        # get all sessions of requested conference
-        conf_sessions = self._getConferenceSessions(request)
+        # check that the conference exists
+        self._getConferenceSessions(request)
         # get key of requested speaker
         spk_key = self._getSpeakerKey(request)
-        # filter conf_sessions for all sessions by provided speaker
-        conf_session_by_spk = conf_sessions.filter(Session.speakers == spk_key)
+        # get the sessions of the conference by provided speaker
+        conf_session_by_spk = getRepository().conferenceSessions(
+            ndb.Key(urlsafe=request.websafeConferenceKey), speakerId=spk_key)
         # return set of SessionForm objects per Session
         return SessionForms(
             items=[self._copySessionToForm(sess) for sess in
                    conf_session_by_spk]
         )
 
+    def _getSessionsQuery(self, request):
+        """Return a query on the sessions of the conference given by an
+        optional websafeConferenceKey, or on all sessions."""
+        if not request.websafeConferenceKey:
+            return Session.query()
+        return Session.query(
+            ancestor=ndb.Key(urlsafe=request.websafeConferenceKey))
+
+    @endpoints.method(SESSION_UPCOMING_GET_REQUEST, SessionForms,
+                      path='sessions/upcoming',
+                      http_method='GET', name='getSessionsStartingSoon')
+    def getSessionsStartingSoon(self, request):
+        """Return sessions starting within the next hours (default 2),
+        optionally of a single conference."""
+        if request.hours < 1:
+            raise endpoints.BadRequestException("'hours' must be positive")
+        now = datetime.utcnow()
+        # a single range scan of the startDateTime index
+        sessions = self._getSessionsQuery(request).filter(
+            Session.startDateTime >= now,
+            Session.startDateTime < now + timedelta(hours=request.hours)
+        ).order(Session.startDateTime)
+        return SessionForms(
+            items=[self._copySessionToForm(sess) for sess in sessions]
+        )
+
+    @endpoints.method(SESSION_RUNNING_GET_REQUEST, SessionForms,
+                      path='sessions/running',
+                      http_method='GET', name='getSessionsRunningAt')
+    def getSessionsRunningAt(self, request):
+        """Return sessions running at a time 'YYYY-MM-DDTHH:MM' (default
+        now), optionally of a single conference."""
+        if request.time:
+            try:
+                at = datetime.strptime(request.time[:16], "%Y-%m-%dT%H:%M")
+            except ValueError:
+                raise endpoints.BadRequestException(
+                    "'time' must be formatted as YYYY-MM-DDTHH:MM")
+        else:
+            at = datetime.utcnow()
+        # Two inequality filters on startDateTime and endDateTime are not
+        # allowed, so a single equality scan on the hour the session runs in
+        # is used and only the sessions of that hour are checked here.
+        hour = at.replace(minute=0, second=0, microsecond=0)
+        sessions = self._getSessionsQuery(request).filter(
+            Session.runningHours == hour).order(Session.startDateTime)
+        return SessionForms(
+            items=[self._copySessionToForm(sess) for sess in sessions
+                   if sess.startDateTime <= at and
+                   (at < sess.endDateTime or
+                    at == sess.startDateTime == sess.endDateTime)]
+        )
+
     @endpoints.method(WISHLIST_POST_REQUEST, BooleanMessage,
                       path='wishlist',
                       http_method='POST', name='addSessionToWishlist')
     # making the function transactional prevents the risk of losing a session
     # when multiple sessions get added. With @ndb.transaction concurrent writes
     # to the same entity (profile) are not possible. By default, 3 retries are
-    # made.
-    @ndb.transactional
+    # made. The session is read from its own entity group and its popularity
+    # counted in another one, hence xg.
+    @ndb.transactional(xg=True)
     def addSessionToWishlist(self, request):
         """ Add a given session to the users Wishlist. """
         onList = None
@@ -433,8 +723,10 @@ class ConferenceApi(remote.Service):
         # check if session exists already on the wishlist
         # given the websafeSessionKey
         wssk = request.websafeSessionKey
-        sess = ndb.Key(urlsafe=wssk).get()
-        if not sess:
+        s_key = ndb.Key(urlsafe=wssk)
+        # the sessions of a deleted conference are about to be deleted
+        sess, conf = ndb.get_multi([s_key, s_key.parent()])
+        if not sess or not conf:
             raise endpoints.NotFoundException(
                 'No session found with key: %s' % wssk)
 
@@ -447,10 +739,109 @@ class ConferenceApi(remote.Service):
         prof.sessionsKeysOnWishlist.append(wssk)
         onList = True
 
+        # count the addition for the session popularity leaderboard
+        popularity.incrementPopularity(sess)
+
+        # keep the agenda sorted; a missing agenda is built by getAgenda
+        agd = self._agendaKey(prof.key).get()
+        if agd:
+            agenda.addItem(agd.items, agenda.sessionItem(sess))
+            agd.put()
+
         # write added session back to the datastore & return
         prof.put()
+        self._cacheProfile(prof)
         return BooleanMessage(data=onList)
 
+    @endpoints.method(POPULAR_GET_REQUEST, PopularSessionForms,
+                      path='conference/{websafeConferenceKey}'
+                           '/sessions/popular',
+                      http_method='GET', name='getPopularSessions')
+    def getPopularSessions(self, request):
+        """Return the most wishlisted sessions of a conference."""
+        limit = min(request.limit or popularity.LEADERBOARD_SIZE,
+                    popularity.LEADERBOARD_SIZE)
+        board = popularity.getLeaderboard(
+            ndb.Key(urlsafe=request.websafeConferenceKey))
+        return PopularSessionForms(items=[
+            PopularSessionForm(websafeSessionKey=wssk, name=name,
+                               wishlistCount=count)
+            for wssk, name, count in board[:limit]])
+
+    @staticmethod
+    def _agendaKey(p_key):
+        """Return the key of the Agenda of a profile."""
+        return ndb.Key(Agenda, 'agenda', parent=p_key)
+
+    def _getAgenda(self, prof):
+        """Return the Agenda of a profile, rebuilding its sessions when they
+        are missing or out of sync with the wishlist and its conferences
+        when they are missing."""
+        a_key = self._agendaKey(prof.key)
+        agd = a_key.get() or Agenda(key=a_key)
+        changed = False
+        if agd.items is None or set(item[2] for item in agd.items) != \
+                set(prof.sessionsKeysOnWishlist):
+            sessions = ndb.get_multi([ndb.Key(urlsafe=wssk) for wssk in
+                                      prof.sessionsKeysOnWishlist])
+            agd.items = agenda.buildAgenda(sessions)
+            changed = True
+        # afterwards kept up to date by _conferenceRegistration
+        if agd.conferences is None:
+            wscks = set(prof.conferenceKeysToAttend)
+            wscks.update(r_key.id() for r_key in Registration.query(
+                ancestor=prof.key).iter(keys_only=True))
+            agd.conferences = sorted(wscks)
+            changed = True
+        if changed:
+            agd.put()
+        return agd
+
+    @staticmethod
+    def _copyAgendaItemToForm(item):
+        """Copy an agenda item of a session to an AgendaItemForm."""
+        start, end, wssk, name = item
+        return AgendaItemForm(
+            websafeSessionKey=wssk, name=name, start=start or None,
+            end=end or None,
+            websafeConferenceKey=ndb.Key(urlsafe=wssk).parent().urlsafe())
+
+    @staticmethod
+    def _copyAgendaConferenceToForm(item):
+        """Copy an agenda item of a conference to an AgendaItemForm."""
+        start, end, wsck, name = item
+        return AgendaItemForm(websafeConferenceKey=wsck, name=name,
+                              start=start or None, end=end or None)
+
+    @endpoints.method(message_types.VoidMessage, AgendaForm,
+                      path='agenda',
+                      http_method='GET', name='getAgenda')
+    def getAgenda(self, request):
+        """Get the user's agenda of wishlisted sessions and registered
+        conferences with their conflicts, and the free slots between the
+        sessions."""
+        prof = self._getProfileFromUser()  # get user profile
+        agd = self._getAgenda(prof)
+        items = agd.items
+        # read the conferences for their current dates; a single batch get
+        confItems = sorted(agenda.conferenceItem(conf) for conf in
+                           ndb.get_multi([ndb.Key(urlsafe=wsck) for wsck in
+                                          agd.conferences]) if conf)
+        return AgendaForm(
+            items=[self._copyAgendaItemToForm(item) for item in items],
+            conferences=[self._copyAgendaConferenceToForm(item)
+                         for item in confItems],
+            conflicts=[AgendaConflictForm(
+                items=[self._copyAgendaItemToForm(item) for item in group])
+                for group in agenda.findConflicts(items)] +
+            [AgendaConflictForm(
+                items=[self._copyAgendaConferenceToForm(item)
+                       for item in group])
+             for group in agenda.findConflicts(confItems)],
+            freeSlots=[AgendaSlotForm(start=start, end=end)
+                       for start, end in agenda.findFreeSlots(items)]
+        )
+
     @endpoints.method(message_types.VoidMessage, SessionForms,
                       path='wishlist',
                       http_method='GET', name='getSessionsInWishlist')
@@ -509,15 +900,18 @@ class ConferenceApi(remote.Service):
         # q = Session.query(ndb.AND(
         #     Session.typeOfSession != "Workshop", Session.startTime <= time))
 
-        q = Session.query(ndb.AND(
-                          Session.typeOfSession.IN(["NOT_SPECIFIED", "Lecture",
-                                                    "Keynote", "Information",
-                                                    "Networking"]),
-                          Session.startTime <= datetime.strptime(
-                            "7:00 pm", "%I:%M %p").time()))
+        # one subquery per type, run concurrently & merged by start time
+        startTime = datetime.strptime("7:00 pm", "%I:%M %p").time()
+        queries = [Session.query(Session.typeOfSession == typeOfSession,
+                                 Session.startTime <= startTime).order(
+                                 Session.startTime)
+                   for typeOfSession in ["NOT_SPECIFIED", "Lecture",
+                                         "Keynote", "Information",
+                                         "Networking"]]
+        sessions, _ = mergeQueries(queries, ['startTime'])
 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=[self._copySessionToForm(sess) for sess in sessions]
         )
 
 
@@ -544,11 +938,10 @@ class ConferenceApi(remote.Service):
         """Create or update Conference object, returning
         ConferenceForm/request.
         """
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        # preload necessary data items; getting the profile makes sure the
+        # organizer has one, holding the address for the confirmation email
+        prof = self._getProfileFromUser()
+        user_id = prof.key.id()
 
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field \
@@ -559,6 +952,8 @@ class ConferenceApi(remote.Service):
                 request.all_fields()}
         del data['websafeKey']
         del data['organizerDisplayName']
+        del data['etag']
+        del data['notModified']
 
         # add default values for those missing (both data model & outbound
         # Message)
@@ -593,21 +988,26 @@ class ConferenceApi(remote.Service):
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
 
-        # create Conference, send email to organizer confirming
+        # create Conference, queue email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
-        Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
-                      'conferenceInfo': repr(request)},
-                      url='/tasks/send_confirmation_email'
-                      )
+        conf = Conference(**data)
+        conf.put()
+        # the email is rendered from the conference when it is sent, so the
+        # conference key is all the pull task needs to carry.
+        taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE).add(
+            taskqueue.Task(payload=c_key.urlsafe(), method='PULL'))
+        # offer the city and topics to the autocomplete & count them
+        autocomplete.queueNames({'CITY': [conf.city], 'TOPIC': conf.topics})
+        facets.queueCount([c_key])
+        # a small conference can be nearly sold out right from the start
+        if caches.isNearlySoldOut(conf):
+            taskqueue.add(params={'websafeConferenceKey': c_key.urlsafe()},
+                          url='/tasks/update_announcement')
         return request
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._getUserId()
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in
@@ -626,6 +1026,12 @@ class ConferenceApi(remote.Service):
             raise endpoints.ForbiddenException(
                 'Only the owner can update the conference.')
 
+        # remember the announcement relevant state before the update
+        wasNearlySoldOut = caches.isNearlySoldOut(conf)
+        oldName = conf.name
+        oldCity, oldTopics = conf.city, set(conf.topics)
+        oldFacets = facets.facetValues(conf)
+
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
         for field in request.all_fields():
@@ -640,6 +1046,23 @@ class ConferenceApi(remote.Service):
                 # write to Conference object
                 setattr(conf, field.name, data)
         conf.put()
+        # update the announcement if the conference crossed the nearly sold
+        # out threshold or got renamed while being listed. The task is only
+        # enqueued if the transaction commits.
+        isNearlySoldOut = caches.isNearlySoldOut(conf)
+        if (isNearlySoldOut != wasNearlySoldOut or
+                (isNearlySoldOut and conf.name != oldName)):
+            taskqueue.add(params={'websafeConferenceKey': conf.key.urlsafe()},
+                          url='/tasks/update_announcement',
+                          transactional=True)
+        # offer a new city or new topics to the autocomplete
+        autocomplete.queueNames({
+            'CITY': [conf.city] if conf.city != oldCity else [],
+            'TOPIC': [t for t in conf.topics if t not in oldTopics]},
+            transactional=True)
+        # recount the city, topics and month
+        if facets.facetValues(conf) != oldFacets:
+            facets.queueCount([conf.key], transactional=True)
         prof = ndb.Key(Profile, user_id).get()
         return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
@@ -656,7 +1079,36 @@ class ConferenceApi(remote.Service):
         """Update conference w/provided fields & return w/updated info."""
         return self._updateConferenceObject(request)
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @ndb.transactional(xg=True)
+    def _deleteConferenceObject(self, request):
+        user_id = self._getUserId()
+        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        # check that conference exists
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s'
+                % request.websafeConferenceKey)
+
+        # check that user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can delete the conference.')
+
+        # its sessions, registrations etc. are deleted by a chain of tasks;
+        # imported here, as deletions also loads the migrations
+        from deletions import startDeletion
+        startDeletion(conf)
+        return BooleanMessage(data=True)
+
+    @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
+                      path='conference/{websafeConferenceKey}/delete',
+                      http_method='POST', name='deleteConference')
+    def deleteConference(self, request):
+        """Delete conference; its sessions and all references to it are
+        deleted in the background."""
+        return self._deleteConferenceObject(request)
+
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
     def getConference(self, request):
@@ -668,51 +1120,88 @@ class ConferenceApi(remote.Service):
                 'No conference found with key: %s'
                 % request.websafeConferenceKey)
         prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+        # return ConferenceForm; tagged by content, as the organizer's
+        # displayName can change without a new conference version
+        return self._conditionalMessage(request, self._copyConferenceToForm(
+            conf, getattr(prof, 'displayName')))
+
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, ConferenceDetailForm,
+                      path='conference/{websafeConferenceKey}/detail',
+                      http_method='GET', name='getConferenceDetail')
+    def getConferenceDetail(self, request):
+        """Return a conference with its organizer, sessions and featured
+        speakers, and the user's registration & wishlist for it."""
+        wsck = request.websafeConferenceKey
+        c_key = ndb.Key(urlsafe=wsck)
+        # start all reads at once; the organizer profile is the parent of
+        # the conference, so it doesn't have to wait for the conference
+        conf_future = c_key.get_async()
+        organizer_future = c_key.parent().get_async()
+        sessions_future = Session.query(ancestor=c_key).fetch_async()
+        featured_future = ndb.get_context().memcache_get(
+            MEMCACHE_FEATURED_KEY % wsck)
+        prof = None
+        if endpoints.get_current_user():
+            reg_future = ndb.Key(Registration, wsck,
+                                 parent=ndb.Key(Profile,
+                                                self._getUserId())).get_async()
+            prof = self._getProfileFromUser()
+
+        conf = conf_future.get_result()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        organizer = organizer_future.get_result()
+        sessions = sorted(sessions_future.get_result(),
+                          key=lambda sess: (sess.startDateTime or datetime.min,
+                                            sess.name))
+        detail = ConferenceDetailForm(
+            conference=self._copyConferenceToForm(
+                conf, getattr(organizer, 'displayName')),
+            sessions=[self._copySessionToForm(sess) for sess in sessions],
+            featuredSpeakers=caches.getFeaturedSpeakers(
+                c_key, featured_future.get_result()) or
+            "No featured speakers.",
+            isAttending=False)
+        if prof:
+            detail.isAttending = bool(
+                reg_future.get_result() or wsck in prof.conferenceKeysToAttend)
+            wishlist = set(prof.sessionsKeysOnWishlist)
+            detail.sessionsKeysOnWishlist = [sess.key.urlsafe() for sess in
+                                             sessions
+                                             if sess.key.urlsafe() in wishlist]
+        return self._conditionalMessage(request, detail)
+
+    @endpoints.method(CONF_CREATED_REQUEST, ConferenceForms,
                       path='conference/byUser', http_method='POST',
                       name='getConferencesCreated')
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # make profile key
-        p_key = ndb.Key(Profile, getUserId(user))
-        # create ancestor query for this user
-        conferences = Conference.query(ancestor=p_key)
-        # get the user profile and display name
-        prof = p_key.get()
+        # get the user profile (making sure user is authed) and display name
+        prof = self._getProfileFromUser()
         displayName = getattr(prof, 'displayName')
+        # create ancestor query for this user
+        conferences = Conference.query(ancestor=prof.key)
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
+        return self._conditionalMessage(request, ConferenceForms(
             items=[self._copyConferenceToForm(conf, displayName) for conf in
                    conferences]
-        )
+        ))
 
     def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
+        """Return a page of the conferences matching the submitted filters,
+        sorted on the inequality filter, if any, and name, and the token of
+        the next page. All conferences are returned unless a pageSize or
+        pageToken is given."""
         inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
+        pageSize = None
+        if request.pageSize or request.pageToken:
+            pageSize = self._getPageSize(request)
+        try:
+            return getRepository().queryConferences(
+                filters, pageSize, request.pageToken)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
 
     def _formatFilters(self, filters):
         """Parse, check validity and format user supplied filters."""
@@ -730,8 +1219,22 @@ class ConferenceApi(remote.Service):
                 raise endpoints.BadRequestException("Filter contains invalid \
                     field or operator.")
 
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
+            # an IN filter, or an EQ filter with several values, matches any
+            # of its values
+            values = filtr.pop("values")
+            if filtr["operator"] == "IN" or values:
+                if filtr["operator"] not in ("=", "IN"):
+                    raise endpoints.BadRequestException("Filter with \
+                        'values' requires the EQ or IN operator.")
+                filtr["operator"] = "IN"
+                filtr["value"] = values + (
+                    [filtr["value"]] if filtr["value"] is not None else [])
+                if not filtr["value"]:
+                    raise endpoints.BadRequestException("IN filter \
+                        requires 'values'.")
+
+            # Every operation except "=" and "IN" is an inequality
+            if filtr["operator"] not in ("=", "IN"):
                 # check if inequality operation has been used in previous
                 # filters
                 # disallow the filter if inequality was performed on a
@@ -744,31 +1247,57 @@ class ConferenceApi(remote.Service):
                 else:
                     inequality_field = filtr["field"]
 
+            if filtr["field"] in INTEGER_FIELDS:
+                try:
+                    if filtr["operator"] == "IN":
+                        filtr["value"] = [int(v) for v in filtr["value"]]
+                    else:
+                        filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on '%s' requires a number." % filtr["field"])
             formatted_filters.append(filtr)
         return (inequality_field, formatted_filters)
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences', http_method='POST',
                       name='queryConferences')
+    @rateLimited
     def queryConferences(self, request):
         """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in
-                      conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return individual ConferenceForm object per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf,
-                               names[conf.organizerUserId]) for conf in
-                               conferences])
+        conferences, nextPageToken = self._getQuery(request)
+
+        # need to fetch organiser displayName from profiles, all at once
+        names = getRepository().organizerNames(
+            [conf.organizerUserId for conf in conferences])
+
+        # return individual ConferenceForm object per Conference, with the
+        # number of conferences per city, topic and month
+        return self._conditionalMessage(request, ConferenceForms(
+            items=[self._copyConferenceToForm(conf,
+                                              names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextPageToken=nextPageToken, facets=self._getFacetForms()))
+
+    def _getFacetForms(self):
+        """Return the facet counts, the most frequent values of a field
+        first."""
+        counts = facets.getFacetCounts()
+        return [FacetForm(field=field, value=value, count=count)
+                for field, _ in facets.FACETS
+                for value, count in sorted(
+                    counts.get(field, {}).items(),
+                    key=lambda item: (-item[1], item[0]))]
+
+    @endpoints.method(AUTOCOMPLETE_GET_REQUEST, SuggestionsForm,
+                      path='autocomplete',
+                      http_method='GET', name='getSuggestions')
+    def getSuggestions(self, request):
+        """Return city, topic or speaker names starting with a prefix."""
+        if not request.field:
+            raise endpoints.BadRequestException("'field' required")
+        return SuggestionsForm(items=autocomplete.getSuggestions(
+            request.field.name, request.prefix or ''))
 
     @endpoints.method(CONF_IN_CITY_REQUEST, ConferenceForms,
                       path='conference/byCity/{city}',
@@ -789,7 +1318,7 @@ class ConferenceApi(remote.Service):
                    confsInCity]
         )
 
-    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+    @endpoints.method(CONF_CONDITIONAL_GET_REQUEST, StringMessage,
                       path='conference/featured',
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
@@ -800,9 +1329,64 @@ class ConferenceApi(remote.Service):
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
-        MEMCACHE_CONFERENCE_KEY = "FEATURED:%s" % wsck
-        return StringMessage(data=memcache.get(
-            MEMCACHE_CONFERENCE_KEY) or "No featured speakers.")
+        return self._conditionalString(
+            request, caches.getFeaturedSpeakers(conf.key) or
+            "No featured speakers.")
+
+# - - - Exports - - - - - - - - - - - - - - - - - - - - - - -
+
+    def _copyExportJobToForm(self, job):
+        """Copy relevant fields from ExportJob to ExportJobForm."""
+        ef = ExportJobForm(
+            websafeKey=job.key.urlsafe(),
+            data=getattr(ExportData, job.data),
+            format=getattr(ExportFormat, job.format),
+            status=job.status,
+            rows=job.rows,
+        )
+        # the download handle, only available once the export is complete
+        if job.status == 'DONE':
+            ef.downloadUrl = '/exports/%s?token=%s' % (
+                job.key.urlsafe(), job.downloadToken)
+        ef.check_initialized()
+        return ef
+
+    @endpoints.method(EXPORT_POST_REQUEST, ExportJobForm,
+                      path='conference/{websafeConferenceKey}/export',
+                      http_method='POST', name='exportConference')
+    def exportConference(self, request):
+        """Start exporting conference data; for its organizer only."""
+        user_id = self._getUserId()
+        # get conference; check that it exists
+        wsck = request.websafeConferenceKey
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        # check that user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can export the conference.')
+        from exports import startExport
+        job = startExport(conf.key, str(request.data), str(request.format))
+        return self._copyExportJobToForm(job)
+
+    @endpoints.method(EXPORT_GET_REQUEST, ExportJobForm,
+                      path='export/{websafeExportKey}',
+                      http_method='GET', name='getExportJob')
+    def getExportJob(self, request):
+        """Return the progress & download handle of an export."""
+        user_id = self._getUserId()
+        job = ndb.Key(urlsafe=request.websafeExportKey).get()
+        if not job:
+            raise endpoints.NotFoundException(
+                'No export found with key: %s' % request.websafeExportKey)
+        # jobs are children of the conference, which is a child of its
+        # organizer's profile
+        if user_id != job.key.parent().parent().id():
+            raise endpoints.ForbiddenException(
+                'Only the owner can get exports of the conference.')
+        return self._copyExportJobToForm(job)
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
@@ -816,22 +1400,49 @@ class ConferenceApi(remote.Service):
                 if field.name == 'teeShirtSize':
                     setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof,
                             field.name)))
+                # add the registrations to the not yet migrated ones
+                elif field.name == 'conferenceKeysToAttend':
+                    setattr(pf, field.name, prof.conferenceKeysToAttend + [
+                        r_key.id() for r_key in Registration.query(
+                            ancestor=prof.key).iter(keys_only=True)])
                 else:
                     setattr(pf, field.name, getattr(prof, field.name))
         pf.check_initialized()
         return pf
 
+    def _getUserId(self):
+        """Return the id of the current user, raising an UnauthorizedException
+        if no user is logged in. The id is memoized for the request.
+        """
+        if self._userId is None:
+            # make sure user is authed
+            user = endpoints.get_current_user()
+            if not user:
+                raise endpoints.UnauthorizedException('Authorization required')
+            self._user = user
+            self._userId = getUserId(user)
+        return self._userId
+
     def _getProfileFromUser(self):
-        """Return user Profile from datastore, creating new one if
-        non-existent.
+        """Return user Profile, creating new one if non-existent.
+
+        The profile is memoized for the request and cached in memcache across
+        requests. Inside of transactions it is always read from the
+        datastore, so it can safely be modified and written back.
         """
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
+        user_id = self._getUserId()
+        inTransaction = ndb.in_transaction()
+
+        # get Profile from request memo or memcache
+        if not inTransaction:
+            if self._profile is not None:
+                return self._profile
+            profile = memcache.get(MEMCACHE_PROFILE_KEY % user_id)
+            if profile is not None:
+                self._profile = profile
+                return profile
 
         # get Profile from datastore
-        user_id = getUserId(user)
         p_key = ndb.Key(Profile, user_id)
         profile = p_key.get()
 
@@ -839,27 +1450,49 @@ class ConferenceApi(remote.Service):
         if not profile:
             profile = Profile(
                 key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
+                displayName=self._user.nickname(),
+                mainEmail=self._user.email(),
                 teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
             )
             profile.put()
 
+        self._cacheProfile(profile)
         return profile      # return Profile
 
-    def _doProfile(self, save_request=None):
-        """Get user Profile and return to user, possibly updating it first."""
-        # get user Profile
+    def _cacheProfile(self, prof):
+        """Write a Profile through to the request memo and memcache; used
+        whenever a profile has been read from or written to the datastore.
+        Within a transaction, this is deferred until it has been committed.
+        """
+        def cache():
+            self._profile = prof
+            memcache.set(MEMCACHE_PROFILE_KEY % prof.key.id(), prof)
+        ndb.get_context().call_on_commit(cache)
+
+    @ndb.transactional()
+    def _updateProfile(self, save_request):
+        """Update the user-modifyable fields of the user Profile. Runs in a
+        transaction, so the profile is read from the datastore rather than
+        the (possibly stale) profile cache.
+        """
         prof = self._getProfileFromUser()
+        for field in ('displayName', 'teeShirtSize'):
+            if hasattr(save_request, field):
+                val = getattr(save_request, field)
+                if val:
+                    setattr(prof, field, str(val))
+        prof.put()
+        self._cacheProfile(prof)
+        return prof
 
+    def _doProfile(self, save_request=None):
+        """Get user Profile and return to user, possibly updating it first."""
         # if saveProfile(), process user-modifyable fields
         if save_request:
-            for field in ('displayName', 'teeShirtSize'):
-                if hasattr(save_request, field):
-                    val = getattr(save_request, field)
-                    if val:
-                        setattr(prof, field, str(val))
-            prof.put()
+            prof = self._updateProfile(save_request)
+        # else just get user Profile
+        else:
+            prof = self._getProfileFromUser()
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -879,43 +1512,32 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
-    @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
-        """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = '%s %s' % (
-                'Last chance to attend! The following conferences '
-                'are nearly sold out:',
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
-        return announcement
-
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @endpoints.method(ANNOUNCEMENT_GET_REQUEST, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(
-            MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from memcache; recomputed by a single
+        request if it got evicted."""
+        return self._conditionalString(request, caches.getAnnouncement())
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
+    def _updateAgendaConferences(self, p_key, add=None, remove=None):
+        """Add or remove a registered conference of the user's Agenda, in
+        the transaction of the registration; a missing Agenda is built by
+        getAgenda."""
+        agd = self._agendaKey(p_key).get()
+        if not agd or agd.conferences is None:
+            return
+        wscks = set(agd.conferences)
+        if add:
+            wscks.add(add)
+        if remove:
+            wscks.discard(remove)
+        agd.conferences = sorted(wscks)
+        agd.put()
+
     @ndb.transactional(xg=True)
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
@@ -930,10 +1552,20 @@ class ConferenceApi(remote.Service):
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        # remember if the conference is listed in the announcement
+        wasNearlySoldOut = caches.isNearlySoldOut(conf)
+
+        # get the registration, a child of the user Profile keyed by the
+        # websafe conference key. Registrations which have not been migrated
+        # yet are still found in the profile's conferenceKeysToAttend list.
+        r_key = ndb.Key(Registration, wsck, parent=prof.key)
+        isLegacy = wsck in prof.conferenceKeysToAttend
+        isRegistered = isLegacy or r_key.get() is not None
+
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if isRegistered:
                 raise ConflictException(
                     "You have already registered for this conference")
 
@@ -943,40 +1575,90 @@ class ConferenceApi(remote.Service):
                     "There are no seats available.")
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
+            Registration(key=r_key, conference=conf.key).put()
+            self._updateAgendaConferences(prof.key, add=wsck)
             conf.seatsAvailable -= 1
             retval = True
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if isRegistered:
 
                 # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
+                if isLegacy:
+                    prof.conferenceKeysToAttend.remove(wsck)
+                    prof.put()
+                    self._cacheProfile(prof)
+                else:
+                    r_key.delete()
+                self._updateAgendaConferences(prof.key, remove=wsck)
                 conf.seatsAvailable += 1
                 retval = True
             else:
                 retval = False
 
-        # write things back to the datastore & return
-        prof.put()
+        # write things back to the datastore
         conf.put()
+
+        # update the announcement if the conference crossed the nearly sold
+        # out threshold. The task is only enqueued if the transaction commits.
+        if caches.isNearlySoldOut(conf) != wasNearlySoldOut:
+            taskqueue.add(params={'websafeConferenceKey': wsck},
+                          url='/tasks/update_announcement',
+                          transactional=True)
         return BooleanMessage(data=retval)
 
-    @endpoints.method(message_types.VoidMessage, ConferenceForms,
+    def _getPageSize(self, request):
+        """Return the requested pageSize, limited to MAX_PAGE_SIZE."""
+        pageSize = min(request.pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if pageSize <= 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive")
+        return pageSize
+
+    def _getPage(self, query, request):
+        """Fetch a page of keys of a keys-only query.
+
+        args:
+            query: the query to fetch a page from.
+            request: request object containing the optional pageToken and
+                pageSize fields.
+        returns:
+            keys: the keys of the page.
+            nextPageToken: token to request the next page with or None if
+                this is the last page.
+        """
+        pageSize = self._getPageSize(request)
+        cursor = None
+        if request.pageToken:
+            try:
+                cursor = Cursor(urlsafe=request.pageToken)
+            except Exception:
+                raise endpoints.BadRequestException("Invalid 'pageToken'")
+        keys, next_cursor, more = query.fetch_page(
+            pageSize, start_cursor=cursor, keys_only=True)
+        nextPageToken = next_cursor.urlsafe() if more and next_cursor else None
+        return keys, nextPageToken
+
+    @endpoints.method(CONF_ATTENDING_GET_REQUEST, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser()  # get user profile
-        # get conferenceKeysToAttend from profile.
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in
-                     prof.conferenceKeysToAttend]
+        # get a page of the user's registrations with a keys-only ancestor
+        # query; the key names are the websafe conference keys.
+        r_keys, nextPageToken = self._getPage(
+            Registration.query(ancestor=prof.key), request)
+        wscks = [r_key.id() for r_key in r_keys]
+        # registrations which have not been migrated yet go on the first page
+        if not request.pageToken:
+            wscks = prof.conferenceKeysToAttend + wscks
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in wscks]
         # fetch conferences from datastore.
         # Use of get_multi(array_of_keys) to fetch all keys at once instead of
         # fetching them one by one.
-        conferences = ndb.get_multi(conf_keys)
+        conferences = [conf for conf in ndb.get_multi(conf_keys) if conf]
 
         # get organizers
         organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in
@@ -989,9 +1671,39 @@ class ConferenceApi(remote.Service):
             names[profile.key.id()] = profile.displayName
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf,
-                               names[conf.organizerUserId]) for conf in
-                               conferences])
+        return self._conditionalMessage(request, ConferenceForms(
+            items=[self._copyConferenceToForm(
+                conf, names[conf.organizerUserId]) for conf in conferences],
+            nextPageToken=nextPageToken))
+
+    @endpoints.method(CONF_ATTENDEES_GET_REQUEST, AttendeeForms,
+                      path='conference/{websafeConferenceKey}/attendees',
+                      http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Get the attendees of a conference; for its organizer only."""
+        user_id = self._getUserId()
+        # get conference; check that it exists
+        wsck = request.websafeConferenceKey
+        conf = ndb.Key(urlsafe=wsck).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % wsck)
+        # check that user is owner
+        if user_id != conf.organizerUserId:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+
+        # get a page of the attendees in the order they registered
+        try:
+            profiles, nextPageToken = getRepository().attendees(
+                conf.key, self._getPageSize(request), request.pageToken)
+        except ValueError:
+            raise endpoints.BadRequestException("Invalid 'pageToken'")
+        return AttendeeForms(
+            items=[AttendeeForm(displayName=prof.displayName,
+                                mainEmail=prof.mainEmail)
+                   for prof in profiles],
+            nextPageToken=nextPageToken)
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
@@ -1037,3 +1749,6 @@ class ConferenceApi(remote.Service):
 
 # registers API
 api = endpoints.api_server([ConferenceApi])
+
+logging.info('conference imported in %.0f ms',
+             (time.time() - _importStarted) * 1000)
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+"""deletions.py
+
+Udacity conference server-side Python App Engine conference deletion
+
+deleteConference deletes the Conference entity right away and leaves the
+rest to a chain of /tasks/delete_conference tasks, one batch of at most
+DELETION_BATCH_SIZE entities per task. The phases of the cascade delete are
+run in order:
+
+    sessions        deletes the sessions on no wishlist a page at a time;
+                    a session on wishlists first has its wishlist & agenda
+                    references removed from the profiles, a batch of
+                    profiles per task, then is deleted
+    registrations   deletes the Registrations of the conference
+    attendees       removes the conference from the legacy
+                    conferenceKeysToAttend lists of the profiles
+    popularity      deletes the popularity shards of the sessions
+    descendants     deletes everything else below the conference, e.g. exports
+    cleanup         drops the memcache entries derived from the conference
+                    and recounts the sessions of its speakers
+
+After every batch the ConferenceDeletion checkpoints the progress, so a chain
+that stopped can be resumed. Batches are idempotent, as a batch is run again
+if its task is retried.
+
+$Id$
+"""
+
+# built-in modules
+import logging
+from datetime import datetime
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+# own modules
+import caches
+import facets
+from caches import MEMCACHE_FEATURED_KEY
+from caches import MEMCACHE_PROFILE_KEY
+from migrations import updateInGroups
+from models import Agenda
+from models import ConferenceDeletion
+from models import Profile
+from models import Registration
+from models import Session
+from models import SessionPopularityShard
+from popularity import MEMCACHE_LEADERBOARD_KEY
+from popularity import MEMCACHE_POPULARITY_KEY
+from readthrough import MEMCACHE_STALE_KEY
+
+# number of entities per batch & task
+DELETION_BATCH_SIZE = 50
+# maximum number of tasks added at once
+MAX_TASKS_PER_ADD = 100
+
+
+def _queueBatch(state, transactional=False):
+    taskqueue.add(params={'websafeConferenceKey': state.key.id(),
+                          'batch': state.batches},
+                  url='/tasks/delete_conference', transactional=transactional)
+
+
+def startDeletion(conf):
+    """Delete a conference & queue the deletion of its data; must be called
+    within a cross-group transaction."""
+    state = ConferenceDeletion(id=conf.key.urlsafe(), status='RUNNING',
+                               started=datetime.utcnow())
+    state.put()
+    conf.key.delete()
+    _queueBatch(state, transactional=True)
+    # the conference stops counting in the facets right away
+    facets.queueCount([conf.key], transactional=True)
+    return state
+
+
+def resumeDeletion(wsck):
+    """Queue the next batch of a deletion which stopped; returns its
+    ConferenceDeletion or None."""
+    state = ndb.Key(ConferenceDeletion, wsck).get()
+    if state and state.status != 'DONE':
+        # a duplicate task of a running chain is dropped by its batch number
+        _queueBatch(state)
+    return state
+
+
+def _forgetProfiles(profiles):
+    """Drop the cached profiles once the transaction commits."""
+    keys = [MEMCACHE_PROFILE_KEY % prof.key.id() for prof in profiles]
+    ndb.get_context().call_on_commit(lambda: memcache.delete_multi(keys))
+
+
+def _progress(next_cursor, more, **changes):
+    """Return the changes of a batch of a phase walked with a cursor."""
+    if more and next_cursor:
+        changes['cursor'] = next_cursor.urlsafe()
+    else:
+        changes['done'] = True
+    return changes
+
+
+def _fetchKeys(query, state):
+    cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+    return query.fetch_page(DELETION_BATCH_SIZE, start_cursor=cursor,
+                            keys_only=True)
+
+
+@ndb.transactional
+def _addSpeakers(wsck, speakers):
+    """Remember the speakers of sessions about to be deleted, so they are
+    recounted even if the task fails before its checkpoint."""
+    state = ndb.Key(ConferenceDeletion, wsck).get()
+    state.speakers = sorted(set(state.speakers) | set(speakers))
+    state.put()
+
+
+def _deleteUnreferencedSessions(state, s_keys):
+    """Delete the sessions on no wishlist at once; returns the keys of the
+    others, which need their references removed first."""
+    # an Agenda only holds the sessions of its profile's wishlist
+    probes = [Profile.query(
+        Profile.sessionsKeysOnWishlist == s_key.urlsafe()).get_async(
+        keys_only=True) for s_key in s_keys]
+    referenced = [s_key for s_key, probe in zip(s_keys, probes)
+                  if probe.get_result()]
+    unreferenced = [s_key for s_key in s_keys if s_key not in referenced]
+    if unreferenced:
+        sessions = ndb.get_multi(unreferenced)
+        _addSpeakers(state.key.id(), [spk_key for sess in sessions if sess
+                                      for spk_key in sess.speakers])
+        ndb.Future.wait_all(ndb.delete_multi_async(unreferenced))
+        memcache.delete_multi([MEMCACHE_POPULARITY_KEY % s_key.urlsafe()
+                               for s_key in unreferenced])
+    return referenced, len(unreferenced)
+
+
+def _deleteSessions(state, c_key):
+    """Delete a page of sessions on no wishlist, or remove the references
+    to a session on wishlists from a batch of profiles and their agendas;
+    such a session is deleted along with the checkpoint after the last
+    batch of its profiles, in a transaction."""
+    deleted = 0
+    if not state.sessionKey:
+        # deleted sessions are gone from the (strongly consistent) ancestor
+        # query, so the first page holds the next ones
+        s_keys = Session.query(ancestor=c_key).fetch(DELETION_BATCH_SIZE,
+                                                     keys_only=True)
+        if not s_keys:
+            return {'done': True}
+        referenced, deleted = _deleteUnreferencedSessions(state, s_keys)
+        if not referenced:
+            return {'deleted': deleted}
+        state.sessionKey, state.cursor = referenced[0], None
+    s_key = state.sessionKey
+    wssk = s_key.urlsafe()
+
+    def removeSession(entities):
+        changed = []
+        for entity in entities:
+            if isinstance(entity, Agenda):
+                items = [item for item in entity.items if item[2] != wssk]
+                if items != entity.items:
+                    entity.items = items
+                    changed.append(entity)
+            elif wssk in entity.sessionsKeysOnWishlist:
+                entity.sessionsKeysOnWishlist = [
+                    key for key in entity.sessionsKeysOnWishlist
+                    if key != wssk]
+                changed.append(entity)
+        _forgetProfiles([entity for entity in changed
+                         if isinstance(entity, Profile)])
+        return changed
+
+    p_keys, next_cursor, more = _fetchKeys(
+        Profile.query(Profile.sessionsKeysOnWishlist == wssk), state)
+    updateInGroups(p_keys + [ndb.Key(Agenda, 'agenda', parent=p_key)
+                             for p_key in p_keys], removeSession)
+    if more and next_cursor:
+        return {'sessionKey': s_key, 'cursor': next_cursor.urlsafe(),
+                'updated': len(p_keys), 'deleted': deleted}
+    sess = s_key.get()
+    memcache.delete(MEMCACHE_POPULARITY_KEY % wssk)
+    return {'sessionKey': None, 'updated': len(p_keys), 'delete': [s_key],
+            'deleted': deleted, 'speakers': sess.speakers if sess else []}
+
+
+def _deleteRegistrations(state, c_key):
+    keys, next_cursor, more = _fetchKeys(
+        Registration.query(Registration.conference == c_key), state)
+    ndb.delete_multi(keys)
+    return _progress(next_cursor, more, deleted=len(keys))
+
+
+def _removeAttendees(state, c_key):
+    wsck = c_key.urlsafe()
+
+    def removeConference(profiles):
+        changed = [prof for prof in profiles
+                   if wsck in prof.conferenceKeysToAttend]
+        for prof in changed:
+            prof.conferenceKeysToAttend = [
+                key for key in prof.conferenceKeysToAttend if key != wsck]
+        _forgetProfiles(changed)
+        return changed
+
+    keys, next_cursor, more = _fetchKeys(
+        Profile.query(Profile.conferenceKeysToAttend == wsck), state)
+    updateInGroups(keys, removeConference)
+    return _progress(next_cursor, more, updated=len(keys))
+
+
+def _deletePopularity(state, c_key):
+    keys, next_cursor, more = _fetchKeys(
+        SessionPopularityShard.query(
+            SessionPopularityShard.conference == c_key), state)
+    ndb.delete_multi(keys)
+    return _progress(next_cursor, more, deleted=len(keys))
+
+
+def _deleteDescendants(state, c_key):
+    keys, next_cursor, more = _fetchKeys(ndb.Query(ancestor=c_key), state)
+    ndb.delete_multi(keys)
+    return _progress(next_cursor, more, deleted=len(keys))
+
+
+def _cleanup(state, c_key):
+    """Drop the cached data of the conference & recount the sessions of
+    its speakers."""
+    wsck = c_key.urlsafe()
+    featuredKey = MEMCACHE_FEATURED_KEY % wsck
+    memcache.delete_multi([featuredKey, MEMCACHE_STALE_KEY % featuredKey,
+                           MEMCACHE_LEADERBOARD_KEY % wsck])
+    # the conference is gone, so this removes it from the announcement
+    caches.updateNearlySoldOut(c_key)
+    tasks = [taskqueue.Task(params={'websafeSpeakerKey': spk_key.urlsafe()},
+                            url='/tasks/count_speaker_sessions')
+             for spk_key in state.speakers]
+    for i in range(0, len(tasks), MAX_TASKS_PER_ADD):
+        taskqueue.Queue().add(tasks[i:i + MAX_TASKS_PER_ADD])
+    return {'done': True}
+
+
+PHASES = [
+    ('sessions', _deleteSessions),
+    ('registrations', _deleteRegistrations),
+    ('attendees', _removeAttendees),
+    ('popularity', _deletePopularity),
+    ('descendants', _deleteDescendants),
+    ('cleanup', _cleanup),
+]
+
+
+@ndb.transactional(xg=True)
+def _checkpoint(wsck, batch, changes):
+    """Move a deletion past a batch; returns the ConferenceDeletion or None
+    if the batch has been checkpointed already by a duplicate task."""
+    state = ndb.Key(ConferenceDeletion, wsck).get()
+    if state.batches != batch:
+        return None
+    # deleted together with the checkpoint, so a retry of the batch finds
+    # the entity again
+    ndb.delete_multi(changes.get('delete', []))
+    state.batches += 1
+    state.deleted += (changes.get('deleted', 0) +
+                      len(changes.get('delete', [])))
+    state.updated += changes.get('updated', 0)
+    state.speakers = sorted(set(state.speakers) |
+                            set(changes.get('speakers', [])))
+    state.sessionKey = changes.get('sessionKey')
+    state.cursor = changes.get('cursor')
+    if changes.get('done'):
+        state.phase += 1
+    if state.phase < len(PHASES):
+        _queueBatch(state, transactional=True)
+    else:
+        state.status = 'DONE'
+        state.finished = datetime.utcnow()
+    state.put()
+    return state
+
+
+def runDeletionBatch(wsck, batch):
+    """Run the next batch of a deletion, continuing in a new task."""
+    state = ndb.Key(ConferenceDeletion, wsck).get()
+    if not state or state.status == 'DONE' or state.batches != batch:
+        return
+    changes = PHASES[state.phase][1](state, ndb.Key(urlsafe=wsck))
+    state = _checkpoint(wsck, batch, changes)
+    if state and state.status == 'DONE':
+        logging.info('Deletion of conference %s finished: %s entities '
+                     'deleted, %s profiles updated', wsck, state.deleted,
+                     state.updated)
+
+
+def getDeletionStatus(wsck):
+    """Return the progress of a deletion as dict or None."""
+    state = ndb.Key(ConferenceDeletion, wsck).get()
+    if not state:
+        return None
+    return {
+        'status': state.status,
+        'phase': PHASES[state.phase][0] if state.phase < len(PHASES)
+        else None,
+        'batches': state.batches,
+        'deleted': state.deleted,
+        'updated': state.updated,
+        'seconds': round(((state.finished or datetime.utcnow()) -
+                          state.started).total_seconds(), 1),
+    }
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+
+"""exports.py
+
+Udacity conference server-side Python App Engine data export
+
+Exports the sessions, speakers or attendees of a conference as CSV or NDJSON
+file. The data is walked with query cursors, one chunk per task, and every
+chunk is appended to the file store right away, so memory use is bounded by
+the chunk size regardless of the size of the conference.
+
+$Id$
+"""
+
+# built-in modules
+import csv
+import json
+import logging
+import uuid
+from cStringIO import StringIO
+# third-party modules
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+# own modules
+from filestore import getFileStore
+from models import ExportJob
+from models import Registration
+from models import Session
+
+# number of entities read & written per task
+EXPORT_CHUNK_SIZE = 200
+
+# columns of the exported rows
+COLUMNS = {
+    'SESSIONS': ['websafeKey', 'name', 'date', 'startTime', 'duration',
+                 'typeOfSession', 'location', 'highlights', 'speakers'],
+    'SPEAKERS': ['speaker', 'sessionName', 'websafeSessionKey'],
+    'ATTENDEES': ['displayName', 'mainEmail', 'teeShirtSize', 'registered'],
+}
+
+CONTENT_TYPES = {
+    'CSV': 'text/csv',
+    'NDJSON': 'application/x-ndjson',
+}
+
+
+def _speakerNames(sessions):
+    """Return a dict of the names of all speakers of the given sessions."""
+    spk_keys = set(spk_key for sess in sessions for spk_key in sess.speakers)
+    return dict((spk.key, spk.name) for spk in ndb.get_multi(list(spk_keys))
+                if spk)
+
+
+def _sessionRows(c_key, cursor):
+    """Return a chunk of session rows of a conference."""
+    sessions, next_cursor, more = Session.query(ancestor=c_key).fetch_page(
+        EXPORT_CHUNK_SIZE, start_cursor=cursor)
+    names = _speakerNames(sessions)
+    rows = [{
+        'websafeKey': sess.key.urlsafe(),
+        'name': sess.name,
+        'date': sess.date and str(sess.date),
+        'startTime': sess.startTime and str(sess.startTime),
+        'duration': sess.duration and str(sess.duration),
+        'typeOfSession': sess.typeOfSession,
+        'location': sess.location,
+        'highlights': sess.highlights,
+        'speakers': [names.get(spk_key) for spk_key in sess.speakers],
+    } for sess in sessions]
+    return rows, next_cursor, more
+
+
+def _speakerRows(c_key, cursor):
+    """Return a chunk of speaker rows, one per speaker and session, of a
+    conference."""
+    sessions, next_cursor, more = Session.query(ancestor=c_key).fetch_page(
+        EXPORT_CHUNK_SIZE, start_cursor=cursor)
+    names = _speakerNames(sessions)
+    rows = [{
+        'speaker': names.get(spk_key),
+        'sessionName': sess.name,
+        'websafeSessionKey': sess.key.urlsafe(),
+    } for sess in sessions for spk_key in sess.speakers]
+    return rows, next_cursor, more
+
+
+def _attendeeRows(c_key, cursor):
+    """Return a chunk of attendee rows of a conference."""
+    registrations, next_cursor, more = Registration.query(
+        Registration.conference == c_key).order(
+        Registration.created).fetch_page(EXPORT_CHUNK_SIZE,
+                                         start_cursor=cursor)
+    profiles = ndb.get_multi([reg.key.parent() for reg in registrations])
+    rows = [{
+        'displayName': prof.displayName,
+        'mainEmail': prof.mainEmail,
+        'teeShirtSize': prof.teeShirtSize,
+        'registered': reg.created.isoformat(),
+    } for reg, prof in zip(registrations, profiles) if prof]
+    return rows, next_cursor, more
+
+ROW_READERS = {
+    'SESSIONS': _sessionRows,
+    'SPEAKERS': _speakerRows,
+    'ATTENDEES': _attendeeRows,
+}
+
+
+def _csvValue(value):
+    """Format a value as (utf-8 encoded) CSV field."""
+    if value is None:
+        return ''
+    if isinstance(value, list):
+        value = '; '.join(v for v in value if v)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+
+def _formatRows(rows, columns, fmt, header):
+    """Format a chunk of rows as CSV or NDJSON.
+
+    args:
+        rows: list of dicts holding the row values by column.
+        columns: the column names in export order.
+        fmt: 'CSV' or 'NDJSON'.
+        header: True if a CSV header row is to be written first.
+    returns:
+        data: the formatted chunk as byte string.
+    """
+    out = StringIO()
+    if fmt == 'CSV':
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(columns)
+        for row in rows:
+            writer.writerow([_csvValue(row[column]) for column in columns])
+    else:
+        for row in rows:
+            out.write(json.dumps(row, sort_keys=True))
+            out.write('\n')
+    return out.getvalue()
+
+
+def startExport(c_key, data, fmt):
+    """Create an ExportJob for a conference and queue its first chunk.
+
+    args:
+        c_key: key of the conference to export.
+        data: 'SESSIONS', 'SPEAKERS' or 'ATTENDEES'.
+        fmt: 'CSV' or 'NDJSON'.
+    returns:
+        job: the created ExportJob.
+    """
+    job_id = ExportJob.allocate_ids(size=1, parent=c_key)[0]
+    job = ExportJob(key=ndb.Key(ExportJob, job_id, parent=c_key),
+                    data=data, format=fmt,
+                    downloadToken=uuid.uuid4().hex)
+    job.fileName = 'exports/%s.%s' % (job.key.urlsafe(), fmt.lower())
+    job.put()
+    taskqueue.add(params={'websafeExportKey': job.key.urlsafe()},
+                  url='/tasks/export_conference')
+    return job
+
+
+def runExportChunk(job_key):
+    """Export the next chunk of an ExportJob and queue the chunk after it.
+
+    The job is the checkpoint: a chunk is only committed once the job has
+    been written with the new cursor, row and byte counts. A retried chunk
+    first cuts off whatever an earlier attempt appended to the file.
+    """
+    job = job_key.get()
+    if not job or job.status in ('DONE', 'FAILED'):
+        return
+    store = getFileStore()
+    # drop a partly written chunk of an earlier, failed attempt
+    store.truncate(job.fileName, job.bytesWritten)
+
+    cursor = ndb.Cursor(urlsafe=job.cursor) if job.cursor else None
+    try:
+        rows, next_cursor, more = ROW_READERS[job.data](job_key.parent(),
+                                                        cursor)
+        chunk = _formatRows(rows, COLUMNS[job.data], job.format,
+                            header=job.bytesWritten == 0)
+        store.append(job.fileName, chunk)
+    except (IOError, OSError):
+        logging.exception('Export %s failed', job_key.urlsafe())
+        job.status = 'FAILED'
+        job.put()
+        return
+
+    job.bytesWritten += len(chunk)
+    job.rows += len(rows)
+    job.cursor = next_cursor.urlsafe() if more and next_cursor else None
+    job.status = 'RUNNING' if job.cursor else 'DONE'
+    job.put()
+    if job.cursor:
+        taskqueue.add(params={'websafeExportKey': job_key.urlsafe()},
+                      url='/tasks/export_conference')
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+"""facets.py
+
+Udacity conference server-side Python App Engine facet counts
+
+The number of conferences per city, topic and start month, shown next to the
+conference filters before a query is run. The counts are kept incrementally
+in the FacetCounts entity by the /tasks/count_facets task, which is queued
+whenever conferences are created, updated, imported or deleted.
+
+A task doesn't carry a delta: it compares every conference with the facet
+values it was counted with last, stored in a CountedFacets child of the
+FacetCounts, and applies the difference in a single transaction. So a retried
+task or the tasks of concurrent updates count every conference exactly once.
+The tasks run on the facets queue one at a time, as they all write the same
+entity group.
+
+Reads never scan conferences; the counts are a single get, cached in
+memcache. A task sets the new counts in memcache once its transaction
+commits, so a read which got the old counts before the commit can't add them
+afterwards; the cached counts also expire after MEMCACHE_FACETS_SECONDS, in
+case the set failed.
+
+Existing conferences are counted by migration 5 (migrations.py).
+
+$Id$
+"""
+
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+# own modules
+from models import CountedFacets
+from models import FacetCounts
+from settings import FACETS_QUEUE
+
+# the counted fields by filter field name
+FACETS = (
+    ('CITY', 'city'),
+    ('TOPIC', 'topics'),
+    ('MONTH', 'month'),
+)
+FACET_COUNTS_ID = 'conference'
+MEMCACHE_FACETS_KEY = "FACETS"
+MEMCACHE_FACETS_SECONDS = 60
+# conferences per task; the task reads them outside of its transaction
+MAX_CONFERENCES_PER_TASK = 100
+
+
+def queueCount(c_keys, transactional=False):
+    """Queue the conferences to be (re)counted.
+
+    args:
+        c_keys: keys of created, updated or deleted conferences.
+        transactional: only add the task if the current transaction commits.
+    """
+    wscks = sorted(set(c_key.urlsafe() for c_key in c_keys))
+    for i in range(0, len(wscks), MAX_CONFERENCES_PER_TASK):
+        chunk = wscks[i:i + MAX_CONFERENCES_PER_TASK]
+        taskqueue.add(params={'websafeConferenceKey': chunk},
+                      url='/tasks/count_facets', queue_name=FACETS_QUEUE,
+                      transactional=transactional)
+
+
+def facetValues(conf):
+    """Return the counted values of a conference, or of a deleted one if
+    None, as dict of sorted lists of strings by facet."""
+    values = {}
+    if conf is None:
+        return values
+    for facet, field in FACETS:
+        value = getattr(conf, field)
+        value = value if isinstance(value, list) else [value]
+        # conferences without city or start date (month 0) aren't counted
+        value = sorted(set(unicode(v) for v in value if v))
+        if value:
+            values[facet] = value
+    return values
+
+
+def _add(counts, values, delta):
+    for facet, names in values.items():
+        facetCounts = counts.setdefault(facet, {})
+        for value in names:
+            facetCounts[value] = facetCounts.get(value, 0) + delta
+            if facetCounts[value] <= 0:
+                del facetCounts[value]
+
+
+@ndb.transactional
+def _applyCounts(c_keys, confs):
+    """Count the differences of the conferences to their counted values."""
+    counts_key = ndb.Key(FacetCounts, FACET_COUNTS_ID)
+    counted_keys = [ndb.Key(CountedFacets, c_key.urlsafe(), parent=counts_key)
+                    for c_key in c_keys]
+    entities = ndb.get_multi([counts_key] + counted_keys)
+    counts = entities[0] or FacetCounts(key=counts_key, counts={})
+    changed, deleted = [], []
+    for counted_key, counted, conf in zip(counted_keys, entities[1:], confs):
+        old = counted.values if counted else {}
+        new = facetValues(conf)
+        if old == new:
+            continue
+        _add(counts.counts, old, -1)
+        _add(counts.counts, new, 1)
+        if conf:
+            changed.append(CountedFacets(key=counted_key, values=new))
+        else:
+            deleted.append(counted_key)
+    if not changed and not deleted:
+        return
+    ndb.put_multi([counts] + changed)
+    ndb.delete_multi(deleted)
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(MEMCACHE_FACETS_KEY, counts.counts,
+                             time=MEMCACHE_FACETS_SECONDS))
+
+
+def countConferences(c_keys):
+    """Update the facet counts with the current state of conferences; can
+    be run any number of times."""
+    c_keys = list(set(c_keys))
+    # gets by key are strongly consistent; a conference updated meanwhile
+    # is counted again by the task of its update
+    _applyCounts(c_keys, ndb.get_multi(c_keys))
+
+
+def getFacetCounts():
+    """Return the number of conferences by value by facet."""
+    counts = memcache.get(MEMCACHE_FACETS_KEY)
+    if counts is None:
+        entity = ndb.Key(FacetCounts, FACET_COUNTS_ID).get()
+        counts = entity.counts if entity else {}
+        # doesn't replace the counts set by a task committed meanwhile
+        memcache.add(MEMCACHE_FACETS_KEY, counts,
+                     time=MEMCACHE_FACETS_SECONDS)
+    return counts
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+
+"""filestore.py
+
+Udacity conference server-side Python App Engine file store
+
+A minimal blob store on the local file system, used as stand-in for a cloud
+blob store to hold exported and imported conference data. Files are
+appended to chunk by chunk and read back in blocks or lines, so neither side
+has to hold a whole file in memory.
+
+$Id$
+"""
+
+# built-in modules
+import os
+# own modules
+from settings import FILESTORE_ROOT
+
+# size of the blocks files are streamed back in
+BLOCK_SIZE = 64 * 1024
+
+
+class LocalFileStore(object):
+    """LocalFileStore -- stores named files below a root directory"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, name):
+        """Return the path of a file, making sure it is inside the root."""
+        path = os.path.abspath(os.path.join(self.root, name))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError('Invalid file name: %s' % name)
+        return path
+
+    def append(self, name, data):
+        """Append data to a file, creating it if it doesn't exist yet."""
+        path = self._path(name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'ab') as f:
+            f.write(data)
+
+    def truncate(self, name, size):
+        """Cut a file down to size bytes, e.g. to drop a partly written
+        chunk before it is written again."""
+        path = self._path(name)
+        if os.path.exists(path):
+            with open(path, 'r+b') as f:
+                f.truncate(size)
+
+    def size(self, name):
+        """Return the size of a file in bytes, 0 if it doesn't exist."""
+        path = self._path(name)
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def stream(self, name):
+        """Yield the content of a file block by block."""
+        with open(self._path(name), 'rb') as f:
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                yield block
+
+    def readLines(self, name, start, end):
+        """Yield the lines starting between two byte offsets of a file, each
+        together with the offset right after it."""
+        with open(self._path(name), 'rb') as f:
+            f.seek(start)
+            offset = start
+            while offset < end:
+                line = f.readline()
+                if not line:
+                    break
+                offset += len(line)
+                yield offset, line
+
+    def delete(self, name):
+        """Delete a file if it exists."""
+        path = self._path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def getFileStore():
+    """Return the file store of the application."""
+    return LocalFileStore(FILESTORE_ROOT)
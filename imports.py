@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+
+"""imports.py
+
+Udacity conference server-side Python App Engine bulk import
+
+Imports conferences, their sessions and speakers from an NDJSON file. Every
+line holds either a new conference together with its sessions
+
+    {"conference": {"name": ..., "organizerUserId": ..., ...},
+     "sessions": [{"name": ..., "speakers": [...], ...}, ...]}
+
+or sessions to add to an existing conference
+
+    {"websafeConferenceKey": ..., "sessions": [...]}
+
+The file is split into shards of whole lines, each imported by its own chain
+of import_shard tasks. A shard is imported in batches: ids are allocated in
+ranges for the whole batch, speakers are looked up by name once per batch,
+missing ones created, and all other entities are written with a single
+put_multi. The shard's checkpoint is only moved forward after a batch has
+been written, so a failed import resumes with the first batch not written
+yet.
+
+A line which can't be imported, e.g. one with an invalid conference key or a
+value of the wrong type, is counted as an error and skipped as a whole, so it
+never fails the shard task; the other lines of its batch are imported.
+
+$Id$
+"""
+
+# built-in modules
+import json
+import logging
+import time
+from datetime import datetime
+# third-party modules
+from google.appengine.api import datastore_errors
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+# own modules
+import autocomplete
+import caches
+import facets
+from filestore import getFileStore
+from models import Conference
+from models import DEFAULTS
+from models import DEFAULTS_SESSION
+from models import ImportJob
+from models import ImportShard
+from models import Profile
+from models import Session
+from models import Speaker
+from models import TeeShirtSize
+from models import TypeOfSession
+
+# number of lines per shard & per batch of a shard
+IMPORT_SHARD_LINES = 1000
+IMPORT_BATCH_LINES = 100
+# a shard task continues in a new task after this many seconds
+IMPORT_TASK_SECONDS = 30
+# maximum number of tasks per taskqueue.add() call
+TASK_BATCH_SIZE = 100
+# errors of invalid values of a line, which is skipped
+ROW_ERRORS = (ValueError, TypeError, AttributeError,
+              datastore_errors.BadValueError, ProtocolBufferDecodeError)
+
+
+def _addTasks(tasks):
+    """Add tasks to the default queue in batches."""
+    for i in range(0, len(tasks), TASK_BATCH_SIZE):
+        taskqueue.Queue().add(tasks[i:i + TASK_BATCH_SIZE])
+
+
+def _shardTask(shard_key):
+    """Return the task importing (the rest of) a shard."""
+    return taskqueue.Task(params={'websafeShardKey': shard_key.urlsafe()},
+                          url='/tasks/import_shard')
+
+
+def startImport(body):
+    """Store an NDJSON file, split it into shards & queue their import.
+
+    args:
+        body: the content of the NDJSON file.
+    returns:
+        job: the created ImportJob.
+    """
+    job_key = ndb.Key(ImportJob, ImportJob.allocate_ids(size=1)[0])
+    fileName = 'imports/%s.ndjson' % job_key.id()
+    getFileStore().append(fileName, body)
+
+    # split the file into shards of IMPORT_SHARD_LINES lines
+    bounds = []
+    start = pos = lines = 0
+    while pos < len(body):
+        newline = body.find('\n', pos)
+        pos = len(body) if newline == -1 else newline + 1
+        lines += 1
+        if lines == IMPORT_SHARD_LINES:
+            bounds.append((start, pos))
+            start, lines = pos, 0
+    if start < len(body):
+        bounds.append((start, len(body)))
+
+    job = ImportJob(key=job_key, fileName=fileName, shards=len(bounds))
+    shards = [ImportShard(key=ndb.Key(ImportShard, i + 1, parent=job_key),
+                          start=start, end=end, checkpoint=start)
+              for i, (start, end) in enumerate(bounds)]
+    ndb.put_multi([job] + shards)
+    _addTasks([_shardTask(shard.key) for shard in shards])
+    return job
+
+
+def resumeImport(job_key):
+    """Queue the import of all shards of an ImportJob not finished yet."""
+    shards = ImportShard.query(ancestor=job_key).fetch()
+    _addTasks([_shardTask(shard.key) for shard in shards
+               if not shard.finished])
+
+
+def getImportStatus(job_key):
+    """Return the progress of an ImportJob as dict, including its rate in
+    rows per second."""
+    job = job_key.get()
+    shards = ImportShard.query(ancestor=job_key).fetch()
+    finished = [shard.finished for shard in shards if shard.finished]
+    done = len(finished) == len(shards)
+    rows = sum(shard.rows for shard in shards)
+    elapsed = ((max(finished) if done and finished else datetime.utcnow()) -
+               job.started).total_seconds()
+    return {
+        'shards': len(shards),
+        'shardsDone': len(finished),
+        'status': 'DONE' if done else 'RUNNING',
+        'rows': rows,
+        'errors': sum(shard.errors for shard in shards),
+        'seconds': round(elapsed, 1),
+        'rowsPerSecond': round(rows / elapsed, 1) if elapsed > 0 else None,
+    }
+
+
+def _isConferenceKey(wsck):
+    """Return whether a value is the websafe key of a conference."""
+    if not isinstance(wsck, basestring):
+        return False
+    try:
+        return ndb.Key(urlsafe=wsck).kind() == Conference._get_kind()
+    except ROW_ERRORS:
+        return False
+
+
+def _parseLine(line):
+    """Parse and validate a line of an import file; returns None if the
+    line is invalid."""
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    if not isinstance(row, dict):
+        return None
+    sessions = row.get('sessions') or []
+    if not isinstance(sessions, list) or not all(
+            isinstance(sess, dict) and sess.get('name') for sess in sessions):
+        return None
+    conf = row.get('conference')
+    if isinstance(conf, dict):
+        # the organizer id becomes part of the conference key
+        if not conf.get('name') or not conf.get('organizerUserId') or \
+                not isinstance(conf['organizerUserId'], basestring):
+            return None
+    elif not _isConferenceKey(row.get('websafeConferenceKey')) or \
+            not sessions:
+        return None
+    else:
+        row.pop('conference', None)
+    row['sessions'] = sessions
+    return row
+
+
+def _allocateIds(rows):
+    """Allocate the ids of all conferences and sessions of a batch.
+
+    returns:
+        ids: dict holding the first allocated conference id per organizer
+            and the first allocated session id per (websafe) conference key.
+    """
+    confsPerOrganizer = {}
+    for row in rows:
+        if 'conference' in row:
+            organizer = row['conference']['organizerUserId']
+            confsPerOrganizer[organizer] = \
+                confsPerOrganizer.get(organizer, 0) + 1
+    confIds = {}
+    for organizer, count in confsPerOrganizer.items():
+        confIds[organizer] = Conference.allocate_ids(
+            size=count, parent=ndb.Key(Profile, organizer))[0]
+
+    # the keys of the new conferences follow from the allocated ranges
+    sessionsPerConf = {}
+    nextConfIds = dict(confIds)
+    for row in rows:
+        if 'conference' in row:
+            organizer = row['conference']['organizerUserId']
+            c_key = ndb.Key(Profile, organizer,
+                            Conference, nextConfIds[organizer])
+            nextConfIds[organizer] += 1
+        else:
+            c_key = ndb.Key(urlsafe=row['websafeConferenceKey'])
+        if row['sessions']:
+            sessionsPerConf[c_key.urlsafe()] = \
+                sessionsPerConf.get(c_key.urlsafe(), 0) + len(row['sessions'])
+    sessionIds = {}
+    for wsck, count in sessionsPerConf.items():
+        sessionIds[wsck] = Session.allocate_ids(
+            size=count, parent=ndb.Key(urlsafe=wsck))[0]
+    return {'conferences': confIds, 'sessions': sessionIds}
+
+
+def _toDate(value):
+    """Convert a date string to a Date object."""
+    return value and datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def _toTime(value):
+    """Convert a time string to a Time object."""
+    return value and datetime.strptime(value[:5], "%H:%M").time()
+
+
+def _buildConference(c_key, data, hasSessions):
+    """Create a Conference entity from a conference of an import line."""
+    data = dict((field, data.get(field)) for field in (
+        'name', 'description', 'topics', 'city', 'startDate', 'endDate',
+        'maxAttendees', 'organizerUserId'))
+    # add default values for those missing
+    for df in DEFAULTS:
+        if data.get(df) in (None, []):
+            data[df] = DEFAULTS[df]
+    data['startDate'] = _toDate(data['startDate'])
+    data['endDate'] = _toDate(data['endDate'])
+    data['month'] = data['startDate'].month if data['startDate'] else 0
+    data['maxAttendees'] = int(data['maxAttendees'])
+    data['seatsAvailable'] = data['maxAttendees']
+    return Conference(key=c_key, sessionsVersion=1 if hasSessions else 0,
+                      **data)
+
+
+def _buildSession(s_key, data):
+    """Create a Session entity from a session of an import line."""
+    names = data.get('speakers') or []
+    if not isinstance(names, list) or not all(
+            isinstance(name, basestring) for name in names):
+        raise TypeError('speakers must be a list of names')
+    data = dict((field, data.get(field)) for field in (
+        'name', 'highlights', 'speakers', 'duration', 'typeOfSession',
+        'date', 'startTime', 'location'))
+    # add default values for those missing
+    for df in DEFAULTS_SESSION:
+        if data.get(df) in (None, []):
+            data[df] = DEFAULTS_SESSION[df]
+    # only accept known session types
+    data['typeOfSession'] = str(data['typeOfSession'])
+    if data['typeOfSession'] not in TypeOfSession.names():
+        data['typeOfSession'] = str(TypeOfSession.NOT_SPECIFIED)
+    data['date'] = _toDate(data['date'])
+    data['startTime'] = _toTime(data['startTime'])
+    data['duration'] = _toTime(data['duration'])
+    # the speakers are resolved by name for the whole batch
+    data['speakers'] = []
+    return Session(key=s_key, **data)
+
+
+def _importBatch(shard, lines, batchEnd):
+    """Import a batch of lines of a shard & move its checkpoint forward.
+
+    args:
+        shard: the ImportShard being imported.
+        lines: the lines of the batch.
+        batchEnd: the offset right after the last line of the batch.
+    """
+    rows = [_parseLine(line) for line in lines]
+    errors = rows.count(None)
+    rows = [row for row in rows if row]
+
+    # sessions can only be added to existing conferences
+    existing = [ndb.Key(urlsafe=row['websafeConferenceKey'])
+                for row in rows if 'conference' not in row]
+    found = set(conf.key for conf in ndb.get_multi(existing) if conf)
+    valid = [row for row in rows if 'conference' in row or
+             ndb.Key(urlsafe=row['websafeConferenceKey']) in found]
+    errors += len(rows) - len(valid)
+    rows = valid
+
+    # Allocate the ids of the batch once and keep them with the shard, so a
+    # retried batch writes the same entities again instead of duplicates.
+    if not shard.pending or shard.pending['offset'] != shard.checkpoint:
+        shard.pending = {'offset': shard.checkpoint,
+                         'ids': _allocateIds(rows)}
+        shard.put()
+    nextConfIds = dict(shard.pending['ids']['conferences'])
+    nextSessionIds = dict(shard.pending['ids']['sessions'])
+
+    # number of lines whose entities are all written
+    imported = 0
+    entities = []
+    newConfs = []
+    touchedConfs = set()
+    # names of the speakers of the imported sessions
+    sessionSpeakers = []
+    for row in rows:
+        # the ids are used up even if the line turns out to be invalid
+        conf = None
+        if 'conference' in row:
+            organizer = row['conference']['organizerUserId']
+            c_key = ndb.Key(Profile, organizer,
+                            Conference, nextConfIds[organizer])
+            nextConfIds[organizer] += 1
+        else:
+            c_key = ndb.Key(urlsafe=row['websafeConferenceKey'])
+        wsck = c_key.urlsafe()
+        s_keys = []
+        for data in row['sessions']:
+            s_keys.append(ndb.Key(Session, nextSessionIds[wsck],
+                                  parent=c_key))
+            nextSessionIds[wsck] += 1
+        try:
+            if 'conference' in row:
+                conf = _buildConference(c_key, row['conference'],
+                                        bool(row['sessions']))
+            sessions = [_buildSession(s_key, data) for s_key, data in
+                        zip(s_keys, row['sessions'])]
+        except ROW_ERRORS as e:
+            logging.warning('Skipping invalid import line: %s', e)
+            errors += 1
+            continue
+        imported += 1
+        if conf:
+            entities.append(conf)
+            newConfs.append(conf)
+        elif sessions:
+            touchedConfs.add(c_key)
+        entities.extend(sessions)
+        sessionSpeakers.extend((sess, data.get('speakers') or [])
+                               for sess, data in zip(sessions,
+                                                     row['sessions']))
+
+    # look every speaker of the batch up once; missing ones are created
+    # with their SpeakerName, so a retried batch finds them again
+    speakers = Speaker.getOrInsertMulti(
+        set(name for sess, names in sessionSpeakers for name in names))
+    spk_keys = list(set(spk.key for spk in speakers.values()))
+    # store the keys & names of the speakers on the sessions
+    for sess, names in sessionSpeakers:
+        sess.speakers = [speakers[name].key for name in names]
+        sess.speakerNames = [speakers[name].name for name in names]
+
+    # make sure all organizers have a profile
+    p_keys = list(set(conf.key.parent() for conf in newConfs))
+    entities.extend(
+        Profile(key=p_key, displayName=p_key.id(), mainEmail=p_key.id(),
+                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED))
+        for p_key, prof in zip(p_keys, ndb.get_multi(p_keys))
+        if prof is None)
+
+    ndb.put_multi(entities)
+    for c_key in touchedConfs:
+        caches.touchConferenceSessions(c_key)
+
+    # update the featured speakers & announcement of the conferences
+    tasks = [taskqueue.Task(params={'c_key_str': c_key.urlsafe()},
+                            url='/tasks/check_speakers')
+             for c_key in touchedConfs.union(
+                 conf.key for conf in newConfs if conf.sessionsVersion)]
+    tasks.extend(taskqueue.Task(
+        params={'websafeConferenceKey': conf.key.urlsafe()},
+        url='/tasks/update_announcement')
+        for conf in newConfs
+        if caches.isNearlySoldOut(conf))
+    tasks.extend(taskqueue.Task(
+        params={'websafeSpeakerKey': spk_key.urlsafe()},
+        url='/tasks/count_speaker_sessions')
+        for spk_key in spk_keys)
+    _addTasks(tasks)
+    # count the new conferences in the facets
+    facets.queueCount(conf.key for conf in newConfs)
+    # offer the new names to the autocomplete
+    autocomplete.queueNames({
+        'CITY': list(set(conf.city for conf in newConfs)),
+        'TOPIC': list(set(t for conf in newConfs for t in conf.topics)),
+        'SPEAKER': list(set(spk.name for spk in speakers.values()))})
+
+    # move the checkpoint forward
+    shard.checkpoint = batchEnd
+    shard.pending = None
+    shard.rows += imported
+    shard.errors += errors
+    shard.put()
+
+
+def runImportShard(shard_key):
+    """Import a shard batch by batch, continuing in a new task when the
+    time of the current one is up."""
+    shard = shard_key.get()
+    if not shard or shard.finished:
+        return
+    fileName = shard_key.parent().get().fileName
+    store = getFileStore()
+    started = time.time()
+    rows = shard.rows
+    while shard.checkpoint < shard.end:
+        if time.time() - started > IMPORT_TASK_SECONDS:
+            _addTasks([_shardTask(shard_key)])
+            break
+        lines = []
+        batchEnd = shard.checkpoint
+        for batchEnd, line in store.readLines(fileName, shard.checkpoint,
+                                              shard.end):
+            if line.strip():
+                lines.append(line)
+                if len(lines) == IMPORT_BATCH_LINES:
+                    break
+        if batchEnd == shard.checkpoint:
+            # nothing left to read, e.g. the file got truncated
+            shard.checkpoint = shard.end
+            shard.put()
+            continue
+        _importBatch(shard, lines, batchEnd)
+    else:
+        shard.finished = datetime.utcnow()
+        shard.put()
+
+    # report the throughput of this task
+    elapsed = time.time() - started
+    logging.info('Imported %d rows of shard %s in %.1fs (%.1f rows/s)',
+                 shard.rows - rows, shard_key.urlsafe(), elapsed,
+                 (shard.rows - rows) / elapsed if elapsed else 0.0)
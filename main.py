@@ -14,16 +14,21 @@ may 26 (v1.2)
 """
 
 # built-in modules
+import json
+import logging
+import os
+import time
+_importStarted = time.time()
 import webapp2
 # third-party modules
 from google.appengine.api import app_identity
 from google.appengine.api import mail
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
+from google.appengine.runtime import apiproxy_errors
 # own modules
-from conference import ConferenceApi
-from models import Session
-from models import Speaker
+from settings import CONFIRMATION_EMAIL_QUEUE
 
 # authorship information
 __authors__ = "Wesley Chun, Norbert Stueken"
@@ -37,18 +42,167 @@ __email__ = "wesc+api@google.com (Wesley Chun), norbert.stueken@gmail.com \
 (Norbert Stueken)"
 __status__ = "Development"
 
+# number of confirmation email tasks leased (and sent) at once
+EMAIL_BATCH_SIZE = 100
+# lease time of a batch; unsent tasks become available again afterwards
+EMAIL_LEASE_SECONDS = 120
+# stop leasing new batches after this many seconds of a cron run
+EMAIL_RUN_SECONDS = 45
+# memcache key & limits of the backoff after the mail quota ran out
+MEMCACHE_EMAIL_BACKOFF_KEY = "CONFIRMATION_EMAIL_BACKOFF"
+EMAIL_BACKOFF_MIN_SECONDS = 60
+EMAIL_BACKOFF_MAX_SECONDS = 3600
+
+# the page built by build.py, and its source, which refers to the unbundled
+# scripts & stylesheets, for checkouts which haven't been built
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BUILT_INDEX = os.path.join(ROOT, 'build', 'index.html')
+SOURCE_INDEX = os.path.join(ROOT, 'templates', 'index.html')
+
+# number of sessions renamed per task
+RENAME_BATCH_SIZE = 50
+
+# This module serves the page as well as the task & cron handlers, so it
+# imports the app's own modules in the handlers needing them: a cold start
+# only loads what its first request needs, and none of them loads the
+# Endpoints API of conference.py, which the warmup request preloads, as the
+# instance may serve the API as well. main.py & conference.py log how long
+# their imports took.
+
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
         """Set Announcement in Memcache."""
-        # use _cacheAnnouncement() to set announcement in Memcache
-        ConferenceApi._cacheAnnouncement()
+        import caches
+        # use cacheAnnouncement() to set announcement in Memcache
+        caches.cacheAnnouncement()
         self.response.set_status(204)
 
 
+class UpdateAnnouncementHandler(webapp2.RequestHandler):
+    def post(self):
+        """Update the nearly sold out set & Announcement in Memcache."""
+        import caches
+        # convert the urlsafe key string to the conference key
+        c_key = ndb.Key(urlsafe=self.request.get('websafeConferenceKey'))
+        caches.updateNearlySoldOut(c_key)
+
+
+def _renderConfirmationEmail(conf):
+    """Render the body of the email confirming a Conference creation.
+
+    args:
+        conf: the created Conference entity.
+    returns:
+        body: the email body.
+    """
+    details = [
+        ('Name', conf.name),
+        ('Description', conf.description),
+        ('Topics', ', '.join(conf.topics)),
+        ('City', conf.city),
+        ('Start date', conf.startDate),
+        ('End date', conf.endDate),
+        ('Max attendees', conf.maxAttendees),
+    ]
+    return 'Hi, you have created the following conference:\r\n\r\n%s' % (
+        '\r\n'.join('%s: %s' % (label, value) for label, value in details
+                     if value not in (None, '')))
+
+
+def _sendConfirmationEmails(queue, tasks):
+    """Send the confirmation emails of a batch of leased tasks.
+
+    args:
+        queue: the pull queue the tasks were leased from.
+        tasks: the leased tasks, each holding a websafe conference key.
+    returns:
+        sent: number of emails sent.
+    raises:
+        apiproxy_errors.OverQuotaError if the mail quota ran out. Tasks of
+            emails sent before are deleted from the queue nevertheless.
+    """
+    import models  # noqa: F401 -- defines the kinds read here
+    # get all conferences and their organizers with two batch gets
+    confs = ndb.get_multi([ndb.Key(urlsafe=task.payload) for task in tasks])
+    profiles = ndb.get_multi([conf.key.parent() for conf in confs if conf])
+    emails = dict((prof.key, prof.mainEmail) for prof in profiles if prof)
+    sender = 'noreply@%s.appspotmail.com' % (
+        app_identity.get_application_id())
+
+    done = []
+    sent = 0
+    try:
+        for task, conf in zip(tasks, confs):
+            # a deleted conference or organizer leaves nobody to notify
+            email = conf and emails.get(conf.key.parent())
+            if email:
+                mail.send_mail(
+                    sender,                                 # from
+                    email,                                  # to
+                    'You created a new Conference!',        # subj
+                    _renderConfirmationEmail(conf))         # body
+                sent += 1
+            else:
+                logging.warning('Dropping confirmation email for %s',
+                                task.payload)
+            done.append(task)
+    finally:
+        # delete the handled tasks, even if the quota ran out in between
+        if done:
+            queue.delete_tasks(done)
+    return sent
+
+
+class SendConfirmationEmailsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Send pending emails confirming Conference creations in batches."""
+        # back off while the mail quota is exhausted
+        backoff = memcache.get(MEMCACHE_EMAIL_BACKOFF_KEY)
+        if backoff and backoff['until'] > time.time():
+            self.response.set_status(204)
+            return
+
+        queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        started = time.time()
+        sent = 0
+        overQuota = False
+        while time.time() - started < EMAIL_RUN_SECONDS:
+            tasks = queue.lease_tasks(EMAIL_LEASE_SECONDS, EMAIL_BATCH_SIZE)
+            if not tasks:
+                break
+            try:
+                sent += _sendConfirmationEmails(queue, tasks)
+            except apiproxy_errors.OverQuotaError:
+                # Unsent tasks stay leased and are retried once the lease
+                # expires; double the backoff on every quota error in a row.
+                seconds = min(EMAIL_BACKOFF_MAX_SECONDS, 2 * (
+                    backoff['seconds'] if backoff
+                    else EMAIL_BACKOFF_MIN_SECONDS / 2))
+                memcache.set(MEMCACHE_EMAIL_BACKOFF_KEY, {
+                    'seconds': seconds, 'until': time.time() + seconds})
+                logging.warning('Mail quota exceeded, backing off for %ss',
+                                seconds)
+                overQuota = True
+                break
+        if backoff and not overQuota:
+            # the run didn't hit the quota, so reset the backoff
+            memcache.delete(MEMCACHE_EMAIL_BACKOFF_KEY)
+
+        # report the throughput of this run
+        elapsed = time.time() - started
+        report = 'Sent %d confirmation emails in %.1fs (%.1f/s)' % (
+            sent, elapsed, sent / elapsed if elapsed else 0.0)
+        logging.info(report)
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(report)
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
     def post(self):
-        """Send email confirming Conference creation."""
+        """Send email confirming Conference creation; only kept to drain
+        push tasks enqueued before the confirmation-email pull queue.
+        """
         mail.send_mail(
             'noreply@%s.appspotmail.com' % (
                 app_identity.get_application_id()),     # from
@@ -63,54 +217,259 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
 class CheckSpeakers(webapp2.RequestHandler):
     def post(self):
         """Check if there are more conference sessions by the Speakers."""
+        import caches
         # convert the urlsafe key string to the conference key
         c_key = ndb.Key(urlsafe=self.request.get('c_key_str'))
-        # get all sessions of the conference
-        confSessions = Session.query(ancestor=c_key)
-        # get all speakers
-        speakers = Speaker.query()
-        # sort all speakers by name
-        speakers = speakers.order(Speaker.name)
-        # create empty list of featured speakers
-        feat_spk_keys = []
-        # check for every speaker
-        for spk in speakers:
-            count = 0
-            # in how many sessions he speaks at the conference
-            for session in confSessions:
-                for cs_spk_key in session.speakers:
-                    if spk.key == cs_spk_key:
-                        count += 1
-                        # if he is in more than one session, feature him
-                        if count == 2:
-                            # attach the speaker key to the list of
-                            # featured speakers
-                            feat_spk_keys.append(cs_spk_key)
-        # set memcache key to the urlsafe key of the conference. Adding prefix
-        # "FEATURED:", so new functionality to be put into memcache won't
-        # collide with existing key.
-        MEMCACHE_CONFERENCE_KEY = "FEATURED:%s" % c_key.urlsafe()
-        # If there are featured speakers at the conference,
-        # format featured speakers announcement and set it in memcache
-        if feat_spk_keys:
-            count = 0
-            featured = "FEATURED SPEAKERS & SESSIONS ON THIS CONFERENCE -- "
-            for spk_key in feat_spk_keys:
-                count += 1
-                featured += " FEATURED %s: %s SESSIONS: " % (
-                    count, spk_key.get().name)
-                sessionsOfFeatured = confSessions.filter(
-                    Session.speakers == spk_key)
-                featured += ", ".join(sess.name for sess in sessionsOfFeatured)
-            memcache.set(MEMCACHE_CONFERENCE_KEY, featured)
-        else:
-            # If there are no featured speakers at the conference,
-            # delete the memcache announcements entry
-            featured = ""
-            memcache.delete(MEMCACHE_CONFERENCE_KEY)
+        # format the featured speakers announcement and set it in memcache
+        caches.cacheFeaturedSpeakers(c_key)
+
+
+class ExportConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Export the next chunk of a conference export."""
+        from exports import runExportChunk
+        runExportChunk(ndb.Key(urlsafe=self.request.get('websafeExportKey')))
+
+
+class IndexHandler(webapp2.RequestHandler):
+    def get(self):
+        """Serve the page built by build.py, or templates/index.html if
+        build.py hasn't been run."""
+        path = BUILT_INDEX
+        if not os.path.isfile(path):
+            logging.warning('%s is missing; serving %s. Run build.py before '
+                            'deploying.', BUILT_INDEX, SOURCE_INDEX)
+            path = SOURCE_INDEX
+        with open(path) as f:
+            page = f.read()
+        # never cached, so clients pick up new bundles right away
+        self.response.headers['Cache-Control'] = 'no-cache'
+        self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
+        self.response.write(page)
+
+
+class DownloadExportHandler(webapp2.RequestHandler):
+    def get(self, websafeExportKey):
+        """Stream a completed export from the file store."""
+        from exports import CONTENT_TYPES
+        from filestore import getFileStore
+        job = ndb.Key(urlsafe=websafeExportKey).get()
+        # the secret token of the download url authorizes the download
+        if (not job or job.status != 'DONE' or
+                self.request.get('token') != job.downloadToken):
+            self.abort(404)
+        self.response.headers['Content-Type'] = CONTENT_TYPES[job.format]
+        self.response.headers['Content-Disposition'] = (
+            'attachment; filename="%s-%s.%s"' % (
+                job.key.parent().id(), job.data.lower(), job.format.lower()))
+        for block in getFileStore().stream(job.fileName):
+            self.response.out.write(block)
+
+
+class ImportHandler(webapp2.RequestHandler):
+    def post(self):
+        """Start a bulk import of the NDJSON file in the request body."""
+        from imports import startImport
+        if not self.request.body.strip():
+            self.abort(400)
+        job = startImport(self.request.body)
+        self.response.set_status(202)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'shards': job.shards,
+            'statusUrl': '/admin/import/%s' % job.key.id()}))
+
+
+class ImportStatusHandler(webapp2.RequestHandler):
+    def get(self, job_id):
+        """Report the progress & throughput of a bulk import."""
+        from imports import getImportStatus
+        job_key = ndb.Key('ImportJob', int(job_id))
+        if not job_key.get():
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(getImportStatus(job_key)))
+
+    def post(self, job_id):
+        """Resume the shards of a bulk import which haven't finished."""
+        from imports import resumeImport
+        job_key = ndb.Key('ImportJob', int(job_id))
+        if not job_key.get():
+            self.abort(404)
+        resumeImport(job_key)
+        self.response.set_status(202)
+
+
+class ImportShardHandler(webapp2.RequestHandler):
+    def post(self):
+        """Import (the rest of) a shard of a bulk import."""
+        from imports import runImportShard
+        runImportShard(ndb.Key(urlsafe=self.request.get('websafeShardKey')))
+
+
+class MigrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Report the progress of all schema migrations."""
+        from migrations import getMigrationStatus
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(getMigrationStatus()))
+
+    def post(self):
+        """Start (or resume) the pending schema migrations."""
+        from migrations import startMigrations
+        startMigrations()
+        self.response.set_status(202)
+
+
+class MigrationBatchHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run the next batch of a schema migration."""
+        from migrations import runMigrationBatch
+        runMigrationBatch(int(self.request.get('version')),
+                          int(self.request.get('batch')))
+
+
+class CountSpeakerSessionsHandler(webapp2.RequestHandler):
+    @ndb.transactional
+    def _storeCounts(self, spk_key, counts):
+        spk = spk_key.get()
+        if not spk:
+            return
+        spk.sessionCounts = counts
+        spk.put()
+
+    def post(self):
+        """Recount the sessions per conference of a speaker. The count is
+        a keys-only scan of the speaker's index entries, so the task can run
+        any number of times."""
+        from models import Session
+        spk_key = ndb.Key(urlsafe=self.request.get('websafeSpeakerKey'))
+        counts = {}
+        for s_key in Session.query(Session.speakers == spk_key).iter(
+                keys_only=True):
+            wsck = s_key.parent().urlsafe()
+            counts[wsck] = counts.get(wsck, 0) + 1
+        self._storeCounts(spk_key, counts)
+
+
+class RenameSpeakerHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy the current name of a speaker to a batch of its sessions
+        and continue with the next batch in a new task."""
+        import caches
+        from models import Session
+        spk = ndb.Key(urlsafe=self.request.get('websafeSpeakerKey')).get()
+        if not spk:
+            # deleted meanwhile; retrying wouldn't bring it back
+            logging.warning('Speaker to rename not found: %s',
+                            self.request.get('websafeSpeakerKey'))
+            return
+        cursor = None
+        if self.request.get('cursor'):
+            cursor = ndb.Cursor(urlsafe=self.request.get('cursor'))
+        sessions, next_cursor, more = Session.query(
+            Session.speakers == spk.key).fetch_page(
+            RENAME_BATCH_SIZE, start_cursor=cursor)
+        # read the other speakers too, as older sessions have no names yet
+        names = dict((other.key, other.name) for other in ndb.get_multi(
+            list(set(k for sess in sessions for k in sess.speakers))) if other)
+        names[spk.key] = spk.name
+        changed = []
+        for sess in sessions:
+            speakerNames = [names.get(k, '') for k in sess.speakers]
+            if sess.speakerNames != speakerNames:
+                sess.speakerNames = speakerNames
+                changed.append(sess)
+        ndb.put_multi(changed)
+        # the sessions of these conferences have changed
+        c_keys = set(sess.key.parent() for sess in changed)
+        for c_key in c_keys:
+            caches.touchConferenceSessions(c_key)
+            taskqueue.add(params={'c_key_str': c_key.urlsafe()},
+                          url='/tasks/check_speakers')
+        if more and next_cursor:
+            taskqueue.add(params={'websafeSpeakerKey': spk.key.urlsafe(),
+                                  'cursor': next_cursor.urlsafe()},
+                          url='/tasks/rename_speaker')
+
+
+class IndexNamesHandler(webapp2.RequestHandler):
+    def post(self):
+        """Add the names of the task to the autocomplete prefix index."""
+        from autocomplete import addNames
+        from models import AutocompleteField
+        for field in AutocompleteField.names():
+            names = self.request.get_all(field)
+            if names:
+                addNames(field, names)
+
+
+class CountFacetsHandler(webapp2.RequestHandler):
+    def post(self):
+        """Recount the conferences of the task in the facet counts."""
+        from facets import countConferences
+        countConferences([ndb.Key(urlsafe=wsck) for wsck in
+                          self.request.get_all('websafeConferenceKey')])
+
+
+class DeleteConferenceHandler(webapp2.RequestHandler):
+    def post(self):
+        """Run the next batch of the deletion of a conference."""
+        from deletions import runDeletionBatch
+        runDeletionBatch(self.request.get('websafeConferenceKey'),
+                         int(self.request.get('batch')))
+
+
+class DeletionStatusHandler(webapp2.RequestHandler):
+    def get(self, websafeConferenceKey):
+        """Report the progress of the deletion of a conference."""
+        from deletions import getDeletionStatus
+        status = getDeletionStatus(websafeConferenceKey)
+        if not status:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(status))
+
+    def post(self, websafeConferenceKey):
+        """Resume the deletion of a conference if it stopped."""
+        from deletions import resumeDeletion
+        if not resumeDeletion(websafeConferenceKey):
+            self.abort(404)
+        self.response.set_status(202)
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        """Load the Endpoints module & prime memcache and the memory of
+        the instance before it serves requests."""
+        # both log their import time
+        import caches
+        import conference  # noqa: F401 -- also serves the Endpoints API
+        caches.getAnnouncement()
+        self.response.set_status(204)
+
 
 app = webapp2.WSGIApplication([
+    ('/', IndexHandler),
+    ('/_ah/warmup', WarmupHandler),
     ('/crons/set_announcement', SetAnnouncementHandler),
+    ('/tasks/update_announcement', UpdateAnnouncementHandler),
+    ('/crons/send_confirmation_emails', SendConfirmationEmailsHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/check_speakers', CheckSpeakers)
+    ('/tasks/check_speakers', CheckSpeakers),
+    ('/tasks/export_conference', ExportConferenceHandler),
+    ('/exports/(.+)', DownloadExportHandler),
+    ('/admin/import', ImportHandler),
+    (r'/admin/import/(\d+)', ImportStatusHandler),
+    ('/tasks/import_shard', ImportShardHandler),
+    ('/admin/migrations', MigrationsHandler),
+    ('/tasks/migrate', MigrationBatchHandler),
+    ('/tasks/count_speaker_sessions', CountSpeakerSessionsHandler),
+    ('/tasks/rename_speaker', RenameSpeakerHandler),
+    ('/tasks/index_names', IndexNamesHandler),
+    ('/tasks/count_facets', CountFacetsHandler),
+    ('/tasks/delete_conference', DeleteConferenceHandler),
+    ('/admin/deletions/(.+)', DeletionStatusHandler)
 ], debug=True)
+
+logging.info('main imported in %.0f ms', (time.time() - _importStarted) * 1000)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+"""migrations.py
+
+Udacity conference server-side Python App Engine schema migrations
+
+Migrations are numbered and run once, in order. A migration is a list of
+steps; a step rewrites all entities of a kind with an update function. Each
+step is walked with a keys-only query cursor, one batch per task: the batch is
+read, updated and written back with put_multi in cross-group transactions of
+at most MAX_XG_GROUPS entity groups, so concurrent writes to the same entities
+are not lost. After every batch the MigrationState checkpoints the cursor, so
+a chain that stopped can be resumed. Update functions must be idempotent, as a
+batch is run again if its task is retried.
+
+Backfills which are maintained by tasks of their own, like the session
+counts of speakers, are steps as well: a step (model, update, KEYS) passes
+the keys of each batch to update outside of transactions, which queues the
+tasks of the batch.
+
+$Id$
+"""
+
+# built-in modules
+import logging
+from datetime import datetime
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+# own modules
+from autocomplete import queueNames
+from caches import MEMCACHE_PROFILE_KEY
+from facets import queueCount
+from models import Conference
+from models import MigrationState
+from models import Profile
+from models import Registration
+from models import Session
+from models import Speaker
+
+# number of entities per batch & task
+MIGRATION_BATCH_SIZE = 50
+# maximum number of entity groups of a cross-group transaction
+MAX_XG_GROUPS = 25
+# marks a step whose update function takes the keys of a batch
+KEYS = 'keys'
+
+
+def _rewrite(entities):
+    """Write entities back unchanged; rewriting updates their indexes and
+    the properties derived in _pre_put_hook."""
+    return entities
+
+
+def _moveRegistrations(profiles):
+    """Turn the conferenceKeysToAttend lists of Profiles into Registration
+    entities and empty the lists."""
+    entities = []
+    for prof in profiles:
+        if not prof.conferenceKeysToAttend:
+            continue
+        entities.extend(
+            Registration(key=ndb.Key(Registration, wsck, parent=prof.key),
+                         conference=ndb.Key(urlsafe=wsck))
+            for wsck in prof.conferenceKeysToAttend)
+        prof.conferenceKeysToAttend = []
+        entities.append(prof)
+    # the cached profiles are outdated once the transaction commits
+    keys = [MEMCACHE_PROFILE_KEY % prof.key.id() for prof in profiles]
+    ndb.get_context().call_on_commit(lambda: memcache.delete_multi(keys))
+    return entities
+
+
+def _queueSpeakerTasks(spk_keys):
+    """Queue the tasks storing the names of speakers on their sessions and
+    counting their sessions."""
+    tasks = []
+    for spk_key in spk_keys:
+        params = {'websafeSpeakerKey': spk_key.urlsafe()}
+        tasks.append(taskqueue.Task(params=params,
+                                    url='/tasks/rename_speaker'))
+        tasks.append(taskqueue.Task(params=params,
+                                    url='/tasks/count_speaker_sessions'))
+    if tasks:
+        taskqueue.Queue().add(tasks)
+
+
+def _queueConferenceNames(c_keys):
+    """Queue the cities & topics of conferences for the autocomplete
+    index."""
+    confs = [conf for conf in ndb.get_multi(c_keys) if conf]
+    queueNames({
+        'CITY': list(set(conf.city for conf in confs)),
+        'TOPIC': list(set(t for conf in confs for t in conf.topics))})
+
+
+def _queueSpeakerNames(spk_keys):
+    """Queue the names of speakers for the autocomplete index."""
+    queueNames({'SPEAKER': [spk.name for spk in ndb.get_multi(spk_keys)
+                            if spk]})
+
+
+# the migrations by version; never change or remove a migration once it has
+# been deployed, add a new one instead
+MIGRATIONS = [
+    {'version': 1, 'name': 'registrations',
+     'steps': [(Profile, _moveRegistrations)]},
+    # drops the index entries of Conference.description, Session.highlights,
+    # Session.location & Profile.mainEmail; rewriting the sessions also
+    # derives their start and end datetimes
+    {'version': 2, 'name': 'unindex heavy properties',
+     'steps': [(Conference, _rewrite), (Session, _rewrite),
+               (Profile, _rewrite)]},
+    {'version': 3, 'name': 'speaker names & session counts',
+     'steps': [(Speaker, _queueSpeakerTasks, KEYS)]},
+    {'version': 4, 'name': 'autocomplete index',
+     'steps': [(Conference, _queueConferenceNames, KEYS),
+               (Speaker, _queueSpeakerNames, KEYS)]},
+    # conferences counted already are left unchanged by their count task
+    {'version': 5, 'name': 'facet counts',
+     'steps': [(Conference, queueCount, KEYS)]},
+]
+
+
+def _migration(version):
+    for migration in MIGRATIONS:
+        if migration['version'] == version:
+            return migration
+    raise ValueError('Unknown migration: %s' % version)
+
+
+def _queueBatch(state, transactional=False):
+    taskqueue.add(params={'version': state.key.id(),
+                          'batch': state.batches},
+                  url='/tasks/migrate', transactional=transactional)
+
+
+def startMigrations():
+    """Start the first migration which hasn't finished yet, or resume it if
+    it is running; returns its MigrationState or None."""
+    states = ndb.get_multi([ndb.Key(MigrationState, migration['version'])
+                            for migration in MIGRATIONS])
+    for migration, state in zip(MIGRATIONS, states):
+        if state and state.status == 'DONE':
+            continue
+        if not state:
+            state = MigrationState(
+                id=migration['version'], name=migration['name'],
+                status='RUNNING', started=datetime.utcnow())
+            state.put()
+        # a duplicate task of a running chain is dropped by its batch number
+        _queueBatch(state)
+        return state
+    return None
+
+
+@ndb.transactional(xg=True)
+def _updateGroups(keys, update):
+    """Read, update & write the entities of up to MAX_XG_GROUPS groups."""
+    entities = [entity for entity in ndb.get_multi(keys) if entity]
+    ndb.put_multi(update(entities))
+
+
+def updateInGroups(keys, update):
+    """Update a batch of entities, grouped by entity group."""
+    groups = {}
+    for key in keys:
+        groups.setdefault(key.root(), []).append(key)
+    roots = list(groups)
+    for i in range(0, len(roots), MAX_XG_GROUPS):
+        _updateGroups([key for root in roots[i:i + MAX_XG_GROUPS]
+                       for key in groups[root]], update)
+
+
+@ndb.transactional
+def _checkpoint(version, batch, step, cursor, processed):
+    """Move a migration past a batch; returns the MigrationState or None if
+    the batch has been checkpointed already by a duplicate task."""
+    state = ndb.Key(MigrationState, version).get()
+    if state.batches != batch:
+        return None
+    state.batches += 1
+    state.processed += processed
+    state.step = step
+    state.cursor = cursor
+    if step < len(_migration(version)['steps']):
+        _queueBatch(state, transactional=True)
+    else:
+        state.status = 'DONE'
+        state.finished = datetime.utcnow()
+    state.put()
+    return state
+
+
+def runMigrationBatch(version, batch):
+    """Run the next batch of a migration, continuing in a new task; starts
+    the next migration once all steps are done."""
+    state = ndb.Key(MigrationState, version).get()
+    if not state or state.status == 'DONE' or state.batches != batch:
+        return
+    step = _migration(version)['steps'][state.step]
+    model, update = step[:2]
+    cursor = Cursor(urlsafe=state.cursor) if state.cursor else None
+    keys, next_cursor, more = model.query().fetch_page(
+        MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    if KEYS in step[2:]:
+        update(keys)
+    else:
+        updateInGroups(keys, update)
+    if more and next_cursor:
+        step, cursor = state.step, next_cursor.urlsafe()
+    else:
+        step, cursor = state.step + 1, None
+    state = _checkpoint(version, batch, step, cursor, len(keys))
+    if state and state.status == 'DONE':
+        logging.info('Migration %s (%s) finished', version, state.name)
+        startMigrations()
+
+
+def getMigrationStatus():
+    """Return the progress of all migrations as list of dicts."""
+    states = ndb.get_multi([ndb.Key(MigrationState, migration['version'])
+                            for migration in MIGRATIONS])
+    status = []
+    for migration, state in zip(MIGRATIONS, states):
+        steps = migration['steps']
+        report = {
+            'version': migration['version'],
+            'name': migration['name'],
+            'status': state.status if state else 'PENDING',
+            'steps': len(steps),
+        }
+        if state:
+            elapsed = ((state.finished or datetime.utcnow()) -
+                       state.started).total_seconds()
+            report.update({
+                'step': state.step,
+                'kind': steps[state.step][0]._get_kind()
+                if state.step < len(steps) else None,
+                'batches': state.batches,
+                'processed': state.processed,
+                'seconds': round(elapsed, 1),
+                'entitiesPerSecond': round(state.processed / elapsed, 1)
+                if elapsed > 0 else None,
+            })
+        status.append(report)
+    return status
@@ -14,6 +14,8 @@ may 26 (v1.2)
 
 # built-in modules
 import httplib
+from datetime import datetime
+from datetime import timedelta
 # third-party modules
 import endpoints
 from protorpc import messages
@@ -37,15 +39,92 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class TooManyRequestsException(endpoints.ServiceException):
+    """TooManyRequestsException -- exception mapped to HTTP 429 response"""
+    # httplib has no constant for 429
+    http_status = 429
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
-    mainEmail = ndb.StringProperty()
+    mainEmail = ndb.StringProperty(indexed=False)
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy list of registrations; replaced by Registration entities and
+    # emptied by migration 1 (migrations.py)
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
     sessionsKeysOnWishlist = ndb.StringProperty(repeated=True)
 
 
+class Registration(ndb.Model):
+    """Registration -- A user's registration for a conference. A child of the
+    attending user's Profile, keyed by the websafe conference key, so both
+    directions can be listed with keys-only queries."""
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- Attendee of a conference outbound form message"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- multiple Attendee outbound form message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+
+
+class UserIdByEmail(ndb.Model):
+    """UserIdByEmail -- maps a normalized email address (the key name) to the
+    user id generated for it by the custom getUserId strategy."""
+    userId = ndb.StringProperty(required=True, indexed=False)
+
+
+class Agenda(ndb.Model):
+    """Agenda -- The sessions on a user's wishlist as intervals sorted by
+    start and end, see agenda.py, and the websafe keys of the conferences the
+    user is registered for. A child of the user's Profile with the id
+    'agenda', so it is updated in the same transaction as the wishlist and
+    the registrations."""
+    items = ndb.JsonProperty(indexed=False)
+    # None in agendas built before conferences were added
+    conferences = ndb.JsonProperty(indexed=False)
+
+
+class AgendaItemForm(messages.Message):
+    """AgendaItemForm -- Session or conference of an agenda outbound form
+    message"""
+    websafeSessionKey = messages.StringField(1)
+    name = messages.StringField(2)
+    start = messages.StringField(3)
+    end = messages.StringField(4)
+    # the conference of a session, or the conference itself
+    websafeConferenceKey = messages.StringField(5)
+
+
+class AgendaConflictForm(messages.Message):
+    """AgendaConflictForm -- Overlapping sessions or conferences outbound
+    form message"""
+    items = messages.MessageField(AgendaItemForm, 1, repeated=True)
+
+
+class AgendaSlotForm(messages.Message):
+    """AgendaSlotForm -- Free slot of an agenda outbound form message"""
+    start = messages.StringField(1)
+    end = messages.StringField(2)
+
+
+class AgendaForm(messages.Message):
+    """AgendaForm -- Personal agenda outbound form message"""
+    items = messages.MessageField(AgendaItemForm, 1, repeated=True)
+    conflicts = messages.MessageField(AgendaConflictForm, 2, repeated=True)
+    freeSlots = messages.MessageField(AgendaSlotForm, 3, repeated=True)
+    # the conferences the user is registered for
+    conferences = messages.MessageField(AgendaItemForm, 4, repeated=True)
+
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -64,6 +143,10 @@ class ProfileForm(messages.Message):
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    # entity tag of data; if notModified is set, data is left empty as the
+    # client already holds the current version
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 
 class BooleanMessage(messages.Message):
@@ -74,7 +157,7 @@ class BooleanMessage(messages.Message):
 class Conference(ndb.Model):
     """Conference -- Conference object"""
     name            = ndb.StringProperty(required=True)
-    description     = ndb.StringProperty()
+    description     = ndb.StringProperty(indexed=False)
     organizerUserId = ndb.StringProperty()
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
@@ -83,6 +166,26 @@ class Conference(ndb.Model):
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
     endDate         = ndb.DateProperty()
+    # version stamps of the conference. version is bumped on every put,
+    # sessionsVersion whenever the set of sessions of the conference changes
+    # and serves as the entity tag of getConferenceSessions; getConference
+    # tags by content, as its form includes the organizer's displayName.
+    version         = ndb.IntegerProperty(default=0, indexed=False)
+    sessionsVersion = ndb.IntegerProperty(default=0, indexed=False)
+
+    def touchSessions(self):
+        """Bump sessionsVersion; the next put leaves version unchanged, as
+        the conference itself hasn't changed."""
+        self.sessionsVersion = (self.sessionsVersion or 0) + 1
+        self._sessionsTouched = True
+
+    def _pre_put_hook(self):
+        """Bump the version stamp of the conference on every write, except
+        for writes of touchSessions."""
+        if getattr(self, '_sessionsTouched', False):
+            self._sessionsTouched = False
+            return
+        self.version = (self.version or 0) + 1
 
 
 class ConferenceForm(messages.Message):
@@ -99,16 +202,105 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10)
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    etag            = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
+
+
+class FacetForm(messages.Message):
+    """FacetForm -- Number of conferences with a value of a filter field
+    outbound form message"""
+    field = messages.StringField(1)
+    value = messages.StringField(2)
+    count = messages.IntegerField(3)
 
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    facets = messages.MessageField(FacetForm, 3, repeated=True)
+    # entity tag of the listing; if notModified is set, the rest is left
+    # empty as the client holds the current version
+    etag = messages.StringField(4)
+    notModified = messages.BooleanField(5)
 
 
 class Speaker(ndb.Model):
     """Speaker -- A Speaker can speak at multiple conferences."""
     name = ndb.StringProperty(required=True)
+    # number of sessions per websafe conference key, recounted by the
+    # /tasks/count_speaker_sessions task whenever sessions are added
+    sessionCounts = ndb.JsonProperty(indexed=False)
+
+    @staticmethod
+    def idFromName(name):
+        """Return the name formatted in lower case without whitespaces, the
+        key name of the SpeakerName of a speaker.
+        """
+        return name.lower().strip().replace(" ", "_")
+
+    @classmethod
+    def findKeys(cls, names):
+        """Return a dict of the keys of the speakers with the given names;
+        names without a speaker are left out.
+
+        Speakers are found by their SpeakerName. Speakers created before
+        there were SpeakerNames have the id derived from their name instead,
+        which a renamed one keeps, so such a speaker only counts if its
+        current name still matches.
+        """
+        ids = dict((name, cls.idFromName(name)) for name in names)
+        uniqueIds = sorted(set(ids.values()))
+        found = dict(
+            (spk_id, mapping.speaker) for spk_id, mapping in zip(
+                uniqueIds, ndb.get_multi([ndb.Key(SpeakerName, spk_id)
+                                          for spk_id in uniqueIds]))
+            if mapping)
+        legacyIds = [spk_id for spk_id in uniqueIds if spk_id not in found]
+        for spk_id, spk in zip(legacyIds, ndb.get_multi(
+                [ndb.Key(cls, spk_id) for spk_id in legacyIds])):
+            if spk and cls.idFromName(spk.name) == spk_id:
+                found[spk_id] = spk.key
+        return dict((name, found[spk_id]) for name, spk_id in ids.items()
+                    if spk_id in found)
+
+    @classmethod
+    def findKey(cls, name):
+        """Return the key of the speaker with the given name or None."""
+        return cls.findKeys([name]).get(name)
+
+    @classmethod
+    def getOrInsertMulti(cls, names):
+        """Return a dict of the speakers with the given names; speakers who
+        don't exist yet are created with allocated ids."""
+        keys = cls.findKeys(names)
+        speakers = dict((name, spk) for name, spk in zip(
+            list(keys), ndb.get_multi(list(keys.values()))) if spk)
+        for name in set(names) - set(speakers):
+            spk_key = ndb.Key(cls, cls.allocate_ids(size=1)[0])
+            speakers[name] = cls._insert(spk_key, name)
+        return speakers
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _insert(spk_key, name):
+        """Create a speaker & its SpeakerName, unless a speaker of the name
+        has been created concurrently; returns the speaker of the name."""
+        mapping_key = ndb.Key(SpeakerName, Speaker.idFromName(name))
+        mapping = mapping_key.get()
+        spk = mapping and mapping.speaker.get()
+        if spk:
+            return spk
+        spk = Speaker(key=spk_key, name=name)
+        ndb.put_multi([spk, SpeakerName(key=mapping_key, speaker=spk_key)])
+        return spk
+
+
+class SpeakerName(ndb.Model):
+    """SpeakerName -- maps a speaker name formatted by Speaker.idFromName (the
+    key name) to the speaker of that name, so names are unique and speakers
+    are found by a get."""
+    speaker = ndb.KeyProperty(kind='Speaker', required=True, indexed=False)
 
 
 class SpeakerForm(messages.Message):
@@ -116,12 +308,31 @@ class SpeakerForm(messages.Message):
     name = messages.StringField(1, required=True)
 
 
+class SpeakerConferenceForm(messages.Message):
+    """SpeakerConferenceForm -- Sessions of a speaker at a conference"""
+    websafeConferenceKey = messages.StringField(1)
+    name = messages.StringField(2)
+    sessions = messages.IntegerField(3)
+
+
+class SpeakerProfileForm(messages.Message):
+    """SpeakerProfileForm -- Speaker profile outbound form message"""
+    name = messages.StringField(1)
+    websafeKey = messages.StringField(2)
+    conferences = messages.MessageField(SpeakerConferenceForm, 3,
+                                        repeated=True)
+    sessions = messages.IntegerField(4)
+
+
 class Session(ndb.Model):
     """Session -- Session as part of a Conference."""
     name            = ndb.StringProperty(required=True)
-    highlights      = ndb.StringProperty(repeated=True)
+    highlights      = ndb.StringProperty(repeated=True, indexed=False)
     # A session can have multiple speaker entities/kinds.
     speakers        = ndb.KeyProperty(kind=Speaker, repeated=True)
+    # names of the speakers in the same order, kept in sync on renames by the
+    # /tasks/rename_speaker task
+    speakerNames    = ndb.StringProperty(repeated=True, indexed=False)
     duration        = ndb.TimeProperty()
     # Add typeOFSession as an enum property with by using the msgprop module.
     # To perform queries on this field, indexed must be set to True.
@@ -129,7 +340,30 @@ class Session(ndb.Model):
     typeOfSession   = ndb.StringProperty()
     date            = ndb.DateProperty()
     startTime       = ndb.TimeProperty()
-    location        = ndb.StringProperty()
+    location        = ndb.StringProperty(indexed=False)
+    # Denormalized from date, startTime and duration by _pre_put_hook so that
+    # time window queries are a single index scan. Times are treated as UTC.
+    startDateTime   = ndb.DateTimeProperty()
+    endDateTime     = ndb.DateTimeProperty()
+    # Start of every hour the session runs in, for "running at" queries.
+    runningHours    = ndb.DateTimeProperty(repeated=True)
+
+    def _pre_put_hook(self):
+        """Derive startDateTime, endDateTime and runningHours."""
+        if not (self.date and self.startTime):
+            self.startDateTime = self.endDateTime = None
+            self.runningHours = []
+            return
+        self.startDateTime = datetime.combine(self.date, self.startTime)
+        self.endDateTime = self.startDateTime
+        if self.duration:
+            self.endDateTime += timedelta(hours=self.duration.hour,
+                                          minutes=self.duration.minute)
+        hour = self.startDateTime.replace(minute=0, second=0, microsecond=0)
+        self.runningHours = [hour]
+        while hour + timedelta(hours=1) < self.endDateTime:
+            hour += timedelta(hours=1)
+            self.runningHours.append(hour)
 
 
 class SessionForm(messages.Message):
@@ -151,6 +385,20 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session form messages"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    etag = messages.StringField(2)
+    notModified = messages.BooleanField(3)
+
+
+class ConferenceDetailForm(messages.Message):
+    """ConferenceDetailForm -- Everything the conference detail page shows"""
+    conference = messages.MessageField(ConferenceForm, 1)
+    isAttending = messages.BooleanField(2)
+    # websafe keys of the sessions of the conference on the user's wishlist
+    sessionsKeysOnWishlist = messages.StringField(3, repeated=True)
+    sessions = messages.MessageField(SessionForm, 4, repeated=True)
+    featuredSpeakers = messages.StringField(5)
+    etag = messages.StringField(6)
+    notModified = messages.BooleanField(7)
 
 
 class TeeShirtSize(messages.Enum):
@@ -182,13 +430,183 @@ class TypeOfSession(messages.Enum):
     Networking = 6
 
 
+# defaults of the fields missing in created conferences & sessions
+DEFAULTS = {
+    "city": "Default City",
+    "maxAttendees": 0,
+    "seatsAvailable": 0,
+    "topics": ["Default", "Topic"],
+}
+
+DEFAULTS_SESSION = {
+    "highlights": ["Default", "Highlight"],
+    "location": "Default Location",
+    "typeOfSession": TypeOfSession("NOT_SPECIFIED"),
+    "date": "1900-01-01",
+    "startTime": "10:00",
+    "duration": "00:00"
+}
+
+
+class ExportData(messages.Enum):
+    """ExportData -- data of a conference to export"""
+    SESSIONS = 1
+    SPEAKERS = 2
+    ATTENDEES = 3
+
+
+class ExportFormat(messages.Enum):
+    """ExportFormat -- file format of an export"""
+    CSV = 1
+    NDJSON = 2
+
+
+class ExportJob(ndb.Model):
+    """ExportJob -- Export of conference data to the file store, written
+    chunk by chunk by the export_conference task; child of the Conference."""
+    data            = ndb.StringProperty(required=True)
+    format          = ndb.StringProperty(required=True)
+    # PENDING, RUNNING, DONE or FAILED
+    status          = ndb.StringProperty(default='PENDING')
+    fileName        = ndb.StringProperty(indexed=False)
+    # secret part of the download url
+    downloadToken   = ndb.StringProperty(indexed=False)
+    # checkpoint of the last written chunk
+    cursor          = ndb.StringProperty(indexed=False)
+    rows            = ndb.IntegerProperty(default=0, indexed=False)
+    bytesWritten    = ndb.IntegerProperty(default=0, indexed=False)
+    created         = ndb.DateTimeProperty(auto_now_add=True)
+    updated         = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+
+class ExportJobForm(messages.Message):
+    """ExportJobForm -- ExportJob outbound form message"""
+    websafeKey      = messages.StringField(1)
+    data            = messages.EnumField('ExportData', 2)
+    format          = messages.EnumField('ExportFormat', 3)
+    status          = messages.StringField(4)
+    rows            = messages.IntegerField(5)
+    downloadUrl     = messages.StringField(6)
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- Bulk import of an NDJSON file, split into ImportShards"""
+    fileName        = ndb.StringProperty(indexed=False)
+    shards          = ndb.IntegerProperty(indexed=False)
+    started         = ndb.DateTimeProperty(auto_now_add=True)
+
+
+class ImportShard(ndb.Model):
+    """ImportShard -- Byte range of the file of an ImportJob, imported by
+    the import_shard task; child of the ImportJob."""
+    start           = ndb.IntegerProperty(indexed=False)
+    end             = ndb.IntegerProperty(indexed=False)
+    # offset up to which the lines have been imported
+    checkpoint      = ndb.IntegerProperty(indexed=False)
+    # ids allocated for the batch after the checkpoint, reused on retries
+    pending         = ndb.JsonProperty()
+    rows            = ndb.IntegerProperty(default=0, indexed=False)
+    errors          = ndb.IntegerProperty(default=0, indexed=False)
+    finished        = ndb.DateTimeProperty(indexed=False)
+
+
+class SessionPopularityShard(ndb.Model):
+    """SessionPopularityShard -- Shard of the number of wishlist additions
+    of a session, keyed by '<websafeSessionKey>-<shard>'; see popularity.py"""
+    session         = ndb.KeyProperty(kind='Session', indexed=False)
+    conference      = ndb.KeyProperty(kind='Conference')
+    count           = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class FacetCounts(ndb.Model):
+    """FacetCounts -- Number of conferences by value by filter field, e.g.
+    {'CITY': {'London': 3}}; see facets.py"""
+    counts          = ndb.JsonProperty(indexed=False)
+
+
+class CountedFacets(ndb.Model):
+    """CountedFacets -- Values a conference is counted with in the
+    FacetCounts, keyed by websafeConferenceKey; child of the FacetCounts"""
+    values          = ndb.JsonProperty(indexed=False)
+
+
+class PopularSessionForm(messages.Message):
+    """PopularSessionForm -- Wishlisted session outbound form message"""
+    websafeSessionKey = messages.StringField(1)
+    name = messages.StringField(2)
+    wishlistCount = messages.IntegerField(3)
+
+
+class PopularSessionForms(messages.Message):
+    """PopularSessionForms -- Most wishlisted sessions outbound form message"""
+    items = messages.MessageField(PopularSessionForm, 1, repeated=True)
+
+
+class MigrationState(ndb.Model):
+    """MigrationState -- Progress of a schema migration, keyed by its
+    version; see migrations.py"""
+    name            = ndb.StringProperty(indexed=False)
+    status          = ndb.StringProperty(indexed=False)
+    # index of the step being run & cursor of its next batch
+    step            = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    # number of batches run so far, also used to drop duplicate tasks
+    batches         = ndb.IntegerProperty(default=0, indexed=False)
+    processed       = ndb.IntegerProperty(default=0, indexed=False)
+    started         = ndb.DateTimeProperty(indexed=False)
+    finished        = ndb.DateTimeProperty(indexed=False)
+
+
+class ConferenceDeletion(ndb.Model):
+    """ConferenceDeletion -- Progress of the cascade delete of a deleted
+    conference, keyed by its websafe key; see deletions.py"""
+    status          = ndb.StringProperty(indexed=False)
+    # index of the phase being run & cursor of its next batch
+    phase           = ndb.IntegerProperty(default=0, indexed=False)
+    cursor          = ndb.StringProperty(indexed=False)
+    # session whose wishlist references are being removed
+    sessionKey      = ndb.KeyProperty(kind='Session', indexed=False)
+    # speakers of the deleted sessions, recounted once the sessions are gone
+    speakers        = ndb.KeyProperty(kind='Speaker', repeated=True,
+                                      indexed=False)
+    # number of batches run so far, also used to drop duplicate tasks
+    batches         = ndb.IntegerProperty(default=0, indexed=False)
+    deleted         = ndb.IntegerProperty(default=0, indexed=False)
+    updated         = ndb.IntegerProperty(default=0, indexed=False)
+    started         = ndb.DateTimeProperty(indexed=False)
+    finished        = ndb.DateTimeProperty(indexed=False)
+
+
+class AutocompleteField(messages.Enum):
+    """AutocompleteField -- fields with a prefix index"""
+    CITY = 1
+    TOPIC = 2
+    SPEAKER = 3
+
+
+class PrefixIndex(ndb.Model):
+    """PrefixIndex -- The first names of a field starting with a prefix, keyed
+    by '<field>:<prefix>', see autocomplete.py."""
+    suggestions = ndb.StringProperty(repeated=True, indexed=False)
+
+
+class SuggestionsForm(messages.Message):
+    """SuggestionsForm -- Autocomplete suggestions outbound form message"""
+    items = messages.StringField(1, repeated=True)
+
+
 class ConferenceQueryForm(messages.Message):
     """ConferenceQueryForm -- Conference query inbound form message"""
     field = messages.StringField(1)
     operator = messages.StringField(2)
     value = messages.StringField(3)
+    values = messages.StringField(4, repeated=True)
 
 
 class ConferenceQueryForms(messages.Message):
-    """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
+    """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form
+    message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2)
+    pageToken = messages.StringField(3)
+    ifNoneMatch = messages.StringField(4)
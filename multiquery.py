@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+"""multiquery.py
+
+Udacity conference server-side Python App Engine merged subqueries
+
+ndb runs the subqueries of IN and OR filters one after another. Here every
+subquery is started at once as an async query and their results are combined
+with an ordered k-way merge which drops duplicates, i.e. entities matching
+more than one subquery.
+
+All subqueries must be sorted by the same properties, and implicitly by key.
+For pagination every subquery fetches at most a page of results; the page
+token holds the cursor & number of consumed results of every subquery plus
+the position of the last result returned, so duplicates consumed by one
+subquery on an earlier page are skipped when another one reaches them.
+
+$Id$
+"""
+
+# built-in modules
+import base64
+import heapq
+import json
+from datetime import date
+from datetime import datetime
+from datetime import time
+# third-party modules
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+
+# formats of the sort values of these types in page tokens
+_TEMPORAL_FORMATS = (
+    ('datetime', datetime, '%Y-%m-%dT%H:%M:%S.%f'),
+    ('date', date, '%Y-%m-%d'),
+    ('time', time, '%H:%M:%S.%f'),
+)
+
+
+def _sortKey(entity, orders):
+    """Return the values an entity is sorted by; like the datastore, an
+    ascending sort on a repeated property uses its smallest value."""
+    values = []
+    for name in orders:
+        value = getattr(entity, name)
+        if isinstance(value, list):
+            value = min(value) if value else None
+        values.append(value)
+    return values
+
+
+def _encodeValue(value):
+    for tag, kind, fmt in _TEMPORAL_FORMATS:
+        if isinstance(value, kind):
+            return {tag: value.strftime(fmt)}
+    return value
+
+
+def _decodeValue(value):
+    if isinstance(value, dict):
+        for tag, kind, fmt in _TEMPORAL_FORMATS:
+            if tag in value:
+                parsed = datetime.strptime(value[tag], fmt)
+                if kind is date:
+                    return parsed.date()
+                if kind is time:
+                    return parsed.time()
+                return parsed
+    return value
+
+
+def _encodeToken(states, last):
+    return base64.urlsafe_b64encode(json.dumps({
+        'queries': states,
+        'last': [[_encodeValue(v) for v in last[0]], last[1].urlsafe()]
+        if last else None}))
+
+
+def _decodeToken(pageToken, count):
+    """Return the states of the subqueries & the last position of a page
+    token; raises ValueError if it is invalid."""
+    if not pageToken:
+        return [[None, 0]] * count, None
+    try:
+        token = json.loads(base64.urlsafe_b64decode(str(pageToken)))
+        states = token['queries']
+        last = token['last']
+        if last:
+            last = ([_decodeValue(v) for v in last[0]],
+                    ndb.Key(urlsafe=last[1]))
+    except Exception:
+        raise ValueError('Invalid page token: %s' % pageToken)
+    if len(states) != count:
+        raise ValueError('Invalid page token: %s' % pageToken)
+    return states, last
+
+
+def mergeQueries(queries, orders, pageSize=None, pageToken=None):
+    """Run queries concurrently & merge their results without duplicates.
+
+    args:
+        queries: the subqueries, all sorted by orders and key.
+        orders: names of the properties the subqueries are sorted by.
+        pageSize: maximum number of results, None for all of them.
+        pageToken: token of the page to return, None for the first one.
+    returns:
+        entities: the merged results of the page.
+        nextPageToken: token of the next page or None if this is the last
+            page.
+    raises:
+        ValueError if the page token is invalid.
+    """
+    states, last = _decodeToken(pageToken, len(queries))
+    futures = []
+    for query, state in zip(queries, states):
+        if state is None:
+            # exhausted on an earlier page
+            futures.append(None)
+        elif pageSize:
+            cursor = Cursor(urlsafe=state[0]) if state[0] else None
+            futures.append(query.fetch_page_async(
+                pageSize, start_cursor=cursor, offset=state[1]))
+        else:
+            futures.append(query.fetch_async())
+
+    results, more, cursors = [], [], []
+    for future in futures:
+        if future is None:
+            results.append([])
+            more.append(False)
+            cursors.append(None)
+        elif pageSize:
+            entities, next_cursor, has_more = future.get_result()
+            results.append(entities)
+            more.append(bool(has_more and next_cursor))
+            cursors.append(next_cursor)
+        else:
+            results.append(future.get_result())
+            more.append(False)
+            cursors.append(None)
+
+    # every entry is unique by subquery & position, so entities are never
+    # compared
+    merged = heapq.merge(*[
+        [(_sortKey(entity, orders), entity.key, i, position, entity)
+         for position, entity in enumerate(entities)]
+        for i, entities in enumerate(results)])
+    page = []
+    consumed = [0] * len(queries)
+    for values, key, i, position, entity in merged:
+        if pageSize and len(page) >= pageSize and key != last[1]:
+            break
+        consumed[i] = position + 1
+        if not last or (values, key) > last:
+            page.append(entity)
+            last = (values, key)
+        # the next results of this subquery haven't been fetched yet, so
+        # results of other subqueries can't be merged beyond this one
+        if consumed[i] == len(results[i]) and more[i]:
+            break
+
+    if not pageSize:
+        return page, None
+    nextStates = []
+    for state, entities, hasMore, cursor, count in zip(
+            states, results, more, cursors, consumed):
+        if state is None or (count == len(entities) and not hasMore):
+            nextStates.append(None)
+        elif count == len(entities):
+            nextStates.append([cursor.urlsafe(), 0])
+        else:
+            nextStates.append([state[0], state[1] + count])
+    if not any(nextStates):
+        return page, None
+    return page, _encodeToken(nextStates, last)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""ndbrepository.py
+
+Udacity conference server-side Python App Engine datastore repository
+
+The Repository of repository.py on the datastore. Ids are ndb keys.
+
+$Id$
+"""
+
+# third-party modules
+from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+# own modules
+from models import Conference
+from models import Profile
+from models import Registration
+from models import Session
+from multiquery import mergeQueries
+from repository import Repository
+from repository import expandFilters
+
+
+class NdbRepository(Repository):
+    """NdbRepository -- reads of the API on the datastore"""
+
+    def queryConferences(self, filters, pageSize=None, pageToken=None):
+        inequalities = [filtr['field'] for filtr in filters
+                        if filtr['operator'] not in ('=', 'IN')]
+        orders = inequalities[:1] + ['name']
+        # IN and != filters are run as concurrent subqueries, which are
+        # merged in the order of the query
+        queries = []
+        for subquery in expandFilters(filters):
+            q = Conference.query()
+            for filtr in subquery:
+                q = q.filter(ndb.query.FilterNode(
+                    filtr['field'], filtr['operator'], filtr['value']))
+            # the datastore requires sorting on the inequality filter first
+            for name in orders:
+                q = q.order(ndb.GenericProperty(name))
+            queries.append(q)
+        return mergeQueries(queries, orders, pageSize, pageToken)
+
+    def organizerNames(self, userIds):
+        profiles = ndb.get_multi([ndb.Key(Profile, userId)
+                                  for userId in set(userIds)])
+        return dict((prof.key.id(), prof.displayName)
+                    for prof in profiles if prof)
+
+    def conferenceSessions(self, conferenceId, typesOfSession=None,
+                           speakerId=None):
+        q = Session.query(ancestor=conferenceId)
+        if speakerId:
+            q = q.filter(Session.speakers == speakerId)
+        if not typesOfSession:
+            return q.fetch()
+        # one concurrent subquery per type, merged in key order
+        return mergeQueries([q.filter(Session.typeOfSession == typeOfSession)
+                             for typeOfSession in typesOfSession], [])[0]
+
+    def speakerSessions(self, speakerId):
+        return Session.query(Session.speakers == speakerId).fetch()
+
+    def speakerNames(self, speakerIds):
+        return dict((spk.key, spk.name)
+                    for spk in ndb.get_multi(speakerIds) if spk)
+
+    def attendees(self, conferenceId, pageSize, pageToken=None):
+        cursor = None
+        if pageToken:
+            try:
+                cursor = Cursor(urlsafe=pageToken)
+            except Exception:
+                raise ValueError('Invalid page token: %s' % pageToken)
+        # keys-only query in the order of registration; the parents of the
+        # registrations are the attendees' profiles
+        r_keys, next_cursor, more = Registration.query(
+            Registration.conference == conferenceId).order(
+            Registration.created).fetch_page(
+            pageSize, start_cursor=cursor, keys_only=True)
+        profiles = ndb.get_multi([r_key.parent() for r_key in r_keys])
+        nextPageToken = next_cursor.urlsafe() if more and next_cursor else None
+        return [prof for prof in profiles if prof], nextPageToken
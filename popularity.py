@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+"""popularity.py
+
+Udacity conference server-side Python App Engine session popularity
+
+Counts how often each session has been put on a wishlist. The count of a
+session is split over NUM_SHARDS SessionPopularityShard root entities, so
+concurrent wishlist additions rarely write the same entity group; a random
+shard is incremented in the transaction adding the session to the wishlist.
+
+Per conference, the LEADERBOARD_SIZE most wishlisted sessions are kept in
+memcache and updated incrementally after every addition with
+compare-and-set. If the leaderboard got evicted it is rebuilt from the shards
+of the conference on the next read.
+
+$Id$
+"""
+
+# built-in modules
+import random
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+# own modules
+from models import SessionPopularityShard
+
+NUM_SHARDS = 10
+LEADERBOARD_SIZE = 20
+MEMCACHE_CAS_RETRIES = 5
+# total count of a session & leaderboard of a conference
+MEMCACHE_POPULARITY_KEY = "POPULARITY:%s"
+MEMCACHE_LEADERBOARD_KEY = "POPULAR:%s"
+
+
+def _shardKeys(s_key):
+    wssk = s_key.urlsafe()
+    return [ndb.Key(SessionPopularityShard, '%s-%d' % (wssk, index))
+            for index in range(NUM_SHARDS)]
+
+
+def incrementPopularity(sess):
+    """Count a wishlist addition of a session. Meant to be called within the
+    transaction adding the session, which must be cross-group; the
+    leaderboard is updated once the transaction commits."""
+    shard_key = random.choice(_shardKeys(sess.key))
+    shard = shard_key.get() or SessionPopularityShard(
+        key=shard_key, session=sess.key, conference=sess.key.parent())
+    shard.count += 1
+    shard.put()
+    ndb.get_context().call_on_commit(lambda: _updateLeaderboard(sess))
+
+
+def _countFromShards(s_key):
+    return sum(shard.count for shard in ndb.get_multi(_shardKeys(s_key))
+               if shard)
+
+
+def _sessionCount(s_key):
+    """Increment the cached total count of a session and return it; loads
+    it from the shards, which include the new addition, if not cached."""
+    cacheKey = MEMCACHE_POPULARITY_KEY % s_key.urlsafe()
+    count = memcache.incr(cacheKey)
+    if count is None:
+        count = _countFromShards(s_key)
+        if not memcache.add(cacheKey, count):
+            # loaded concurrently; the other count includes ours as well
+            count = memcache.get(cacheKey) or count
+    return count
+
+
+def _updateLeaderboard(sess):
+    """Move a session up the leaderboard of its conference."""
+    count = _sessionCount(sess.key)
+    wssk = sess.key.urlsafe()
+    cacheKey = MEMCACHE_LEADERBOARD_KEY % sess.key.parent().urlsafe()
+    client = memcache.Client()
+    for _ in range(MEMCACHE_CAS_RETRIES):
+        board = client.gets(cacheKey)
+        if board is None:
+            # evicted; it is rebuilt from the shards when read
+            return
+        board = [entry for entry in board if entry[0] != wssk]
+        if len(board) >= LEADERBOARD_SIZE and count <= board[-1][2]:
+            return
+        board.append([wssk, sess.name, count])
+        board.sort(key=lambda entry: -entry[2])
+        if client.cas(cacheKey, board[:LEADERBOARD_SIZE]):
+            return
+    # too much contention; rebuild it on the next read
+    memcache.delete(cacheKey)
+
+
+def getLeaderboard(c_key):
+    """Return the most wishlisted sessions of a conference as list of
+    [websafeSessionKey, name, count], most popular first."""
+    cacheKey = MEMCACHE_LEADERBOARD_KEY % c_key.urlsafe()
+    board = memcache.get(cacheKey)
+    if board is not None:
+        return board
+    counts = {}
+    for shard in SessionPopularityShard.query(
+            SessionPopularityShard.conference == c_key):
+        counts[shard.session] = counts.get(shard.session, 0) + shard.count
+    top = sorted(counts, key=lambda s_key: -counts[s_key])[:LEADERBOARD_SIZE]
+    board = [[s_key.urlsafe(), sess.name, counts[s_key]]
+             for s_key, sess in zip(top, ndb.get_multi(top)) if sess]
+    memcache.add(cacheKey, board)
+    return board
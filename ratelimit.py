@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+"""ratelimit.py
+
+Udacity conference server-side Python App Engine rate limiting
+
+Limits how often a client may call an API method. Every client, i.e. the
+logged in user or else the remote address, has a token bucket per method
+holding up to `limit` requests, refilled continuously at `limit` requests
+per `seconds`. So a client can make a burst of at most `limit` requests,
+and never more than `limit` plus the refill in any window of `seconds`. The
+limits are read from settings.RATE_LIMITS by method name, unless
+settings.RATE_LIMIT_OVERRIDES has one for the client.
+
+The bucket is a (tokens, timestamp) pair in memcache, named after the method
+and the client. A request refills it for the time passed since the
+timestamp and takes a token with compare-and-set, retrying if a concurrent
+request of the client changed it meanwhile. A full bucket is the same as a
+missing one, so buckets expire once they would have been refilled. If
+memcache is unavailable requests aren't limited.
+
+    @endpoints.method(...)
+    @rateLimited
+    def queryConferences(self, request):
+
+Endpoints can't set response headers, so instead of a Retry-After header
+the message of the 429 error tells the client when the next token is due.
+
+$Id$
+"""
+
+# built-in modules
+import functools
+import math
+import time
+# third-party modules
+import endpoints
+from google.appengine.api import memcache
+# own modules
+from models import TooManyRequestsException
+from settings import RATE_LIMIT_OVERRIDES
+from settings import RATE_LIMITS
+
+MEMCACHE_RATE_KEY = "RATE:%s:%s"
+# compare-and-set attempts before a request of a busy client is let through
+CAS_RETRIES = 3
+
+
+def takeToken(name, client, limit, seconds):
+    """Take a request from the bucket of a client for an API method.
+
+    args:
+        name: name of the API method.
+        client: id of the client.
+        limit: size of the bucket.
+        seconds: time to refill an empty bucket.
+    raises:
+        TooManyRequestsException if the bucket is empty.
+    """
+    key = MEMCACHE_RATE_KEY % (name, client)
+    rate = float(limit) / seconds
+    cache = memcache.Client()
+    for _ in range(CAS_RETRIES):
+        now = time.time()
+        bucket = cache.gets(key)
+        if bucket is None:
+            # a full bucket, less this request
+            if cache.add(key, (limit - 1, now), time=seconds):
+                return
+            continue
+        tokens, timestamp = bucket
+        tokens = min(limit, tokens + (now - timestamp) * rate)
+        if tokens < 1:
+            wait = max(1, int(math.ceil((1 - tokens) / rate)))
+            raise TooManyRequestsException(
+                'Rate limit of %d requests per %d seconds exceeded; retry '
+                'in %d seconds.' % (limit, seconds, wait))
+        if cache.cas(key, (tokens - 1, now), time=seconds):
+            return
+
+
+def getLimit(name, client):
+    """Return the (limit, seconds) of a client for an API method, or None
+    if its calls aren't limited."""
+    overrides = RATE_LIMIT_OVERRIDES.get(client, {})
+    if name in overrides:
+        return overrides[name]
+    return RATE_LIMITS.get(name)
+
+
+def rateLimited(method):
+    """Decorate a method of the ConferenceApi to limit the calls of each
+    client as configured in settings."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        if endpoints.get_current_user():
+            client = self._getUserId()
+        else:
+            client = 'ip:%s' % self.request_state.remote_address
+        limit = getLimit(method.__name__, client)
+        if limit:
+            takeToken(method.__name__, client, *limit)
+        return method(self, request)
+    return wrapper
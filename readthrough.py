@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+"""readthrough.py
+
+Udacity conference server-side Python App Engine read-through memcache
+
+Values which are expensive to compute, like the featured speakers of a
+conference or the announcement, are read through memcache: on a miss only the
+request taking a short lease recomputes the value, while concurrent requests
+get the last known value instead of recomputing it as well. The last known
+value is kept in memcache under a separate stale key and in the memory of the
+instance, so it usually survives the eviction of the value itself.
+
+Writers must store values with setValue, so the stale copies stay current.
+
+$Id$
+"""
+
+# built-in modules
+import time
+# third-party modules
+from google.appengine.api import memcache
+
+MEMCACHE_STALE_KEY = "STALE:%s"
+MEMCACHE_LEASE_KEY = "LEASE:%s"
+# a lease expires after LEASE_SECONDS, if its holder died while recomputing
+LEASE_SECONDS = 10
+# without a stale value, wait up to LEASE_WAIT_RETRIES * LEASE_WAIT_SECONDS
+# for the lease holder before recomputing the value as well
+LEASE_WAIT_RETRIES = 5
+LEASE_WAIT_SECONDS = 0.1
+MEMORY_MAX_ENTRIES = 1000
+_memory = {}
+
+
+def _remember(key, value):
+    if len(_memory) >= MEMORY_MAX_ENTRIES:
+        _memory.clear()
+    _memory[key] = value
+
+
+def setValue(key, value):
+    """Store a value and its stale copies."""
+    memcache.set_multi({key: value, MEMCACHE_STALE_KEY % key: value})
+    _remember(key, value)
+
+
+def setStale(key, value):
+    """Update the stale copies of a value stored with compare-and-set."""
+    memcache.set(MEMCACHE_STALE_KEY % key, value)
+    _remember(key, value)
+
+
+def getValue(key, compute, cached=None):
+    """Return the value of a memcache key, computed on a miss.
+
+    args:
+        key: memcache key of the value.
+        compute: function computing & returning the value.
+        cached: the value of the key, if it has been read already.
+    returns:
+        value: the cached, last known or freshly computed value.
+    """
+    value = memcache.get(key) if cached is None else cached
+    if value is not None:
+        _remember(key, value)
+        return value
+    leaseKey = MEMCACHE_LEASE_KEY % key
+    leased = memcache.add(leaseKey, True, time=LEASE_SECONDS)
+    if not leased:
+        # recomputed by another request; serve the last known value
+        value = _memory.get(key)
+        if value is None:
+            value = memcache.get(MEMCACHE_STALE_KEY % key)
+        for _ in range(LEASE_WAIT_RETRIES):
+            if value is not None:
+                break
+            time.sleep(LEASE_WAIT_SECONDS)
+            value = memcache.get(key)
+        if value is not None:
+            return value
+    try:
+        value = compute()
+        setValue(key, value)
+    finally:
+        if leased:
+            memcache.delete(leaseKey)
+    return value
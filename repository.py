@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""repository.py
+
+Udacity conference server-side Python App Engine storage repository
+
+The conference, session, speaker and profile reads of the API which have to
+scale with the amount of data go through a Repository, so they can be load
+tested on a local SQLite database (sqliterepository.py, used by benchmark.py
+only) as well as run on the datastore (ndbrepository.py). A Repository only
+reads records; the algorithms working on them, like the featured speaker
+aggregation, live in this base class and are shared by all backends.
+
+Records are the entities of the backend, which have the attributes of the
+models: conferences name, city, topics, month, maxAttendees and
+organizerUserId, sessions name, typeOfSession and speakers, speakers name and
+profiles displayName and mainEmail. Ids are opaque to the callers: keys for
+ndb, integers for SQLite. The API relies on the keys of ndb records, so it
+always uses the NdbRepository.
+
+This module doesn't depend on App Engine, so the SQLite backend and the
+benchmark (benchmark.py) run without the SDK.
+
+$Id$
+"""
+
+# built-in modules
+import abc
+
+# fields of the conference filters & the fields with integer values
+CONFERENCE_FIELDS = ('city', 'topics', 'month', 'maxAttendees')
+INTEGER_FIELDS = ('month', 'maxAttendees')
+OPERATORS = ('=', '>', '>=', '<', '<=', '!=', 'IN')
+# the datastore runs at most this many subqueries per query
+MAX_SUBQUERIES = 30
+
+
+class Repository(object):
+    """Repository -- reads of the API; subclasses implement the storage"""
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def queryConferences(self, filters, pageSize=None, pageToken=None):
+        """Return a page of the conferences matching all filters, ordered by
+        the field of the inequality filter, if any, and name, and the token
+        of the next page or None.
+
+        args:
+            filters: list of dicts with field, operator and value; the value
+                of an IN filter is a list. At most one field may have
+                inequality filters.
+            pageSize: maximum number of conferences, None for all.
+            pageToken: token of the page, None for the first one.
+        raises:
+            ValueError if the page token is invalid or the filters need too
+                many subqueries.
+        """
+
+    @abc.abstractmethod
+    def organizerNames(self, userIds):
+        """Return a dict of the display names of the given user ids."""
+
+    @abc.abstractmethod
+    def conferenceSessions(self, conferenceId, typesOfSession=None,
+                           speakerId=None):
+        """Return the sessions of a conference, optionally only those of
+        some types and/or of a speaker."""
+
+    @abc.abstractmethod
+    def speakerSessions(self, speakerId):
+        """Return the sessions of a speaker at all conferences."""
+
+    @abc.abstractmethod
+    def speakerNames(self, speakerIds):
+        """Return a dict of the names of the given speaker ids."""
+
+    @abc.abstractmethod
+    def attendees(self, conferenceId, pageSize, pageToken=None):
+        """Return a page of the profiles registered for a conference, in the
+        order they registered, and the token of the next page or None.
+
+        raises:
+            ValueError if the page token is invalid.
+        """
+
+    def featuredSpeakers(self, conferenceId):
+        """Return the speakers of more than one session of a conference as
+        list of (speaker name, names of the sessions) by speaker name, the
+        sessions in the order of conferenceSessions."""
+        sessionsBySpeaker = {}
+        for sess in self.conferenceSessions(conferenceId):
+            for speakerId in sess.speakers:
+                sessionsBySpeaker.setdefault(speakerId, []).append(sess.name)
+        featured = dict((speakerId, names) for speakerId, names in
+                        sessionsBySpeaker.items() if len(names) > 1)
+        names = self.speakerNames(list(featured))
+        return sorted((names[speakerId], featured[speakerId])
+                      for speakerId in featured if speakerId in names)
+
+
+def expandFilters(filters):
+    """Return the combinations of equality & inequality filters matching
+    the same entities as filters with IN and != operators, i.e. the
+    subqueries to run; raises ValueError if there are too many of them."""
+    subqueries = [[]]
+    for filtr in filters:
+        if filtr['operator'] == 'IN':
+            alternatives = [('=', value) for value in filtr['value']]
+        elif filtr['operator'] == '!=':
+            alternatives = [('<', filtr['value']), ('>', filtr['value'])]
+        else:
+            alternatives = [(filtr['operator'], filtr['value'])]
+        subqueries = [subquery + [dict(filtr, operator=operator, value=value)]
+                      for subquery in subqueries
+                      for operator, value in alternatives]
+        if len(subqueries) > MAX_SUBQUERIES:
+            raise ValueError('Filters need more than %d subqueries'
+                             % MAX_SUBQUERIES)
+    return subqueries
+
+
+def getRepository():
+    """Return the repository of the API, reading from the datastore."""
+    # imported here, so this module can be used without the SDK
+    from ndbrepository import NdbRepository
+    return NdbRepository()
@@ -16,3 +16,38 @@ WEB_CLIENT_ID = '248891130562-21fj46jej3hov3hlukm7118pv2e5ac0a.apps.googleuserco
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Google OAuth2 tokeninfo endpoint used by utils.getUserId(id_type="oauth");
+# can be pointed at a local stand-in for testing.
+TOKENINFO_URL = 'https://www.googleapis.com/oauth2/v1/tokeninfo'
+
+# Pull queue holding the websafe keys of newly created conferences whose
+# organizers still need a confirmation email (see queue.yaml).
+CONFIRMATION_EMAIL_QUEUE = 'confirmation-email'
+
+# Root directory of the local file store (filestore.py), the stand-in for a
+# blob store holding exported conference data.
+FILESTORE_ROOT = '/tmp/conference-filestore'
+
+# Push queue of the /tasks/index_names task maintaining the autocomplete
+# prefix index; it runs one task at a time (see queue.yaml).
+AUTOCOMPLETE_QUEUE = 'autocomplete'
+
+# Push queue of the /tasks/count_facets task maintaining the facet counts of
+# the conference filters (facets.py); it runs one task at a time.
+FACETS_QUEUE = 'facets'
+
+# Rate limits of the API methods clients poll (ratelimit.py), as (requests,
+# seconds) per client by method name; methods not listed aren't limited.
+# Each client has a token bucket of `requests` tokens refilled over
+# `seconds`: a burst is at most `requests` long, and any window of `seconds`
+# holds at most 2 * `requests` requests (a full bucket plus its refill).
+RATE_LIMITS = {
+    'queryConferences': (60, 60),
+    'getConferenceSessions': (60, 60),
+}
+# Limits of single clients, i.e. a user id or 'ip:' and a remote address,
+# taking precedence over RATE_LIMITS, e.g. for a trusted integration:
+#   {'ip:10.0.0.5': {'queryConferences': (600, 60)}}
+# A limit of None exempts the client from the method's limit.
+RATE_LIMIT_OVERRIDES = {}
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""sqliterepository.py
+
+Udacity conference server-side Python App Engine SQLite repository
+
+The Repository of repository.py on a local SQLite database, to run the reads
+of the API on millions of rows without the App Engine stack (see
+benchmark.py). Ids are integers, except for the user ids of profiles.
+Repeated properties are tables of their own and every datastore index the
+queries rely on has an SQLite counterpart, so query plans are comparable.
+
+$Id$
+"""
+
+# built-in modules
+import sqlite3
+# own modules
+from repository import CONFERENCE_FIELDS
+from repository import OPERATORS
+from repository import Repository
+
+# SQLite allows at most 999 parameters per statement
+MAX_PARAMS = 900
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conference (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, organizerUserId TEXT,
+    city TEXT, startDate TEXT, month INTEGER, endDate TEXT,
+    maxAttendees INTEGER, seatsAvailable INTEGER);
+CREATE INDEX IF NOT EXISTS conference_name ON conference (name);
+CREATE INDEX IF NOT EXISTS conference_city ON conference (city, name);
+CREATE INDEX IF NOT EXISTS conference_month ON conference (month, name);
+CREATE INDEX IF NOT EXISTS conference_maxAttendees
+    ON conference (maxAttendees, name);
+CREATE TABLE IF NOT EXISTS conference_topic (
+    conference_id INTEGER NOT NULL, topic TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS conference_topic_topic
+    ON conference_topic (topic, conference_id);
+CREATE INDEX IF NOT EXISTS conference_topic_conference
+    ON conference_topic (conference_id);
+CREATE TABLE IF NOT EXISTS speaker (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS session (
+    id INTEGER PRIMARY KEY, conference_id INTEGER NOT NULL,
+    name TEXT NOT NULL, typeOfSession TEXT, date TEXT, startTime TEXT);
+CREATE INDEX IF NOT EXISTS session_conference
+    ON session (conference_id, typeOfSession);
+CREATE TABLE IF NOT EXISTS session_speaker (
+    session_id INTEGER NOT NULL, speaker_id INTEGER NOT NULL,
+    position INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS session_speaker_session
+    ON session_speaker (session_id, position);
+CREATE INDEX IF NOT EXISTS session_speaker_speaker
+    ON session_speaker (speaker_id, session_id);
+CREATE TABLE IF NOT EXISTS profile (
+    userId TEXT PRIMARY KEY, displayName TEXT, mainEmail TEXT);
+CREATE TABLE IF NOT EXISTS registration (
+    profile_id TEXT NOT NULL, conference_id INTEGER NOT NULL,
+    created REAL NOT NULL, PRIMARY KEY (profile_id, conference_id));
+CREATE INDEX IF NOT EXISTS registration_conference
+    ON registration (conference_id, created, profile_id);
+"""
+
+
+class Record(object):
+    """Record -- a row with the attributes of the model"""
+
+    def __init__(self, **fields):
+        self.__dict__.update(fields)
+
+
+def _chunks(values):
+    values = list(values)
+    for i in range(0, len(values), MAX_PARAMS):
+        yield values[i:i + MAX_PARAMS]
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+class SqliteRepository(Repository):
+    """SqliteRepository -- reads of the API on a SQLite database"""
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.row_factory = sqlite3.Row
+
+    def createSchema(self):
+        """Create the tables & indexes if they don't exist yet."""
+        self.db.executescript(SCHEMA)
+
+    def insert(self, table, rows):
+        """Insert rows, i.e. tuples of all columns, into a table."""
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return
+        self.db.execute('INSERT INTO %s VALUES (%s)' % (
+            table, _placeholders(first)), first)
+        self.db.executemany('INSERT INTO %s VALUES (%s)' % (
+            table, _placeholders(first)), rows)
+        self.db.commit()
+
+    def _selectIn(self, sql, values, *params):
+        """Yield the rows of a query with an IN list of values, split into
+        statements of at most MAX_PARAMS values."""
+        for chunk in _chunks(values):
+            for row in self.db.execute(sql % _placeholders(chunk),
+                                       params + tuple(chunk)):
+                yield row
+
+    def queryConferences(self, filters, pageSize=None, pageToken=None):
+        offset = 0
+        if pageToken:
+            try:
+                offset = int(pageToken)
+            except ValueError:
+                raise ValueError('Invalid page token: %s' % pageToken)
+        where, params = [], []
+        inequality = None
+        for filtr in filters:
+            field, operator = filtr['field'], filtr['operator']
+            # field & operator go into the statement, so only known ones
+            if field not in CONFERENCE_FIELDS or operator not in OPERATORS:
+                raise ValueError('Invalid filter: %s %s' % (field, operator))
+            values = [filtr['value']]
+            condition = '%s ?' % operator
+            if operator == 'IN':
+                values = list(filtr['value'])
+                condition = 'IN (%s)' % _placeholders(values)
+            if field == 'topics':
+                # like the datastore, match any of the repeated values
+                where.append('EXISTS (SELECT 1 FROM conference_topic t '
+                             'WHERE t.conference_id = c.id '
+                             'AND t.topic %s)' % condition)
+            else:
+                where.append('c.%s %s' % (field, condition))
+            params.extend(values)
+            if operator not in ('=', 'IN'):
+                inequality = field
+        order = 'c.name, c.id'
+        # conferences with an inequality on topics are ordered by name only
+        if inequality and inequality != 'topics':
+            order = 'c.%s, %s' % (inequality, order)
+        sql = 'SELECT c.* FROM conference c'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + order
+        if pageSize:
+            # one more row tells whether there is a next page
+            sql += ' LIMIT %d OFFSET %d' % (pageSize + 1, offset)
+        rows = self.db.execute(sql, params).fetchall()
+        nextPageToken = None
+        if pageSize and len(rows) > pageSize:
+            rows = rows[:pageSize]
+            nextPageToken = str(offset + pageSize)
+        confs = [Record(topics=[], **dict(zip(row.keys(), row)))
+                 for row in rows]
+        byId = dict((conf.id, conf) for conf in confs)
+        for row in self._selectIn(
+                'SELECT conference_id, topic FROM conference_topic '
+                'WHERE conference_id IN (%s)', list(byId)):
+            byId[row[0]].topics.append(row[1])
+        return confs, nextPageToken
+
+    def organizerNames(self, userIds):
+        return dict(self._selectIn(
+            'SELECT userId, displayName FROM profile WHERE userId IN (%s)',
+            set(userIds)))
+
+    def _sessions(self, sql, params):
+        """Return the sessions of a query with their speakers."""
+        sessions = [Record(speakers=[], **dict(zip(row.keys(), row)))
+                    for row in self.db.execute(sql, params)]
+        byId = dict((sess.id, sess) for sess in sessions)
+        for row in self._selectIn(
+                'SELECT session_id, speaker_id FROM session_speaker '
+                'WHERE session_id IN (%s) ORDER BY session_id, position',
+                list(byId)):
+            byId[row[0]].speakers.append(row[1])
+        return sessions
+
+    def conferenceSessions(self, conferenceId, typesOfSession=None,
+                           speakerId=None):
+        sql = 'SELECT s.* FROM session s WHERE s.conference_id = ?'
+        params = [conferenceId]
+        if typesOfSession:
+            sql += ' AND s.typeOfSession IN (%s)' % _placeholders(
+                typesOfSession)
+            params.extend(typesOfSession)
+        if speakerId:
+            sql += (' AND EXISTS (SELECT 1 FROM session_speaker ss '
+                    'WHERE ss.session_id = s.id AND ss.speaker_id = ?)')
+            params.append(speakerId)
+        return self._sessions(sql + ' ORDER BY s.id', params)
+
+    def speakerSessions(self, speakerId):
+        return self._sessions(
+            'SELECT s.* FROM session s JOIN session_speaker ss '
+            'ON ss.session_id = s.id WHERE ss.speaker_id = ? '
+            'ORDER BY s.id', [speakerId])
+
+    def speakerNames(self, speakerIds):
+        return dict(self._selectIn(
+            'SELECT id, name FROM speaker WHERE id IN (%s)', speakerIds))
+
+    def attendees(self, conferenceId, pageSize, pageToken=None):
+        # keyset pagination on (created, profile_id), the token being the
+        # last row of the previous page
+        sql = ('SELECT p.*, r.created, r.profile_id FROM registration r '
+               'JOIN profile p ON p.userId = r.profile_id '
+               'WHERE r.conference_id = ?')
+        params = [conferenceId]
+        if pageToken:
+            try:
+                created, profileId = pageToken.split('|', 1)
+                created = float(created)
+            except ValueError:
+                raise ValueError('Invalid page token: %s' % pageToken)
+            sql += (' AND (r.created > ? OR '
+                    '(r.created = ? AND r.profile_id > ?))')
+            params.extend([created, created, profileId])
+        sql += ' ORDER BY r.created, r.profile_id LIMIT %d' % (pageSize + 1)
+        rows = self.db.execute(sql, params).fetchall()
+        nextPageToken = None
+        if len(rows) > pageSize:
+            rows = rows[:pageSize]
+            nextPageToken = '%r|%s' % (rows[-1]['created'],
+                                       rows[-1]['profile_id'])
+        return ([Record(**dict(zip(row.keys(), row))) for row in rows],
+                nextPageToken)
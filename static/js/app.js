@@ -130,3 +130,172 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+
+/**
+ * @ngdoc service
+ * @name conditionalApi
+ *
+ * @description
+ * Service that remembers the last response of the conference read methods, keyed by method and parameters.
+ * If a response has an entity tag, it is sent back with the next call of the same method, so the server can
+ * answer with a "not modified" response instead of the full payload.
+ * Cached responses can also be served right away while they are revalidated in the background
+ * (stale-while-revalidate); methods changing data invalidate the responses they affect.
+ *
+ */
+app.factory('conditionalApi', function () {
+    var conditionalApi = {};
+
+    /**
+     * Cached responses younger than this many milliseconds are served without revalidating them.
+     * @type {number}
+     */
+    var FRESH_MILLIS = 5000;
+
+    /**
+     * Holds the last response and the time it was received per method and parameters.
+     * @type {{}}
+     */
+    var responses = {};
+
+    /**
+     * Counts the invalidations, so responses of calls started before an invalidation aren't cached.
+     * @type {number}
+     */
+    var generation = 0;
+
+    var cacheKey = function (method, params) {
+        return method + ':' + JSON.stringify(params || {});
+    };
+
+    /**
+     * Invokes a conference API method, sending the entity tag of the cached response if there is one.
+     *
+     * @param {string} method the name of the conference API method, e.g. 'getConference'.
+     * @param {Object} params the parameters of the method.
+     * @param {Function} callback called with the fresh or, if not modified, the cached response.
+     */
+    conditionalApi.execute = function (method, params, callback) {
+        var key = cacheKey(method, params);
+        var cached = responses[key];
+        var started = generation;
+        var request = angular.extend({}, params);
+        if (cached && cached.resp.result && cached.resp.result.etag) {
+            // The discovery based client can't set the If-None-Match header, so it is sent as parameter.
+            request.ifNoneMatch = cached.resp.result.etag;
+        }
+        gapi.client.conference[method](request).execute(function (resp) {
+            if (!resp.error && resp.result && resp.result.notModified && cached) {
+                cached.time = new Date().getTime();
+                callback(cached.resp);
+                return;
+            }
+            if (!resp.error && started == generation) {
+                responses[key] = {resp: resp, time: new Date().getTime()};
+            }
+            callback(resp);
+        });
+    };
+
+    /**
+     * Invokes a conference API method, serving a cached response right away if there is one.
+     * A cached response which isn't fresh anymore is revalidated in the background; the callback is
+     * called a second time if the revalidated response differs from the cached one.
+     *
+     * @param {string} method the name of the conference API method, e.g. 'queryConferences'.
+     * @param {Object} params the parameters of the method.
+     * @param {Function} callback called with the cached and/or the fresh response.
+     */
+    conditionalApi.cached = function (method, params, callback) {
+        var cached = responses[cacheKey(method, params)];
+        if (!cached) {
+            conditionalApi.execute(method, params, callback);
+            return;
+        }
+        // Call back asynchronously like the API client, so callers can use $scope.$apply.
+        setTimeout(function () {
+            callback(cached.resp);
+        }, 0);
+        if (new Date().getTime() - cached.time < FRESH_MILLIS) {
+            return;
+        }
+        conditionalApi.execute(method, params, function (resp) {
+            // The cached response has been shown already, so failed revalidations are ignored.
+            if (!resp.error && !angular.equals(resp.result, cached.resp.result)) {
+                callback(resp);
+            }
+        });
+    };
+
+    /**
+     * Drops the cached responses of the given methods, or of all methods if none are given.
+     *
+     * @param {...string} methods the names of the conference API methods.
+     */
+    conditionalApi.invalidate = function () {
+        var methods = Array.prototype.slice.call(arguments);
+        generation++;
+        angular.forEach(Object.keys(responses), function (key) {
+            if (methods.length == 0 || methods.indexOf(key.split(':')[0]) >= 0) {
+                delete responses[key];
+            }
+        });
+    };
+
+    return conditionalApi;
+});
+
+
+/**
+ * @ngdoc service
+ * @name autocomplete
+ *
+ * @description
+ * Service that returns city, topic and speaker name suggestions for a typeahead.
+ * Suggestions are remembered per field and prefix, so retyping a prefix doesn't call the API again.
+ *
+ */
+app.factory('autocomplete', function ($q, $rootScope) {
+    var autocomplete = {};
+
+    /**
+     * Holds the suggestions per field and lower case prefix.
+     * @type {{}}
+     */
+    var suggestions = {};
+
+    /**
+     * Returns a promise of the names of a field starting with a prefix.
+     *
+     * @param {string} field 'CITY', 'TOPIC' or 'SPEAKER'; other fields have no suggestions.
+     * @param {string} prefix the text typed so far.
+     * @returns {Promise} resolved with an array of names.
+     */
+    autocomplete.suggest = function (field, prefix) {
+        var deferred = $q.defer();
+        if (['CITY', 'TOPIC', 'SPEAKER'].indexOf(field) < 0 || !prefix) {
+            deferred.resolve([]);
+            return deferred.promise;
+        }
+        var cacheKey = field + ':' + prefix.toLowerCase();
+        if (suggestions[cacheKey]) {
+            deferred.resolve(suggestions[cacheKey]);
+            return deferred.promise;
+        }
+        gapi.client.conference.getSuggestions({field: field, prefix: prefix}).
+            execute(function (resp) {
+                $rootScope.$apply(function () {
+                    if (resp.error) {
+                        deferred.resolve([]);
+                        return;
+                    }
+                    suggestions[cacheKey] = resp.result.items || [];
+                    deferred.resolve(suggestions[cacheKey]);
+                });
+            });
+        return deferred.promise;
+    };
+
+    return autocomplete;
+});
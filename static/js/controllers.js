@@ -25,7 +25,7 @@ conferenceApp.controllers = angular.module('conferenceControllers', ['ui.bootstr
  * A controller used for the My Profile page.
  */
 conferenceApp.controllers.controller('MyProfileCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, HTTP_ERRORS, conditionalApi) {
         $scope.submitted = false;
         $scope.loading = false;
 
@@ -111,6 +111,9 @@ conferenceApp.controllers.controller('MyProfileCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            // The display name is shown as organizer of the listed conferences.
+                            conditionalApi.invalidate('queryConferences', 'getConferencesCreated',
+                                'getConferencesToAttend');
                             $scope.messages = 'The profile has been updated';
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -135,7 +138,7 @@ conferenceApp.controllers.controller('MyProfileCtrl',
  * A controller used for the Create conferences page.
  */
 conferenceApp.controllers.controller('CreateConferenceCtrl',
-    function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+    function ($scope, $log, oauth2Provider, HTTP_ERRORS, autocomplete, conditionalApi) {
 
         /**
          * The conference object being edited in the page.
@@ -143,18 +146,6 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
          */
         $scope.conference = $scope.conference || {};
 
-        /**
-         * Holds the default values for the input candidates for city select.
-         * @type {string[]}
-         */
-        $scope.cities = [
-            'Chicago',
-            'London',
-            'Paris',
-            'San Francisco',
-            'Tokyo'
-        ];
-
         /**
          * Holds the default values for the input candidates for topics select.
          * @type {string[]}
@@ -167,6 +158,23 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
             'Health and Nutrition'
         ];
 
+        /**
+         * Returns a promise of the city or topic names starting with the typed text.
+         */
+        $scope.suggest = autocomplete.suggest;
+
+        /**
+         * Adds a topic picked from the suggestions to the candidates and selects it.
+         * @param topic the picked topic.
+         */
+        $scope.addTopic = function (topic) {
+            if ($scope.topics.indexOf(topic) < 0) {
+                $scope.topics.push(topic);
+            }
+            $scope.conference.topics = ($scope.conference.topics || []).concat([topic]);
+            $scope.newTopic = '';
+        };
+
         /**
          * Tests if the arugment is an integer and not negative.
          * @returns {boolean} true if the argument is an integer, false otherwise.
@@ -231,6 +239,7 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
                             }
                         } else {
                             // The request has succeeded.
+                            conditionalApi.invalidate('queryConferences', 'getConferencesCreated');
                             $scope.messages = 'The conference has been created : ' + resp.result.name;
                             $scope.alertStatus = 'success';
                             $scope.submitted = false;
@@ -249,7 +258,8 @@ conferenceApp.controllers.controller('CreateConferenceCtrl',
  * @description
  * A controller used for the Show conferences page.
  */
-conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $log, oauth2Provider, HTTP_ERRORS,
+                                                                     autocomplete, conditionalApi) {
 
     /**
      * Holds the status if the query is being executed.
@@ -266,6 +276,11 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.filters = [
     ];
 
+    /**
+     * Returns a promise of the names of the filtered field starting with the typed value.
+     */
+    $scope.suggest = autocomplete.suggest;
+
     $scope.filtereableFields = [
         {enumValue: 'CITY', displayName: 'City'},
         {enumValue: 'TOPIC', displayName: 'Topic'},
@@ -293,6 +308,12 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.conferences = [];
 
+    /**
+     * Holds the number of conferences per value of the filterable fields, by field enumValue.
+     * @type {Object}
+     */
+    $scope.facets = {};
+
     /**
      * Holds the state if offcanvas is enabled.
      *
@@ -390,6 +411,24 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
         })
     };
 
+    /**
+     * Adds an equality filter on the value of a facet and queries the conferences.
+     *
+     * @param facet the facet, having the field enumValue, value and count.
+     */
+    $scope.addFacetFilter = function (facet) {
+        for (var i = 0; i < $scope.filtereableFields.length; i++) {
+            if ($scope.filtereableFields[i].enumValue == facet.field) {
+                $scope.filters.push({
+                    field: $scope.filtereableFields[i],
+                    operator: $scope.operators[0],
+                    value: facet.value
+                });
+            }
+        }
+        $scope.queryConferences();
+    };
+
     /**
      * Clears all filters.
      */
@@ -441,31 +480,40 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
             }
         }
         $scope.loading = true;
-        gapi.client.conference.queryConferences(sendFilters).
-            execute(function (resp) {
-                $scope.$apply(function () {
-                    $scope.loading = false;
-                    if (resp.error) {
-                        // The request has failed.
-                        var errorMessage = resp.error.message || '';
-                        $scope.messages = 'Failed to query conferences : ' + errorMessage;
-                        $scope.alertStatus = 'warning';
-                        $log.error($scope.messages + ' filters : ' + JSON.stringify(sendFilters));
-                    } else {
-                        // The request has succeeded.
-                        $scope.submitted = false;
-                        $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
-                        $scope.alertStatus = 'success';
-                        $log.info($scope.messages);
+        // Cached results are shown right away and revalidated in the background.
+        conditionalApi.cached('queryConferences', sendFilters, function (resp) {
+            $scope.$apply(function () {
+                if ($scope.selectedTab != 'ALL') {
+                    // The user has switched tabs meanwhile.
+                    return;
+                }
+                $scope.loading = false;
+                if (resp.error) {
+                    // The request has failed.
+                    var errorMessage = resp.error.message || '';
+                    $scope.messages = 'Failed to query conferences : ' + errorMessage;
+                    $scope.alertStatus = 'warning';
+                    $log.error($scope.messages + ' filters : ' + JSON.stringify(sendFilters));
+                } else {
+                    // The request has succeeded.
+                    $scope.submitted = false;
+                    $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
+                    $scope.alertStatus = 'success';
+                    $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
-                    }
-                    $scope.submitted = true;
-                });
+                    $scope.conferences = [];
+                    angular.forEach(resp.items, function (conference) {
+                        $scope.conferences.push(conference);
+                    });
+                    $scope.facets = {};
+                    angular.forEach(resp.facets, function (facet) {
+                        $scope.facets[facet.field] = $scope.facets[facet.field] || [];
+                        $scope.facets[facet.field].push(facet);
+                    });
+                }
+                $scope.submitted = true;
             });
+        });
     }
 
     /**
@@ -473,49 +521,58 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      */
     $scope.getConferencesCreated = function () {
         $scope.loading = true;
-        gapi.client.conference.getConferencesCreated().
-            execute(function (resp) {
-                $scope.$apply(function () {
-                    $scope.loading = false;
-                    if (resp.error) {
-                        // The request has failed.
-                        var errorMessage = resp.error.message || '';
-                        $scope.messages = 'Failed to query the conferences created : ' + errorMessage;
-                        $scope.alertStatus = 'warning';
-                        $log.error($scope.messages);
-
-                        if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
-                            oauth2Provider.showLoginModal();
-                            return;
-                        }
-                    } else {
-                        // The request has succeeded.
-                        $scope.submitted = false;
-                        $scope.messages = 'Query succeeded : Conferences you have created';
-                        $scope.alertStatus = 'success';
-                        $log.info($scope.messages);
+        conditionalApi.cached('getConferencesCreated', {}, function (resp) {
+            $scope.$apply(function () {
+                if ($scope.selectedTab != 'YOU_HAVE_CREATED') {
+                    return;
+                }
+                $scope.loading = false;
+                if (resp.error) {
+                    // The request has failed.
+                    var errorMessage = resp.error.message || '';
+                    $scope.messages = 'Failed to query the conferences created : ' + errorMessage;
+                    $scope.alertStatus = 'warning';
+                    $log.error($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                    if (resp.code && resp.code == HTTP_ERRORS.UNAUTHORIZED) {
+                        oauth2Provider.showLoginModal();
+                        return;
                     }
-                    $scope.submitted = true;
-                });
+                } else {
+                    // The request has succeeded.
+                    $scope.submitted = false;
+                    $scope.messages = 'Query succeeded : Conferences you have created';
+                    $scope.alertStatus = 'success';
+                    $log.info($scope.messages);
+
+                    $scope.conferences = [];
+                    angular.forEach(resp.items, function (conference) {
+                        $scope.conferences.push(conference);
+                    });
+                }
+                $scope.submitted = true;
             });
+        });
     };
 
     /**
-     * Retrieves the conferences to attend by calling the conference.getProfile method and
-     * invokes the conference.getConference method n times where n == the number of the conferences to attend.
+     * Retrieves the conferences to attend by calling the conference.getConferencesToAttend method
+     * page by page until all of them have been loaded. Every page is served from the cache right away
+     * and replaced if its revalidation returns something else.
      */
     $scope.getConferencesAttend = function () {
-        $scope.loading = true;
-        gapi.client.conference.getConferencesToAttend().
-            execute(function (resp) {
+        var pages = [];
+        var loadPage = function (index, pageToken) {
+            var nextPageRequested = false;
+            $scope.loading = true;
+            conditionalApi.cached('getConferencesToAttend', {pageToken: pageToken}, function (resp) {
                 $scope.$apply(function () {
+                    if ($scope.selectedTab != 'YOU_WILL_ATTEND') {
+                        return;
+                    }
                     if (resp.error) {
                         // The request has failed.
+                        $scope.loading = false;
                         var errorMessage = resp.error.message || '';
                         $scope.messages = 'Failed to query the conferences to attend : ' + errorMessage;
                         $scope.alertStatus = 'warning';
@@ -527,7 +584,14 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                         }
                     } else {
                         // The request has succeeded.
-                        $scope.conferences = resp.result.items;
+                        pages[index] = resp.result.items || [];
+                        $scope.conferences = [].concat.apply([], pages);
+                        if (resp.result.nextPageToken && !nextPageRequested) {
+                            // load the next page
+                            nextPageRequested = true;
+                            loadPage(index + 1, resp.result.nextPageToken);
+                            return;
+                        }
                         $scope.loading = false;
                         $scope.messages = 'Query succeeded : Conferences you will attend (or you have attended)';
                         $scope.alertStatus = 'success';
@@ -536,6 +600,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                     $scope.submitted = true;
                 });
             });
+        };
+        loadPage(0);
     };
 });
 
@@ -547,21 +613,36 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
  * @description
  * A controller used for the conference detail page.
  */
-conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS) {
+conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $log, $routeParams, HTTP_ERRORS,
+                                                                       oauth2Provider, conditionalApi) {
     $scope.conference = {};
 
     $scope.isUserAttending = false;
 
+    /**
+     * Holds the sessions of the conference ordered by start time.
+     * @type {Array}
+     */
+    $scope.sessions = [];
+
+    /**
+     * Holds the websafe keys of the sessions on the user's wishlist.
+     * @type {{}}
+     */
+    $scope.wishlist = {};
+
     /**
      * Initializes the conference detail page.
-     * Invokes the conference.getConference method and sets the returned conference in the $scope.
+     * Invokes the conference.getConferenceDetail method, which returns the conference, its sessions and
+     * featured speakers and the registration state of the user in a single response.
+     * The entity tag of the last response is sent along, so an unchanged conference isn't sent again.
      *
      */
     $scope.init = function () {
         $scope.loading = true;
-        gapi.client.conference.getConference({
+        conditionalApi.execute('getConferenceDetail', {
             websafeConferenceKey: $routeParams.websafeConferenceKey
-        }).execute(function (resp) {
+        }, function (resp) {
             $scope.$apply(function () {
                 $scope.loading = false;
                 if (resp.error) {
@@ -573,28 +654,20 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                     $log.error($scope.messages);
                 } else {
                     // The request has succeeded.
+                    var detail = resp.result;
                     $scope.alertStatus = 'success';
-                    $scope.conference = resp.result;
-                }
-            });
-        });
-
-        $scope.loading = true;
-        // If the user is attending the conference, updates the status message and available function.
-        gapi.client.conference.getProfile().execute(function (resp) {
-            $scope.$apply(function () {
-                $scope.loading = false;
-                if (resp.error) {
-                    // Failed to get a user profile.
-                } else {
-                    var profile = resp.result;
-                    for (var i = 0; i < profile.conferenceKeysToAttend.length; i++) {
-                        if ($routeParams.websafeConferenceKey == profile.conferenceKeysToAttend[i]) {
-                            // The user is attending the conference.
-                            $scope.alertStatus = 'info';
-                            $scope.messages = 'You are attending this conference';
-                            $scope.isUserAttending = true;
-                        }
+                    $scope.conference = detail.conference;
+                    $scope.sessions = detail.sessions || [];
+                    $scope.featuredSpeakers = detail.featuredSpeakers;
+                    $scope.wishlist = {};
+                    angular.forEach(detail.sessionsKeysOnWishlist || [], function (websafeKey) {
+                        $scope.wishlist[websafeKey] = true;
+                    });
+                    if (detail.isAttending) {
+                        // The user is attending the conference.
+                        $scope.alertStatus = 'info';
+                        $scope.messages = 'You are attending this conference';
+                        $scope.isUserAttending = true;
                     }
                 }
             });
@@ -626,6 +699,8 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Register succeeded.
+                        conditionalApi.invalidate('queryConferences', 'getConferencesCreated',
+                            'getConferencesToAttend');
                         $scope.messages = 'Registered for the conference';
                         $scope.alertStatus = 'success';
                         $scope.isUserAttending = true;
@@ -662,6 +737,8 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
                 } else {
                     if (resp.result) {
                         // Unregister succeeded.
+                        conditionalApi.invalidate('queryConferences', 'getConferencesCreated',
+                            'getConferencesToAttend');
                         $scope.messages = 'Unregistered from the conference';
                         $scope.alertStatus = 'success';
                         $scope.conference.seatsAvailable = $scope.conference.seatsAvailable + 1;
@@ -691,7 +768,7 @@ conferenceApp.controllers.controller('ConferenceDetailCtrl', function ($scope, $
  * such as user authentications.
  *
  */
-conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider) {
+conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oauth2Provider, conditionalApi) {
 
     /**
      * Returns if the viewLocation is the currently viewed page.
@@ -755,6 +832,8 @@ conferenceApp.controllers.controller('RootCtrl', function ($scope, $location, oa
      */
     $scope.signOut = function () {
         oauth2Provider.signOut();
+        // The cached responses belong to the user signing out.
+        conditionalApi.invalidate();
         $scope.alertStatus = 'success';
         $scope.rootMessages = 'Logged out';
     };
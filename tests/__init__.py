@@ -0,0 +1,23 @@
+"""Tests of the conference app, run on the service stubs of the App Engine
+SDK. Point GAE_SDK at the SDK and run them from the app directory:
+
+    $ GAE_SDK=~/google_appengine python -m unittest discover -s tests -t .
+
+$Id$
+"""
+
+# built-in modules
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_sdk = os.environ.get('GAE_SDK')
+if _sdk and _sdk not in sys.path:
+    sys.path.insert(0, _sdk)
+    # puts the bundled libraries (webapp2, protorpc, endpoints, ...) on the
+    # path like the devserver does
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
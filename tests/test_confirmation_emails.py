@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""test_confirmation_emails.py
+
+Tests of the batched confirmation emails of main.py: tasks are leased from
+the confirmation-email pull queue, their emails sent and the tasks deleted;
+a mail quota error backs off and leaves the unsent tasks leased.
+
+$Id$
+"""
+
+# built-in modules
+import time
+import unittest
+# third-party modules
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from google.appengine.runtime import apiproxy_errors
+# own modules
+from tests import ROOT
+import main
+from models import Conference
+from models import Profile
+from settings import CONFIRMATION_EMAIL_QUEUE
+
+
+class SendConfirmationEmailsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.setup_env(app_id='conference-api')
+        self.testbed.init_app_identity_stub()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_mail_stub()
+        # queue.yaml defines the confirmation-email pull queue
+        self.testbed.init_taskqueue_stub(root_path=ROOT)
+        ndb.get_context().clear_cache()
+        self.mailStub = self.testbed.get_stub(testbed.MAIL_SERVICE_NAME)
+        self.taskqueueStub = self.testbed.get_stub(
+            testbed.TASKQUEUE_SERVICE_NAME)
+        self.queue = taskqueue.Queue(CONFIRMATION_EMAIL_QUEUE)
+        self.sendMail = main.mail.send_mail
+
+    def tearDown(self):
+        main.mail.send_mail = self.sendMail
+        self.testbed.deactivate()
+
+    def _createConference(self, userId, name):
+        """Store a conference & its organizer and queue its email task."""
+        p_key = ndb.Key(Profile, userId)
+        Profile(key=p_key, displayName=userId,
+                mainEmail='%s@example.com' % userId).put()
+        conf = Conference(parent=p_key, name=name, city='London',
+                          topics=['Web Technologies'], organizerUserId=userId)
+        conf.put()
+        self.queue.add(taskqueue.Task(payload=conf.key.urlsafe(),
+                                      method='PULL'))
+        return conf
+
+    def _pendingTasks(self):
+        """Return the tasks in the queue, leased or not."""
+        return self.taskqueueStub.get_filtered_tasks(
+            queue_names=[CONFIRMATION_EMAIL_QUEUE])
+
+    def _run(self):
+        return main.app.get_response('/crons/send_confirmation_emails')
+
+    def _failAfter(self, count):
+        """Let the mail API send count emails, then run out of quota."""
+        sent = []
+
+        def sendMail(*args, **kwargs):
+            if len(sent) >= count:
+                raise apiproxy_errors.OverQuotaError('mail quota')
+            sent.append(args)
+            return self.sendMail(*args, **kwargs)
+        main.mail.send_mail = sendMail
+
+    def testSendsEmailsAndDeletesTasks(self):
+        for i in range(3):
+            self._createConference('user%d' % i, 'Conference %d' % i)
+
+        resp = self._run()
+
+        self.assertEqual(resp.status_int, 200)
+        self.assertIn('Sent 3 confirmation emails', resp.body)
+        messages = self.mailStub.get_sent_messages()
+        self.assertEqual(sorted(message.to for message in messages),
+                         ['user%d@example.com' % i for i in range(3)])
+        message = self.mailStub.get_sent_messages(to='user1@example.com')[0]
+        self.assertIn('Name: Conference 1', message.body.decode())
+        self.assertEqual(self._pendingTasks(), [])
+
+    def testDropsTaskOfDeletedConference(self):
+        conf = self._createConference('user0', 'Conference 0')
+        conf.key.delete()
+
+        self._run()
+
+        self.assertEqual(self.mailStub.get_sent_messages(), [])
+        self.assertEqual(self._pendingTasks(), [])
+
+    def testOverQuotaKeepsUnsentTasksLeased(self):
+        for i in range(3):
+            self._createConference('user%d' % i, 'Conference %d' % i)
+        self._failAfter(1)
+
+        resp = self._run()
+
+        self.assertIn('Sent 1 confirmation emails', resp.body)
+        self.assertEqual(len(self.mailStub.get_sent_messages()), 1)
+        # the task of the sent email is deleted, the others are kept but
+        # still leased, so they can't be leased again right away
+        self.assertEqual(len(self._pendingTasks()), 2)
+        self.assertEqual(self.queue.lease_tasks(60, 100), [])
+        backoff = memcache.get(main.MEMCACHE_EMAIL_BACKOFF_KEY)
+        self.assertEqual(backoff['seconds'], main.EMAIL_BACKOFF_MIN_SECONDS)
+        self.assertGreater(backoff['until'], time.time())
+
+    def testBacksOffWhileOverQuota(self):
+        self._createConference('user0', 'Conference 0')
+        memcache.set(main.MEMCACHE_EMAIL_BACKOFF_KEY, {
+            'seconds': 60, 'until': time.time() + 60})
+
+        resp = self._run()
+
+        self.assertEqual(resp.status_int, 204)
+        self.assertEqual(self.mailStub.get_sent_messages(), [])
+        # the task isn't leased, so it is sent once the backoff is over
+        self.assertEqual(len(self.queue.lease_tasks(60, 100)), 1)
+
+    def testDoublesBackoffOnRepeatedQuotaErrors(self):
+        self._createConference('user0', 'Conference 0')
+        memcache.set(main.MEMCACHE_EMAIL_BACKOFF_KEY, {
+            'seconds': 60, 'until': time.time() - 1})
+        self._failAfter(0)
+
+        self._run()
+
+        backoff = memcache.get(main.MEMCACHE_EMAIL_BACKOFF_KEY)
+        self.assertEqual(backoff['seconds'], 120)
+        self.assertEqual(len(self._pendingTasks()), 1)
+
+    def testResetsBackoffAfterSuccessfulRun(self):
+        self._createConference('user0', 'Conference 0')
+        memcache.set(main.MEMCACHE_EMAIL_BACKOFF_KEY, {
+            'seconds': 120, 'until': time.time() - 1})
+
+        self._run()
+
+        self.assertEqual(len(self.mailStub.get_sent_messages()), 1)
+        self.assertIsNone(memcache.get(main.MEMCACHE_EMAIL_BACKOFF_KEY))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+
+"""test_tokeninfo.py
+
+Tests of the oauth branch of utils.getUserId against a local HTTP stand-in
+for the tokeninfo endpoint (settings.TOKENINFO_URL): the token cache, retries
+of server errors within the deadline and the id_token / access_token
+fallback.
+
+$Id$
+"""
+
+# built-in modules
+import BaseHTTPServer
+import json
+import os
+import threading
+import time
+import unittest
+import urlparse
+# third-party modules
+from google.appengine.ext import testbed
+# own modules
+import tests  # puts the SDK & the app on the path
+import utils
+
+
+class TokenInfoServer(BaseHTTPServer.HTTPServer):
+    """TokenInfoServer -- answers tokeninfo requests with the scripted
+    responses of its handler & records every request"""
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           TokenInfoHandler)
+        self.requests = []
+        # function of the query parameters returning (status, body)
+        self.respond = lambda params: (404, {})
+        # seconds to wait before answering
+        self.delay = 0
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/tokeninfo' % self.server_port
+
+
+class TokenInfoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        params = dict(urlparse.parse_qsl(urlparse.urlparse(self.path).query))
+        self.server.requests.append(params)
+        time.sleep(self.server.delay)
+        status, body = self.server.respond(params)
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def validAs(tokenType, userId='1234', expiresIn=3600):
+    """Return a responder accepting any token of a type only."""
+    def respond(params):
+        if tokenType in params:
+            return 200, {'user_id': userId, 'expires_in': expiresIn}
+        return 400, {'error': 'invalid_token'}
+    return respond
+
+
+class GetUserIdOauthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        # the urlfetch stub does real HTTP requests
+        self.testbed.init_urlfetch_stub()
+        self.server = TokenInfoServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.saved = dict((name, getattr(utils, name)) for name in (
+            'TOKENINFO_URL', 'TOKENINFO_DEADLINE', 'TOKENINFO_ATTEMPTS'))
+        utils.TOKENINFO_URL = self.server.url
+        utils._tokenCache.clear()
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer token-1'
+        os.environ.pop('OAUTH_USER_ID', None)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for name, value in self.saved.items():
+            setattr(utils, name, value)
+        utils._tokenCache.clear()
+        os.environ.pop('HTTP_AUTHORIZATION', None)
+        self.testbed.deactivate()
+
+    def _getUserId(self):
+        return utils.getUserId(None, id_type='oauth')
+
+    def testCachesUserIdInProcessAndMemcache(self):
+        self.server.respond = validAs('id_token')
+
+        self.assertEqual(self._getUserId(), '1234')
+        requests = len(self.server.requests)
+        # in-process hit
+        self.assertEqual(self._getUserId(), '1234')
+        self.assertEqual(len(self.server.requests), requests)
+        # memcache hit, e.g. on another instance
+        utils._tokenCache.clear()
+        self.assertEqual(self._getUserId(), '1234')
+        self.assertEqual(len(self.server.requests), requests)
+        # another token isn't cached
+        os.environ['HTTP_AUTHORIZATION'] = 'Bearer token-2'
+        self.assertEqual(self._getUserId(), '1234')
+        self.assertGreater(len(self.server.requests), requests)
+
+    def testDoesNotCacheInvalidToken(self):
+        self.server.respond = lambda params: (400, {'error': 'invalid'})
+
+        self.assertEqual(self._getUserId(), '')
+        self.assertEqual(self._getUserId(), '')
+        # both token types are tried on every call
+        self.assertEqual(len(self.server.requests), 4)
+
+    def testFallsBackToAccessToken(self):
+        self.server.respond = validAs('access_token', userId='5678')
+
+        self.assertEqual(self._getUserId(), '5678')
+        self.assertEqual(sorted(list(params)[0] for params in
+                                self.server.requests),
+                         ['access_token', 'id_token'])
+
+    def testOnlyTriesAccessTokenIfOauthUserIdIsSet(self):
+        os.environ['OAUTH_USER_ID'] = '5678'
+        try:
+            self.server.respond = validAs('access_token', userId='5678')
+            self.assertEqual(self._getUserId(), '5678')
+            self.assertEqual([list(params) for params in self.server.requests],
+                             [['access_token']])
+        finally:
+            del os.environ['OAUTH_USER_ID']
+
+    def testRetriesServerErrors(self):
+        answers = [(503, {}), (500, {}),
+                   (200, {'user_id': '1234', 'expires_in': 3600})]
+        os.environ['OAUTH_USER_ID'] = '1234'
+        try:
+            self.server.respond = lambda params: answers.pop(0)
+            self.assertEqual(self._getUserId(), '1234')
+            self.assertEqual(len(self.server.requests), 3)
+        finally:
+            del os.environ['OAUTH_USER_ID']
+
+    def testGivesUpAtDeadline(self):
+        utils.TOKENINFO_ATTEMPTS = 100
+        utils.TOKENINFO_DEADLINE = 1
+        self.server.delay = 0.3
+        self.server.respond = lambda params: (503, {})
+
+        started = time.time()
+        self.assertEqual(self._getUserId(), '')
+        # attempts stop at the deadline, with a request in flight at most
+        self.assertLess(time.time() - started, 2)
+        self.assertLess(len(self.server.requests), 2 * 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
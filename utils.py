@@ -1,10 +1,89 @@
+import hashlib
 import json
 import os
 import time
 import uuid
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
-from models import Profile
+from models import UserIdByEmail
+from settings import TOKENINFO_URL
+
+# user ids of validated oauth tokens are cached in-process and in memcache,
+# keyed by a hash of the token, for at most the token lifetime.
+MEMCACHE_TOKEN_KEY = "TOKEN:%s"
+TOKEN_CACHE_SECONDS = 600
+TOKEN_CACHE_MAX_ENTRIES = 10000
+_tokenCache = {}
+
+# user ids of the custom strategy, keyed by normalized email address
+MEMCACHE_USER_ID_KEY = "USER_ID:%s"
+
+# all tokeninfo attempts together must not take longer than this
+TOKENINFO_DEADLINE = 5
+TOKENINFO_ATTEMPTS = 3
+
+
+def _getCachedUserId(tokenHash):
+    """Return the cached user id of a validated token or None."""
+    now = time.time()
+    entry = _tokenCache.get(tokenHash)
+    if entry is None:
+        entry = memcache.get(MEMCACHE_TOKEN_KEY % tokenHash)
+        if entry is not None:
+            _tokenCache[tokenHash] = entry
+    if entry is not None and entry[1] > now:
+        return entry[0]
+    return None
+
+
+def _cacheUserId(tokenHash, userId, expiresIn):
+    """Cache the user id of a validated token until it expires."""
+    ttl = min(TOKEN_CACHE_SECONDS, int(expiresIn or 0))
+    if ttl <= 0:
+        return
+    entry = (userId, time.time() + ttl)
+    # keep the in-process cache bounded
+    if len(_tokenCache) >= TOKEN_CACHE_MAX_ENTRIES:
+        _tokenCache.clear()
+    _tokenCache[tokenHash] = entry
+    memcache.set(MEMCACHE_TOKEN_KEY % tokenHash, entry, time=ttl)
+
+
+def _fetchTokenInfo(token, tokenTypes):
+    """Validate a token at the tokeninfo endpoint.
+
+    All candidate token types are queried concurrently. Server errors are
+    retried right away instead of sleeping, as long as attempts and the
+    overall deadline allow it.
+    """
+    deadline = time.time() + TOKENINFO_DEADLINE
+    for _ in range(TOKENINFO_ATTEMPTS):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        rpcs = []
+        for tokenType in tokenTypes:
+            rpc = urlfetch.create_rpc(deadline=remaining)
+            urlfetch.make_fetch_call(rpc, '%s?%s=%s' % (
+                TOKENINFO_URL, tokenType, token))
+            rpcs.append((tokenType, rpc))
+        retry = []
+        for tokenType, rpc in rpcs:
+            try:
+                resp = rpc.get_result()
+            except urlfetch.Error:
+                retry.append(tokenType)
+                continue
+            if resp.status_code == 200:
+                return json.loads(resp.content)
+            elif resp.status_code >= 500:
+                retry.append(tokenType)
+            # any other status means the token isn't valid as this type
+        if not retry:
+            break
+        tokenTypes = retry
+    return {}
 
 
 def getUserId(user, id_type="email"):
@@ -15,32 +94,33 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
+        tokenHash = hashlib.sha256(token).hexdigest()
+        user_id = _getCachedUserId(tokenHash)
+        if user_id is None:
+            # An id token is tried first, unless an access token has been
+            # used. As an id token may turn out to be an access token, both
+            # are validated at once.
+            if 'OAUTH_USER_ID' in os.environ:
+                tokenTypes = ['access_token']
             else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+                tokenTypes = ['id_token', 'access_token']
+            user = _fetchTokenInfo(token, tokenTypes)
+            user_id = user.get('user_id', '')
+            if user_id:
+                _cacheUserId(tokenHash, user_id, user.get('expires_in'))
+        return user_id
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorithm
-        # this is just a sample that queries datastore for an existing profile
-        # and generates an id if profile does not exist for an email
-        profile = Conference.query(Conference.mainEmail == user.email())
-        if profile:
-            return profile.id()
-        else:
-            return str(uuid.uuid1().get_hex())
+        # this is just a sample that looks up the id generated for an email
+        # address by key and generates an id if there is none yet
+        email = user.email().strip().lower()
+        user_id = memcache.get(MEMCACHE_USER_ID_KEY % email)
+        if user_id is None:
+            # get_or_insert transactionally creates the mapping, so concurrent
+            # first logins can't end up with different ids (and profiles).
+            mapping = UserIdByEmail.get_or_insert(
+                email, userId=uuid.uuid1().hex)
+            user_id = mapping.userId
+            memcache.set(MEMCACHE_USER_ID_KEY % email, user_id)
+        return user_id